@@ -1,3 +1,16 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import ExchangeRate, ProcessingJob
+
+
+@admin.register(ProcessingJob)
+class ProcessingJobAdmin(admin.ModelAdmin):
+    list_display = ("zip_filename", "user", "status", "progress_current", "progress_total", "created_at", "finished_at")
+    list_filter = ("status",)
+    readonly_fields = ("id", "stats", "worker", "heartbeat_at", "created_at", "updated_at", "started_at", "finished_at")
+
+
+@admin.register(ExchangeRate)
+class ExchangeRateAdmin(admin.ModelAdmin):
+    list_display = ("date", "currency", "rate", "fetched_at")
+    list_filter = ("currency",)
@@ -0,0 +1,227 @@
+"""
+Поиск якоря сопоставлением с образцом (cv2.matchTemplate) вместо OCR зоны якоря.
+
+Образец - изображение текста якоря (например "ИНН"), вырезанное из зоны якоря первого
+документа, на котором якорь нашел OCR. Он хранится в OCR_ANCHOR_TEMPLATE_DIR (PNG и JSON
+со смещением образца относительно рамки текста OCR), поэтому найденное смещение совпадает
+с тем, что вернул бы OCR. Если образца еще нет или совпадение ниже OCR_ANCHOR_MATCH_THRESHOLD,
+якорь ищет OCR (services.find_anchor_offset) и при успехе сохраняет образец.
+
+Если в зоне несколько мест, похожих на образец, берется первое в порядке чтения (сверху вниз,
+слева направо), как у OCR; если первое из них ниже порога, решает OCR. Образец сохраняется,
+только если OCR читает его как текст якоря и сопоставление находит его на том же месте.
+Имя файла содержит TEMPLATE_VERSION: при изменении способа вырезки образцы переучиваются.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+import cv2
+import numpy as np
+from django.conf import settings
+
+# Версия формата образцов: увеличивать при изменении вырезки образца или его проверки
+TEMPLATE_VERSION = 2
+
+MIN_GLYPH_HEIGHT = 12
+MIN_CHAR_WIDTH = 6
+MIN_GLYPH_CONTRAST = 5.0
+# Пики ниже порога не более чем на PEAK_MARGIN тоже считаются кандидатами:
+# если такой пик стоит в порядке чтения раньше, смещение определяет OCR
+PEAK_MARGIN = 0.1
+MAX_PEAKS = 16
+# Допуск (в пикселях) при проверке, что образец находится на месте рамки OCR
+LEARN_TOLERANCE = 2
+
+
+def _to_gray(image):
+    image = np.ascontiguousarray(image)
+    if image.ndim == 2:
+        return image
+    return cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+
+
+def _atomic_write(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp_")
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(data)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _peaks(res, glyph_shape, floor):
+    """Локальные максимумы res не ниже floor: [(x, y, score)], соседние пики в пределах образца подавляются."""
+    res = res.copy()
+    gh, gw = glyph_shape
+    peaks = []
+    while len(peaks) < MAX_PEAKS:
+        _, score, _, (mx, my) = cv2.minMaxLoc(res)
+        if not np.isfinite(score) or score < floor:
+            break
+        peaks.append((mx, my, float(score)))
+        res[max(0, my - gh // 2):my + gh // 2 + 1, max(0, mx - gw // 2):mx + gw // 2 + 1] = -1.0
+    return peaks
+
+
+def _first_in_reading_order(peaks, glyph_height):
+    """Первый пик в порядке чтения: верхняя строка (пики, отличающиеся по y меньше половины высоты), в ней левый."""
+    top = min(y for _, y, _ in peaks)
+    line = [p for p in peaks if p[1] - top < glyph_height / 2]
+    return min(line, key=lambda p: (p[0], p[1]))
+
+
+def _ocr_text(reader, glyph):
+    """Текст, который OCR читает на образце (с белыми полями, чтобы детектор нашел рамку)."""
+    pad = glyph.shape[0]
+    padded = cv2.copyMakeBorder(glyph, pad, pad, pad, pad, cv2.BORDER_CONSTANT, value=255)
+    results = reader.readtext(cv2.cvtColor(padded, cv2.COLOR_GRAY2BGR), detail=0)
+    return "".join(str(r) for r in results).replace(" ", "")
+
+
+class AnchorLocator:
+    def __init__(self, directory=None, threshold=None):
+        self.directory = str(directory or settings.OCR_ANCHOR_TEMPLATE_DIR)
+        self.threshold = threshold if threshold is not None else getattr(settings, 'OCR_ANCHOR_MATCH_THRESHOLD', 0.8)
+        self._glyphs = {}  # (anchor_key, text) -> (glyph, (ox, oy))
+        self._lock = threading.Lock()
+
+    def _base_path(self, anchor_key, text):
+        digest = hashlib.md5(f"{anchor_key}|{text}".encode("utf-8")).hexdigest()[:12]
+        return os.path.join(self.directory, f"anchor_v{TEMPLATE_VERSION}_{digest}")
+
+    def _load(self, anchor_key, text):
+        key = (anchor_key, text)
+        with self._lock:
+            if key in self._glyphs:
+                return self._glyphs[key]
+
+        base = self._base_path(anchor_key, text)
+        glyph = None
+        try:
+            with open(base + ".json", encoding="utf-8") as fh:
+                meta = json.load(fh)
+            if meta.get("version") != TEMPLATE_VERSION:
+                raise ValueError(f"anchor template version {meta.get('version')}")
+            # cv2.imread не открывает пути с кириллицей в Windows, поэтому читаем байты сами
+            with open(base + ".png", 'rb') as fh:
+                image = cv2.imdecode(np.frombuffer(fh.read(), np.uint8), cv2.IMREAD_GRAYSCALE)
+            if image is not None:
+                glyph = (image, tuple(meta["offset"]))
+        except (OSError, ValueError, KeyError):
+            # Образца еще нет: его может сохранить другой процесс пула, поэтому отсутствие не кэшируется
+            return None
+
+        if glyph is not None:
+            with self._lock:
+                self._glyphs[key] = glyph
+        return glyph
+
+    def match(self, anchor_crop, anchor_key, text):
+        """
+        Ищет образец якоря в кропе зоны якоря. Возвращает (dx, dy, score) - смещение в координатах
+        кропа, как у рамки OCR, и TM_CCOEFF_NORMED в [-1, 1]; None, если образца нет.
+        Из нескольких совпадений выбирается первое в порядке чтения (см. _locate).
+        """
+        glyph = self._load(anchor_key, text)
+        if glyph is None:
+            return None
+        image, (ox, oy) = glyph
+        found = self._locate(_to_gray(anchor_crop), image)
+        if found is None:
+            return None
+        mx, my, score = found
+        return mx - ox, my - oy, score
+
+    def _locate(self, gray, image):
+        """
+        (x, y, score) образца image в gray. Кандидаты - пики не ниже threshold - PEAK_MARGIN;
+        берется первый в порядке чтения, и если он ниже порога, вызывающий код уходит в OCR,
+        даже когда дальше есть более сильный пик (другое вхождение текста, которое OCR не выбрал бы).
+        """
+        if gray.shape[0] < image.shape[0] or gray.shape[1] < image.shape[1]:
+            return None
+        res = cv2.matchTemplate(gray, image, cv2.TM_CCOEFF_NORMED)
+        peaks = _peaks(res, image.shape, self.threshold - PEAK_MARGIN)
+        if peaks:
+            return _first_in_reading_order(peaks, image.shape[0])
+        _, score, _, (mx, my) = cv2.minMaxLoc(res)
+        if not np.isfinite(score):
+            return None
+        return mx, my, float(score)
+
+    def learn(self, anchor_crop, anchor_key, text, bbox, ocr_text, reader):
+        """
+        Сохраняет образец по найденной OCR рамке bbox с текстом ocr_text, содержащим text.
+        Ширина символа оценивается по рамке, поэтому в образец попадает только сам текст якоря,
+        без соседних символов (номер ИНН у каждого документа свой). Образец проверяется: reader
+        должен прочитать на нем ровно text, а сопоставление с кропом - вернуть смещение рамки OCR.
+        Возвращает True, если образец сохранен.
+        """
+        if self._load(anchor_key, text) is not None:
+            return False
+        idx = ocr_text.find(text)
+        if idx < 0:
+            return False
+
+        gray = _to_gray(anchor_crop)
+        x0, y0 = int(bbox[0][0]), int(bbox[0][1])
+        x1, y1 = int(bbox[2][0]), int(bbox[2][1])
+        char_w = (x1 - x0) / len(ocr_text)
+        gx0 = max(0, int(round(x0 + idx * char_w)))
+        gx1 = min(gray.shape[1], int(round(x0 + (idx + len(text)) * char_w)))
+        gy0, gy1 = max(0, y0), min(gray.shape[0], y1)
+        glyph = gray[gy0:gy1, gx0:gx1]
+        if (glyph.shape[0] < MIN_GLYPH_HEIGHT or glyph.shape[1] < MIN_CHAR_WIDTH * len(text)
+                or glyph.std() < MIN_GLYPH_CONTRAST):
+            print(f"[AnchorLocator] Anchor template '{text}' rejected: {glyph.shape[1]}x{glyph.shape[0]}, std={glyph.std():.1f}")
+            return False
+
+        glyph = np.ascontiguousarray(glyph)
+        glyph_text = _ocr_text(reader, glyph)
+        if glyph_text != text:
+            print(f"[AnchorLocator] Anchor template '{text}' rejected: OCR reads '{glyph_text}'")
+            return False
+        found = self._locate(gray, glyph)
+        if (found is None or found[2] < self.threshold
+                or abs(found[0] - gx0) > LEARN_TOLERANCE or abs(found[1] - gy0) > LEARN_TOLERANCE):
+            print(f"[AnchorLocator] Anchor template '{text}' rejected: match {found} != ({gx0}, {gy0})")
+            return False
+
+        ok, png = cv2.imencode(".png", glyph)
+        if not ok:
+            return False
+        base = self._base_path(anchor_key, text)
+        os.makedirs(self.directory, exist_ok=True)
+        meta = {"version": TEMPLATE_VERSION, "anchor_key": anchor_key, "text": text, "offset": [gx0 - x0, gy0 - y0]}
+        # Сначала картинка, потом JSON: образец без JSON не загружается, поэтому частично записанного не бывает
+        _atomic_write(base + ".png", png.tobytes())
+        _atomic_write(base + ".json", json.dumps(meta, ensure_ascii=False).encode("utf-8"))
+        with self._lock:
+            self._glyphs[(anchor_key, text)] = (glyph, (gx0 - x0, gy0 - y0))
+        print(f"[AnchorLocator] Saved anchor template '{text}' ({glyph.shape[1]}x{glyph.shape[0]}) to {base}.png")
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._glyphs.clear()
+
+
+_locator = None
+_locator_lock = threading.Lock()
+
+
+def get_anchor_locator():
+    """Поиск якоря по образцу в текущем процессе или None, если он выключен (OCR_ANCHOR_MATCHING_ENABLED=False)."""
+    global _locator
+    if not getattr(settings, 'OCR_ANCHOR_MATCHING_ENABLED', True):
+        return None
+    with _locator_lock:
+        if _locator is None:
+            _locator = AnchorLocator()
+        return _locator
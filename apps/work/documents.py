@@ -0,0 +1,251 @@
+"""
+Реестр шаблонов документов.
+
+Шаблон описывает тип документа целиком: как узнать файл по имени, какие поля на каких
+страницах читать (прямоугольник в пикселях 300 dpi, якорь, предобработка кропа,
+минимальная высота строки, проверка значения из текстового слоя), каким методом
+DataCleaner чистить значение и в какую колонку строки оно попадает, а также запасную
+страницу, если значение не прошло проверку. Новый тип документа добавляется записью
+в DOCUMENT_TEMPLATES, без новых веток в services.
+
+Каждый шаблон при загрузке реестра компилируется в план (ExtractionPlan): список страниц,
+каждая из которых рендерится один раз и распознается одним пакетом OCR, и запасные шаги.
+"""
+import re
+import threading
+from decimal import Decimal
+
+
+class FieldSpec:
+    """
+    Поле документа.
+    rect - (x, y, w, h) в пикселях 300 dpi; column - колонка строки результата (None - не переносится);
+    cleaner - имя метода DataCleaner; preprocessing - см. services.preprocess_crop;
+    min_height - строки OCR ниже этой высоты не попадают в значение; raw - значение поля
+    это список (text, height) для собственной очистки; text_layer_check - проверка текста
+    из текстового слоя PDF (не прошедшее поле распознается OCR); anchor_text - текст якоря.
+    """
+
+    def __init__(self, name, rect, column=None, cleaner=None, preprocessing=None, min_height=0,
+                 raw=False, text_layer_check=None, anchor_text=None):
+        self.name = name
+        self.rect = rect
+        self.column = column
+        self.cleaner = cleaner
+        self.preprocessing = preprocessing
+        self.min_height = min_height
+        self.raw = raw
+        self.text_layer_check = text_layer_check
+        self.anchor_text = anchor_text
+
+    @property
+    def is_anchor(self):
+        return self.anchor_text is not None
+
+
+class FallbackPage:
+    """Если очищенное значение поля target не проходит is_valid, оно берется из поля field страницы page."""
+
+    def __init__(self, target, page, field, is_valid):
+        self.target = target
+        self.page = page
+        self.field = field
+        self.is_valid = is_valid
+
+
+class PageStep:
+    """Шаг плана: одна страница - один рендер и один пакет OCR для всех ее полей."""
+
+    def __init__(self, page_num, fields, apply_deskew, use_text_layer):
+        self.page_num = page_num
+        self.fields = fields
+        self.coords_map = {f.name: f.rect for f in fields}
+        self.apply_deskew = apply_deskew
+        self.use_text_layer = use_text_layer
+
+
+class ExtractionPlan:
+    def __init__(self, steps, fallbacks):
+        self.steps = steps
+        self.fallbacks = fallbacks  # [(FallbackPage, PageStep)]
+
+
+class DocumentTemplate:
+    """
+    key - короткое имя (t1, t2...); filename_pattern - регулярное выражение для имени файла (re.match, без учета регистра);
+    extensions - допустимые расширения; pages - {номер страницы: [FieldSpec, ...]};
+    apply_deskew - выравнивать страницу; use_text_layer - сначала читать текстовый слой PDF.
+    """
+
+    def __init__(self, key, title, filename_pattern, extensions, pages, apply_deskew=False,
+                 use_text_layer=False, fallbacks=()):
+        self.key = key
+        self.title = title
+        self.filename_re = re.compile(filename_pattern, re.IGNORECASE)
+        self.extensions = tuple(extensions)
+        self.pages = pages
+        self.apply_deskew = apply_deskew
+        self.use_text_layer = use_text_layer
+        self.fallbacks = list(fallbacks)
+        self.plan = compile_plan(self)
+
+    def matches(self, filename):
+        return filename.lower().endswith(self.extensions) and bool(self.filename_re.match(filename))
+
+    def coords_map(self, page_num=0):
+        return {f.name: f.rect for f in self.pages.get(page_num, [])}
+
+    def fields(self):
+        for page_fields in self.pages.values():
+            yield from page_fields
+        for fallback in self.fallbacks:
+            yield fallback.field
+
+    def __repr__(self):
+        return f"<DocumentTemplate {self.key}: {self.title}>"
+
+
+def compile_plan(template):
+    steps = [
+        PageStep(page_num, fields, template.apply_deskew, template.use_text_layer)
+        for page_num, fields in sorted(template.pages.items())
+    ]
+    fallbacks = [
+        (fallback, PageStep(fallback.page, [fallback.field], template.apply_deskew, template.use_text_layer))
+        for fallback in template.fallbacks
+    ]
+    return ExtractionPlan(steps, fallbacks)
+
+
+def _has_digit(text):
+    return bool(re.search(r'\d', text))
+
+
+def safe_decimal(value, field_name):
+    if not value:
+        return Decimal("0")
+    cleaned = ""
+    for ch in value:
+        if ch.isdigit() or ch in ".,":
+            cleaned += ch
+    cleaned = cleaned.replace(",", ".")
+    if cleaned == "":
+        return Decimal("0")
+    try:
+        return Decimal(cleaned)
+    except Exception as e:
+        print(f"Ошибка Decimal для '{field_name}': '{value}' в '{cleaned}': {e}")
+        return Decimal("0")
+
+
+def _valid_price(value):
+    # Цена 7 или не больше 1 - OCR прочитал не ту строку первой страницы ЭСФ
+    price = safe_decimal(value, "Check Price")
+    return not (price == Decimal("7") or price <= Decimal("1"))
+
+
+DOCUMENT_TEMPLATES = [
+    DocumentTemplate(
+        key="t1",
+        title="Type 1 (Main)",
+        filename_pattern=r'^[\d\.]+(\s*(cmp|смп|смр|cmr))?\s*\.(pdf|xlsx)$',
+        extensions=(".pdf", ".xlsx"),
+        apply_deskew=True,
+        pages={0: [
+            # Колонка 1 - дата из формы загрузки; дата документа нужна для каталога фото водителя
+            FieldSpec("Дата (1)", (880, 2520, 390, 140), cleaner="clean_1"),
+            FieldSpec("ФИО Водит. (4)", (850, 2450, 500, 150), column=4, cleaner="clean_fio", min_height=20, raw=True,
+                      preprocessing={"channel": "b", "threshold": 170}),
+            FieldSpec("Кол.тон (7)", (1500, 1390, 300, 80), column=7, cleaner="clean_7"),
+            # Синий канал гасит синие печати и подписи поверх марки и номера
+            FieldSpec("Марка", (380, 2730, 350, 70), column=2, cleaner="clean_marka", raw=True,
+                      preprocessing={"channel": "b"}),
+            FieldSpec("Гос_номер ()", (-80, 2730, 700, 170), column=3, cleaner="clean_gos_number", raw=True,
+                      preprocessing={"channel": "b", "threshold": 165}),
+            FieldSpec("Якорь (1)", (0, 500, 500, 1000), anchor_text="ИНН"),
+        ]},
+    ),
+    DocumentTemplate(
+        key="t2",
+        title="Type 2 (ESF)",
+        filename_pattern=r'^(эсф|электронный\s*(-)?\s*счет\s*(-)?\s*фактура)',
+        extensions=(".pdf",),
+        use_text_layer=True,
+        pages={0: [
+            FieldSpec("Цена (8)", (1450, 2150, 250, 160), column=8, cleaner="clean_8", text_layer_check=_has_digit),
+            FieldSpec("№ счет факт (Инвойс) (16)", (500, 200, 500, 60), column=16, cleaner="clean_16",
+                      text_layer_check=_has_digit),
+        ]},
+        fallbacks=[
+            FallbackPage("Цена (8)", 1, FieldSpec("Цена (8) Alt", (1500, 100, 150, 120), text_layer_check=_has_digit),
+                         is_valid=_valid_price),
+        ],
+    ),
+    DocumentTemplate(
+        key="t3",
+        title="Type 3 (SNT)",
+        filename_pattern=r'^(снт|сопроводительная\s*накладная\s*(на)?\s*товары)',
+        extensions=(".pdf",),
+        use_text_layer=True,
+        pages={0: [
+            FieldSpec("№ сопров.накл. KZ (15)", (360, 250, 330, 200), column=15, cleaner="clean_15",
+                      text_layer_check=lambda text: bool(re.search(r'KZ-SNT-', text))),
+            FieldSpec("Дата сопр.накл (13)", (360, 250, 330, 200), column=13, cleaner="clean_1",
+                      text_layer_check=lambda text: bool(re.search(r'\b\d{2}\.\d{2}\.\d{4}\b', text))),
+        ]},
+    ),
+]
+
+
+class DocumentRegistry:
+    def __init__(self, templates):
+        self.templates = list(templates)
+        self._by_key = {}
+        self._fields = {}
+        for template in self.templates:
+            if template.key in self._by_key:
+                raise ValueError(f"Повторяющийся ключ шаблона документа: {template.key}")
+            self._by_key[template.key] = template
+            for field in template.fields():
+                # Поле ищется по имени при кропе и разборе OCR, поэтому имена уникальны во всем реестре
+                if field.name in self._fields:
+                    raise ValueError(f"Поле '{field.name}' объявлено в нескольких шаблонах")
+                self._fields[field.name] = field
+
+    def get(self, key):
+        return self._by_key[key]
+
+    def field(self, name):
+        return self._fields.get(name)
+
+    def classify(self, filename):
+        """Первый шаблон (в порядке DOCUMENT_TEMPLATES), которому соответствует имя файла, или None."""
+        for template in self.templates:
+            if template.matches(filename):
+                return template
+        return None
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = DocumentRegistry(DOCUMENT_TEMPLATES)
+        return _registry
+
+
+def get_template(key):
+    return get_registry().get(key)
+
+
+def field_spec(name):
+    """FieldSpec поля по имени или None для полей вне реестра."""
+    return get_registry().field(name)
+
+
+def classify_file(filename):
+    return get_registry().classify(filename)
@@ -0,0 +1,554 @@
+"""
+Выгрузка результатов в Excel.
+
+Новая книга пишется в режиме write-only openpyxl: строки сразу уходят во временный
+файл листа, стили (шрифт, заливка, формат чисел) и буквы колонок формул вычисляются
+один раз на книгу, а не для каждой ячейки. Готовый XLSX собирается во временном файле
+и отдается FileResponse по частям, поэтому память не зависит от числа строк.
+
+Дописывание в загруженный пользователем файл (append_to_workbook) не загружает книгу
+целиком: XML активного листа читается потоком (первая строка - заголовок, колонка A -
+последний номер, номер последней строки), новые строки вставляются перед </sheetData>,
+в styles.xml добавляются только нужные стили, а остальные части XLSX копируются как есть.
+Старые строки не переформатируются. Если лист содержит таблицы или автофильтр (их
+удаляет generate_excel) или устроен нестандартно, книга дописывается через openpyxl.
+"""
+import html
+import re
+import shutil
+import tempfile
+import zipfile
+from copy import copy
+from datetime import date, datetime
+from decimal import Decimal
+from xml.etree import ElementTree
+
+import openpyxl
+from django.http import FileResponse
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+from openpyxl.styles import Font, PatternFill
+from openpyxl.utils import column_index_from_string, get_column_letter
+
+XLSX_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+HEADERS = [
+    "Дата", "Марка АТС", "Гос.номер АТС", "ФИО Водит.", "Код ТН ВЭД",
+    "БНД", "Кол.тон", "Цена", "Сумма в $", "Курс", "Сумма в сомах",
+    "НДС ЕАЭС", "Дата сопр.накл", "Номер СМР", "№ сопров.накл. KZ", "№ счет факт"
+]
+
+# Номера полей строки результата (ключи row) в порядке колонок; 9, 11, 12 - формулы
+FIELD_ORDER = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16]
+DATE_FIELDS = (1, 13)
+INT_FIELDS = (5, 14)
+NUMERIC_FIELDS = (7, 8, 9, 10, 11, 12)
+LIGHT_GREEN_FIELDS = (1, 10)
+DARK_GREEN_FIELDS = (7,)
+
+FILL_LIGHT_GREEN = PatternFill(start_color="92D050", end_color="92D050", fill_type="solid")
+FILL_DARK_GREEN = PatternFill(start_color="00B050", end_color="00B050", fill_type="solid")
+
+
+class RowStyles:
+    """Стили ячеек строки данных, вычисленные один раз на книгу: {(поле, вид значения): StyleArray}."""
+
+    def __init__(self, ws):
+        self._ws = ws
+        self._styles = {}
+        for field in FIELD_ORDER:
+            self._styles[(field, None)] = self._make(field)
+            if field in DATE_FIELDS:
+                self._styles[(field, 'date')] = self._make(field, 'DD.MM.YYYY')
+            if field in INT_FIELDS:
+                self._styles[(field, 'int')] = self._make(field, '0')
+
+    def _make(self, field, number_format=None):
+        cell = WriteOnlyCell(self._ws)
+        if field in NUMERIC_FIELDS:
+            cell.number_format = '#,##0.00'
+        if number_format:
+            cell.number_format = number_format
+        if field in LIGHT_GREEN_FIELDS:
+            cell.fill = FILL_LIGHT_GREEN
+        elif field in DARK_GREEN_FIELDS:
+            cell.fill = FILL_DARK_GREEN
+        return cell._style
+
+    def cell(self, field, value, kind=None):
+        cell = WriteOnlyCell(self._ws, value)
+        cell._style = copy(self._styles[(field, kind)])
+        return cell
+
+
+def coerce_value(field, value):
+    """Значение ячейки и вид стиля: даты ДД.ММ.ГГГГ -> date, цифровые коды ТН ВЭД/СМР -> int."""
+    if value and isinstance(value, str):
+        if field in DATE_FIELDS:
+            try:
+                return datetime.strptime(value, "%d.%m.%Y").date(), 'date'
+            except ValueError:
+                pass
+        if field in INT_FIELDS and value.isdigit():
+            return int(value), 'int'
+    return value, None
+
+
+def write_new_workbook(data, fileobj, nds_percent=2):
+    """Пишет новую книгу со строками data (как в generate_excel) в fileobj."""
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("OCR Results")
+    styles = RowStyles(ws)
+
+    bold_font = Font(bold=True)
+    header = []
+    for title in HEADERS:
+        cell = WriteOnlyCell(ws, title)
+        cell.font = bold_font
+        header.append(cell)
+    ws.append(header)
+
+    letters = {field: get_column_letter(col) for col, field in enumerate(FIELD_ORDER, start=1)}
+    sum_dollar = f"={letters[7]}{{0}}*{letters[8]}{{0}}"
+    sum_som = f"={letters[9]}{{0}}*{letters[10]}{{0}}"
+    nds = f"={letters[11]}{{0}}*{nds_percent}%"
+
+    for row_num, row in enumerate(data, start=2):
+        values = {field: row.get(field) for field in FIELD_ORDER}
+        values[9] = sum_dollar.format(row_num)
+        values[11] = sum_som.format(row_num)
+        values[12] = nds.format(row_num)
+        cells = []
+        for field in FIELD_ORDER:
+            value, kind = coerce_value(field, values[field])
+            cells.append(styles.cell(field, value, kind))
+        ws.append(cells)
+
+    wb.save(fileobj)
+
+
+class AppendNotSupported(Exception):
+    """Книгу нельзя дописать потоково; она дописывается через openpyxl (services.generate_excel)."""
+
+
+CHUNK_SIZE = 1024 * 1024
+MAIN_NS = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+REL_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+
+SHEET_DATA_RE = re.compile(rb'<sheetData\s*(/?)>')
+SHEET_DATA_END = b'</sheetData>'
+ROW_TAG_RE = re.compile(rb'<row\b([^>]*)>')
+CELL_WITHOUT_REF_RE = re.compile(rb'<c(?=[\s>/])(?![^>]*\br=")')
+CELL_A_RE = re.compile(rb'<c\b([^>]*?\br="A(\d+)"[^>]*?)(/?)>')
+DIMENSION_RE = re.compile(rb'<dimension\s+ref="([A-Z]+\d+)(?::([A-Z]+)\d+)?"\s*/>')
+UNSUPPORTED_RE = re.compile(rb'<(?:autoFilter|tableParts)\b')
+
+BUILTIN_FORMAT_NUMBER = 4  # '#,##0.00'
+BUILTIN_FORMAT_INT = 1  # '0'
+DATE_FORMAT_CODE = 'DD.MM.YYYY'
+
+
+def _attr(attrs, name):
+    match = re.search(rb'\b' + name + rb'="([^"]*)"', attrs)
+    return match.group(1).decode() if match else None
+
+
+def _text(value):
+    return html.unescape(value.decode("utf-8"))
+
+
+class SheetScan:
+    """Что нужно знать о листе перед дописыванием: последняя строка, ячейка A1 и значения колонки A."""
+
+    def __init__(self):
+        self.last_row = 0
+        self.header = None  # ('s', индекс в sharedStrings) или ('v', текст)
+        self.max_number = 0  # наибольший номер в колонке A начиная со 2-й строки
+        self.shared_numbers = set()  # индексы sharedStrings ячеек колонки A - номер хранится строкой
+
+    def feed(self, data):
+        if CELL_WITHOUT_REF_RE.search(data):
+            raise AppendNotSupported("ячейки без адреса")
+        for match in ROW_TAG_RE.finditer(data):
+            row_num = _attr(match.group(1), b"r")
+            if row_num is None:
+                raise AppendNotSupported("строки без номера")
+            self.last_row = max(self.last_row, int(row_num))
+        for match in CELL_A_RE.finditer(data):
+            attrs, row_num, closed = match.groups()
+            if closed:
+                continue
+            end = data.find(b'</c>', match.end())
+            body = data[match.end():end]
+            cell_type = _attr(attrs, b"t")
+            if cell_type == "inlineStr":
+                value = ('v', "".join(_text(t) for t in re.findall(rb'<t\b[^>]*>(.*?)</t>', body, re.S)))
+            else:
+                v = re.search(rb'<v>(.*?)</v>', body, re.S)
+                if v is None:
+                    continue
+                value = ('s', int(v.group(1))) if cell_type == "s" else ('v', _text(v.group(1)))
+            if int(row_num) == 1:
+                self.header = value
+            elif value[0] == 's':
+                self.shared_numbers.add(value[1])
+            else:
+                self.max_number = max(self.max_number, _parse_number(value[1]) or 0)
+
+
+def _parse_number(text):
+    # Как int(cell.value) в generate_excel: числа Excel хранятся как "5" или "5.0"
+    try:
+        number = float(text)
+    except ValueError:
+        return None
+    return int(number) if number.is_integer() else None
+
+
+def _shared_strings(zin, path, indexes):
+    """Только нужные строки sharedStrings.xml: {индекс: текст}. Файл читается потоком."""
+    if not indexes or path not in zin.namelist():
+        return {}
+    result = {}
+    last = max(indexes)
+    idx = 0
+    with zin.open(path) as fh:
+        for _, elem in ElementTree.iterparse(fh):
+            if elem.tag != f"{{{MAIN_NS}}}si":
+                continue
+            if idx in indexes:
+                result[idx] = "".join(t.text or "" for t in elem.iter(f"{{{MAIN_NS}}}t"))
+            elem.clear()
+            idx += 1
+            if idx > last:
+                break
+    return result
+
+
+def _resolve_part(base_dir, target):
+    if target.startswith("/"):
+        return target.lstrip("/")
+    parts = []
+    for piece in f"{base_dir}/{target}".split("/"):
+        if piece == "..":
+            parts.pop()
+        elif piece and piece != ".":
+            parts.append(piece)
+    return "/".join(parts)
+
+
+def _workbook_parts(zin):
+    """(путь активного листа, путь sharedStrings, путь styles, book 1904)."""
+    workbook = zin.read("xl/workbook.xml")
+    rels = ElementTree.fromstring(zin.read("xl/_rels/workbook.xml.rels"))
+    targets = {}
+    for rel in rels:
+        targets[rel.get("Id")] = (rel.get("Type", "").rsplit("/", 1)[-1], _resolve_part("xl", rel.get("Target")))
+
+    root = ElementTree.fromstring(workbook)
+    view = root.find(f"{{{MAIN_NS}}}bookViews/{{{MAIN_NS}}}workbookView")
+    active = int(view.get("activeTab", 0)) if view is not None else 0
+    sheets = root.findall(f"{{{MAIN_NS}}}sheets/{{{MAIN_NS}}}sheet")
+    if active >= len(sheets):
+        raise AppendNotSupported("не найден активный лист")
+    rel_type, sheet_path = targets.get(sheets[active].get(f"{{{REL_NS}}}id"), (None, None))
+    if rel_type != "worksheet":
+        raise AppendNotSupported("активный лист не является таблицей")
+
+    shared_path = styles_path = None
+    for rel_type, path in targets.values():
+        if rel_type == "sharedStrings":
+            shared_path = path
+        elif rel_type == "styles":
+            styles_path = path
+    if styles_path is None:
+        raise AppendNotSupported("нет styles.xml")
+    pr = root.find(f"{{{MAIN_NS}}}workbookPr")
+    date1904 = pr is not None and pr.get("date1904") in ("1", "true")
+    return sheet_path, shared_path, styles_path, date1904
+
+
+class StyleAppender:
+    """Добавляет в styles.xml заливки, формат даты и cellXfs для новых строк, не трогая существующие стили."""
+
+    def __init__(self, xml):
+        self.xml = xml
+        if '<styleSheet' not in xml or '<cellXfs' not in xml or '<fills' not in xml:
+            raise AppendNotSupported("нестандартный styles.xml")
+        self.date_format_id = self._date_format()
+        self.fill_ids = {
+            'light': self._append_block("fills", "fill", _fill_xml("0092D050")),
+            'dark': self._append_block("fills", "fill", _fill_xml("0000B050")),
+        }
+        self._xf_ids = {}
+
+    def _date_format(self):
+        used = [163]
+        for match in re.finditer(r'<numFmt\b([^>]*)/>', self.xml):
+            fmt_id = re.search(r'numFmtId="(\d+)"', match.group(1))
+            code = re.search(r'formatCode="([^"]*)"', match.group(1))
+            if fmt_id is None or code is None:
+                continue
+            if html.unescape(code.group(1)) == DATE_FORMAT_CODE:
+                return int(fmt_id.group(1))
+            used.append(int(fmt_id.group(1)))
+        fmt_id = max(used) + 1
+        num_fmt = f'<numFmt numFmtId="{fmt_id}" formatCode="{DATE_FORMAT_CODE}"/>'
+        if re.search(r'<numFmts\b[^>]*/>', self.xml):
+            self.xml = re.sub(r'<numFmts\b[^>]*/>', f'<numFmts count="1">{num_fmt}</numFmts>', self.xml, count=1)
+        elif '<numFmts' in self.xml:
+            self._append_block("numFmts", "numFmt", num_fmt)
+        else:
+            # numFmts - первый дочерний элемент styleSheet
+            self.xml = re.sub(r'(<styleSheet\b[^>]*>)', rf'\1<numFmts count="1">{num_fmt}</numFmts>', self.xml, count=1)
+        return fmt_id
+
+    def _append_block(self, block, item, item_xml):
+        """Добавляет элемент в конец блока (fills, cellXfs...) и возвращает его индекс."""
+        match = re.search(rf'<{block}\b[^>]*>(.*?)</{block}>', self.xml, re.S)
+        if match is None:
+            raise AppendNotSupported(f"в styles.xml нет {block}")
+        index = len(re.findall(rf'<{item}[\s>/]', match.group(1)))
+        open_tag = re.sub(r'\bcount="\d+"', f'count="{index + 1}"', self.xml[match.start():match.start(1)])
+        self.xml = (self.xml[:match.start()] + open_tag + match.group(1) + item_xml
+                    + self.xml[match.end(1):])
+        return index
+
+    def xf(self, num_fmt_id, fill):
+        key = (num_fmt_id, fill)
+        if key not in self._xf_ids:
+            fill_id = self.fill_ids[fill] if fill else 0
+            attrs = f'numFmtId="{num_fmt_id}" fontId="0" fillId="{fill_id}" borderId="0" xfId="0"'
+            if num_fmt_id:
+                attrs += ' applyNumberFormat="1"'
+            if fill_id:
+                attrs += ' applyFill="1"'
+            self._xf_ids[key] = self._append_block("cellXfs", "xf", f'<xf {attrs}/>')
+        return self._xf_ids[key]
+
+    def style_for(self, field, kind):
+        if kind == 'date':
+            num_fmt_id = self.date_format_id
+        elif kind == 'int':
+            num_fmt_id = BUILTIN_FORMAT_INT
+        elif field in NUMERIC_FIELDS:
+            num_fmt_id = BUILTIN_FORMAT_NUMBER
+        else:
+            num_fmt_id = 0
+        fill = 'light' if field in LIGHT_GREEN_FIELDS else 'dark' if field in DARK_GREEN_FIELDS else None
+        if not num_fmt_id and not fill:
+            return None
+        return self.xf(num_fmt_id, fill)
+
+
+def _fill_xml(rgb):
+    return f'<fill><patternFill patternType="solid"><fgColor rgb="{rgb}"/><bgColor rgb="{rgb}"/></patternFill></fill>'
+
+
+def _cell_xml(ref, value, style):
+    s = f' s="{style}"' if style else ''
+    if value is None or value == '':
+        return f'<c r="{ref}"{s}/>' if style else ''
+    if isinstance(value, str) and value.startswith('='):
+        return f'<c r="{ref}"{s}><f>{html.escape(value[1:], quote=False)}</f></c>'
+    if isinstance(value, bool):
+        return f'<c r="{ref}"{s} t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, (int, float, Decimal)):
+        return f'<c r="{ref}"{s} t="n"><v>{value}</v></c>'
+    text = html.escape(ILLEGAL_CHARACTERS_RE.sub('', str(value)), quote=False)
+    return f'<c r="{ref}"{s} t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+
+def _excel_serial(day, date1904):
+    epoch = date(1904, 1, 1) if date1904 else date(1899, 12, 30)
+    return (day - epoch).days
+
+
+def _new_rows_xml(data, first_row, next_number, has_numbering, styles, date1904, nds_percent):
+    offset = 1 if has_numbering else 0
+    letters = {field: get_column_letter(col + offset) for col, field in enumerate(FIELD_ORDER, start=1)}
+    cell_styles = {}
+    for row_num, row in enumerate(data, start=first_row):
+        values = {field: row.get(field) for field in FIELD_ORDER}
+        values[9] = f"={letters[7]}{row_num}*{letters[8]}{row_num}"
+        values[11] = f"={letters[9]}{row_num}*{letters[10]}{row_num}"
+        values[12] = f"={letters[11]}{row_num}*{nds_percent}%"
+        cells = []
+        if has_numbering:
+            cells.append(_cell_xml(f"A{row_num}", next_number, None))
+            next_number += 1
+        for field in FIELD_ORDER:
+            value, kind = coerce_value(field, values[field])
+            if kind == 'date':
+                value = _excel_serial(value, date1904)
+            if (field, kind) not in cell_styles:
+                cell_styles[(field, kind)] = styles.style_for(field, kind)
+            cells.append(_cell_xml(f"{letters[field]}{row_num}", value, cell_styles[(field, kind)]))
+        yield f'<row r="{row_num}">{"".join(cells)}</row>'.encode("utf-8")
+
+
+def _scan_sheet(zin, sheet_path):
+    scan = SheetScan()
+    buf = b""
+    with zin.open(sheet_path) as fh:
+        for chunk in iter(lambda: fh.read(CHUNK_SIZE), b""):
+            buf += chunk
+            cut = buf.rfind(b"</row>")
+            if cut < 0:
+                continue
+            cut += len(b"</row>")
+            scan.feed(buf[:cut])
+            buf = buf[cut:]
+    scan.feed(buf)
+    if not SHEET_DATA_RE.search(buf) and scan.last_row == 0:
+        raise AppendNotSupported("не найден sheetData")
+    if UNSUPPORTED_RE.search(buf):
+        raise AppendNotSupported("таблица или автофильтр")
+    return scan
+
+
+def _copy_sheet(src, dst, new_rows, last_row, last_col):
+    """Копирует XML листа, вставляя new_rows (итератор байтов) перед </sheetData> и обновляя dimension."""
+    def fix_dimension(match):
+        start, end_col = match.group(1), match.group(2) or re.match(rb'[A-Z]+', match.group(1)).group(0)
+        end_col = max(end_col.decode(), last_col, key=column_index_from_string)
+        return b'<dimension ref="%s:%s%d"/>' % (start, end_col.encode(), last_row)
+
+    head = b""
+    for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+        head += chunk
+        if SHEET_DATA_RE.search(head):
+            break
+    match = SHEET_DATA_RE.search(head)
+    if match is None:
+        raise AppendNotSupported("не найден sheetData")
+    dst.write(DIMENSION_RE.sub(fix_dimension, head[:match.start()], count=1))
+    if match.group(1):
+        # Пустой лист: <sheetData/>
+        dst.write(b'<sheetData>')
+        for row in new_rows:
+            dst.write(row)
+        dst.write(SHEET_DATA_END)
+        dst.write(head[match.end():])
+        shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        return
+
+    dst.write(head[match.start():match.end()])
+    buf = head[match.end():]
+    keep = len(SHEET_DATA_END) - 1
+    while True:
+        end = buf.find(SHEET_DATA_END)
+        if end >= 0:
+            dst.write(buf[:end])
+            for row in new_rows:
+                dst.write(row)
+            dst.write(buf[end:])
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+            return
+        chunk = src.read(CHUNK_SIZE)
+        if not chunk:
+            raise AppendNotSupported("не найден конец sheetData")
+        # Хвост оставляется, чтобы не пропустить </sheetData> на границе блоков
+        dst.write(buf[:-keep])
+        buf = buf[-keep:] + chunk
+
+
+def _full_calc_on_load(xml):
+    # Новые формулы записаны без вычисленных значений: Excel пересчитает книгу при открытии
+    if re.search(rb'<calcPr\b[^>]*\bfullCalcOnLoad=', xml):
+        return xml
+    if b'<calcPr' in xml:
+        return re.sub(rb'<calcPr\b', b'<calcPr fullCalcOnLoad="1"', xml, count=1)
+    match = re.search(rb'<(?:oleSize|customWorkbookViews|pivotCaches|smartTagPr|smartTagTypes|webPublishing'
+                      rb'|fileRecoveryPr|webPublishObjects|extLst)\b|</workbook>', xml)
+    if match is None:
+        return xml
+    return xml[:match.start()] + b'<calcPr fullCalcOnLoad="1"/>' + xml[match.start():]
+
+
+def append_to_workbook(data, existing_excel_file, fileobj, nds_percent=2):
+    """
+    Пишет в fileobj книгу existing_excel_file с дописанными строками data (как generate_excel).
+    AppendNotSupported - книгу нужно дописать через openpyxl.
+    """
+    try:
+        zin = zipfile.ZipFile(existing_excel_file)
+    except (zipfile.BadZipFile, OSError) as e:
+        raise AppendNotSupported(f"не XLSX: {e}")
+
+    with zin:
+        try:
+            sheet_path, shared_path, styles_path, date1904 = _workbook_parts(zin)
+            scan = _scan_sheet(zin, sheet_path)
+            styles = StyleAppender(zin.read(styles_path).decode("utf-8"))
+        except (KeyError, ValueError, ElementTree.ParseError) as e:
+            raise AppendNotSupported(f"не удалось разобрать книгу: {e}")
+
+        wanted = set(scan.shared_numbers)
+        if scan.header and scan.header[0] == 's':
+            wanted.add(scan.header[1])
+        strings = _shared_strings(zin, shared_path, wanted)
+
+        has_numbering = False
+        next_number = 1
+        header = None
+        if scan.header:
+            header = strings.get(scan.header[1]) if scan.header[0] == 's' else scan.header[1]
+        if header:
+            if "дата" not in str(header).lower():
+                has_numbering = True
+                print(f"[append_to_workbook] Detected numbering column. First header: '{header}'")
+                numbers = [_parse_number(strings.get(idx, "")) or 0 for idx in scan.shared_numbers]
+                next_number = max([scan.max_number] + numbers) + 1
+                print(f"[append_to_workbook] Will continue numbering from {next_number}")
+            else:
+                print(f"[append_to_workbook] First column contains 'дата', no numbering column detected")
+
+        first_row = scan.last_row + 1
+        last_row = scan.last_row + len(data)
+        last_col = get_column_letter(len(FIELD_ORDER) + (1 if has_numbering else 0))
+        new_rows = _new_rows_xml(data, first_row, next_number, has_numbering, styles, date1904, nds_percent)
+
+        with zipfile.ZipFile(fileobj, "w", zipfile.ZIP_DEFLATED) as zout:
+            for info in zin.infolist():
+                out_info = zipfile.ZipInfo(info.filename, date_time=info.date_time)
+                out_info.compress_type = zipfile.ZIP_DEFLATED
+                out_info.external_attr = info.external_attr
+                if info.filename == sheet_path:
+                    with zin.open(info) as src, zout.open(out_info, "w", force_zip64=True) as dst:
+                        _copy_sheet(src, dst, new_rows, max(last_row, 1), last_col)
+                elif info.filename == styles_path:
+                    # Стили нужных ячеек добавляются при генерации строк, поэтому styles.xml пишется последним
+                    continue
+                elif info.filename == "xl/workbook.xml":
+                    zout.writestr(out_info, _full_calc_on_load(zin.read(info)))
+                else:
+                    with zin.open(info) as src, zout.open(out_info, "w", force_zip64=True) as dst:
+                        shutil.copyfileobj(src, dst, CHUNK_SIZE)
+            styles_info = zin.getinfo(styles_path)
+            out_info = zipfile.ZipInfo(styles_path, date_time=styles_info.date_time)
+            out_info.compress_type = zipfile.ZIP_DEFLATED
+            zout.writestr(out_info, styles.xml.encode("utf-8"))
+    print(f"[append_to_workbook] Appended {len(data)} row(s) after row {scan.last_row}")
+
+
+def excel_response(data, existing_excel_file=None, nds_percent=2, filename="ocr_results.xlsx"):
+    """FileResponse с XLSX из временного файла (удаляется при закрытии ответа)."""
+    tmp = tempfile.TemporaryFile(suffix=".xlsx")
+    try:
+        if existing_excel_file:
+            try:
+                append_to_workbook(data, existing_excel_file, tmp, nds_percent=nds_percent)
+            except AppendNotSupported as e:
+                print(f"[excel_response] Streaming append not possible ({e}), using openpyxl")
+                from .services import generate_excel
+                tmp.seek(0)
+                tmp.truncate()
+                generate_excel(data, existing_excel_file, nds_percent=nds_percent).save(tmp)
+        else:
+            write_new_workbook(data, tmp, nds_percent=nds_percent)
+        tmp.seek(0)
+    except Exception:
+        tmp.close()
+        raise
+    return FileResponse(tmp, as_attachment=True, filename=filename, content_type=XLSX_CONTENT_TYPE)
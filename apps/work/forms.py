@@ -67,10 +67,12 @@ class PreviewEditForm(forms.Form):
     """Динамическая форма для редактирования данных предпросмотра"""
     
     def __init__(self, *args, **kwargs):
+        # Список строк или {номер строки: строка}, если в форме только часть строк (страница, измененные строки)
         objects_data = kwargs.pop('objects_data', [])
         super().__init__(*args, **kwargs)
         
-        for idx, obj_data in enumerate(objects_data):
+        rows = objects_data.items() if isinstance(objects_data, dict) else enumerate(objects_data)
+        for idx, obj_data in rows:
             prefix = f'obj_{idx}'
 
             date_initial = obj_data.get(1, '')
@@ -0,0 +1,72 @@
+"""
+Фоновая запись PNG (превью полей и отладочные кропы).
+
+OCR получает кропы в памяти, а сохранение на диск уходит в отдельный поток,
+чтобы кодирование PNG не задерживало распознавание. Перед тем как читать
+каталог с картинками (копирование в превью, раскладка по полям), нужно
+вызвать flush(каталог).
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import numpy as np
+from PIL import Image
+
+
+class ImageWriter:
+    def __init__(self, max_workers=1):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="png-writer")
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def _write(self, image, path):
+        try:
+            if isinstance(image, np.ndarray):
+                image = Image.fromarray(image)
+            image.save(path)
+        except Exception as e:
+            print(f"[ImageWriter] Error saving {path}: {e}")
+
+    def submit(self, image, path):
+        """Ставит изображение (PIL или numpy-массив) в очередь на запись. Изображение после этого не должно меняться."""
+        directory = os.path.dirname(os.path.abspath(path))
+        future = self._executor.submit(self._write, image, path)
+        with self._lock:
+            self._pending.setdefault(directory, []).append(future)
+        # Вне блокировки: для уже завершенной записи колбэк вызывается сразу в этом потоке
+        future.add_done_callback(lambda f, d=directory: self._discard(d, f))
+        return future
+
+    def _discard(self, directory, future):
+        with self._lock:
+            futures = self._pending.get(directory)
+            if futures is None:
+                return
+            if future in futures:
+                futures.remove(future)
+            if not futures:
+                del self._pending[directory]
+
+    def flush(self, directory=None):
+        """Дожидается записи всех файлов каталога directory (или всех, если каталог не указан)."""
+        with self._lock:
+            if directory is None:
+                futures = [f for fs in self._pending.values() for f in fs]
+            else:
+                futures = list(self._pending.get(os.path.abspath(directory), []))
+        if futures:
+            wait(futures)
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_image_writer():
+    """Писатель текущего процесса (в каждом процессе пула OCR - свой)."""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = ImageWriter()
+        return _writer
@@ -0,0 +1,128 @@
+"""
+Прием ZIP-архива с документами.
+
+Архив читается прямо из переданного файла (загрузка Django или сохраненный source.zip):
+по центральному каталогу ZIP каждый элемент классифицируется по имени шаблонами
+documents.DOCUMENT_TEMPLATES, и на диск распаковываются только документы Type 1/2/3.
+Остальное (служебные каталоги, картинки, прочий мусор) не читается вовсе.
+
+Защита от zip-бомб проверяется во время распаковки по фактически прочитанным байтам,
+а не по размерам из заголовков: число элементов (OCR_ZIP_MAX_MEMBERS), размер одного
+файла (OCR_ZIP_MAX_MEMBER_MB), суммарный размер (OCR_ZIP_MAX_TOTAL_MB) и степень
+сжатия (OCR_ZIP_MAX_RATIO).
+"""
+import os
+import zipfile
+
+from django.conf import settings
+
+from .documents import classify_file
+from .metrics import incr_metric, metric_timer
+
+CHUNK_SIZE = 1024 * 1024
+# Файлы меньше этого размера не проверяются на степень сжатия (пустые страницы сжимаются очень сильно)
+RATIO_CHECK_MIN_BYTES = 1024 * 1024
+UTF8_FLAG = 0x800
+
+
+class ArchiveError(Exception):
+    """Архив нельзя обработать; текст исключения показывается пользователю."""
+
+
+def member_name(info):
+    """Имя элемента архива. Без флага UTF-8 имена из Windows записаны в OEM-кодировке (cp866), а zipfile читает их как cp437."""
+    name = info.filename
+    if not info.flag_bits & UTF8_FLAG:
+        try:
+            name = name.encode("cp437").decode("cp866")
+        except (UnicodeEncodeError, UnicodeDecodeError):
+            pass
+    return name
+
+
+def safe_relpath(name):
+    """Относительный путь внутри каталога распаковки или None для путей, выходящих за его пределы."""
+    parts = []
+    for part in name.replace("\\", "/").split("/"):
+        if part in ("", "."):
+            continue
+        if part == ".." or ":" in part:
+            return None
+        parts.append(part)
+    return os.path.join(*parts) if parts else None
+
+
+class ZipIngestor:
+    def __init__(self, max_members=None, max_member_bytes=None, max_total_bytes=None, max_ratio=None):
+        self.max_members = max_members or getattr(settings, 'OCR_ZIP_MAX_MEMBERS', 5000)
+        self.max_member_bytes = max_member_bytes or getattr(settings, 'OCR_ZIP_MAX_MEMBER_MB', 100) * 1024 * 1024
+        self.max_total_bytes = max_total_bytes or getattr(settings, 'OCR_ZIP_MAX_TOTAL_MB', 2048) * 1024 * 1024
+        self.max_ratio = max_ratio or getattr(settings, 'OCR_ZIP_MAX_RATIO', 200)
+        self.total_bytes = 0
+
+    def _extract(self, zf, info, name, target):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        written = 0
+        try:
+            with zf.open(info) as src, open(target, 'wb') as dst:
+                for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                    written += len(chunk)
+                    self.total_bytes += len(chunk)
+                    if written > self.max_member_bytes:
+                        raise ArchiveError(f"Файл '{name}' в архиве слишком большой (больше {self.max_member_bytes // (1024 * 1024)} МБ)")
+                    if self.total_bytes > self.max_total_bytes:
+                        raise ArchiveError(f"Архив после распаковки больше {self.max_total_bytes // (1024 * 1024)} МБ")
+                    if written > RATIO_CHECK_MIN_BYTES and written > self.max_ratio * max(info.compress_size, 1):
+                        raise ArchiveError(f"Файл '{name}' в архиве сжат подозрительно сильно (возможна zip-бомба)")
+                    dst.write(chunk)
+        except Exception:
+            if os.path.exists(target):
+                os.remove(target)
+            raise
+        return written
+
+    def ingest(self, zip_file, extract_dir, metrics=None):
+        """
+        Распаковывает документы архива zip_file (путь или файловый объект с seek) в extract_dir.
+        Возвращает {ключ шаблона: [пути файлов]} в порядке архива.
+        """
+        fileobj = getattr(zip_file, 'file', zip_file)
+        if hasattr(fileobj, 'seek'):
+            fileobj.seek(0)
+        try:
+            zf = zipfile.ZipFile(fileobj)
+        except zipfile.BadZipFile as e:
+            raise ArchiveError(f"Файл не является ZIP-архивом или поврежден: {e}")
+
+        files_by_template = {}
+        with zf, metric_timer(metrics, 'zip_ingest'):
+            infos = zf.infolist()
+            if len(infos) > self.max_members:
+                raise ArchiveError(f"В архиве слишком много файлов ({len(infos)}, допустимо {self.max_members})")
+
+            for info in infos:
+                if info.is_dir():
+                    continue
+                name = member_name(info)
+                relpath = safe_relpath(name)
+                template = classify_file(os.path.basename(relpath)) if relpath else None
+                if template is None:
+                    incr_metric(metrics, 'zip_members_skipped')
+                    continue
+                if info.flag_bits & 0x1:
+                    raise ArchiveError(f"Файл '{name}' в архиве защищен паролем")
+
+                target = os.path.join(extract_dir, relpath)
+                written = self._extract(zf, info, name, target)
+                incr_metric(metrics, 'zip_members_extracted')
+                incr_metric(metrics, 'zip_bytes_extracted', written)
+                paths = files_by_template.setdefault(template.key, [])
+                # Повторяющееся имя в архиве перезаписывает файл, как extractall
+                if target not in paths:
+                    paths.append(target)
+                print(f" [SCAN] Found {template.title}: {os.path.basename(relpath)}")
+        return files_by_template
+
+
+def ingest_zip(zip_file, extract_dir, metrics=None):
+    return ZipIngestor().ingest(zip_file, extract_dir, metrics=metrics)
@@ -0,0 +1,329 @@
+"""
+Фоновая обработка архивов.
+
+Загрузка только сохраняет архив и создает ProcessingJob, а сам конвейер
+process_zip_file выполняется в локальном пуле потоков. Состояние задач хранится
+в БД, поэтому после перезапуска воркера незавершенные задачи ставятся в очередь
+заново. Внешний брокер (Redis и т.п.) не нужен; при OCR_JOBS_EAGER=True задачи
+выполняются синхронно в вызывающем потоке (удобно для тестов).
+
+Взятая задача помечается процессом-владельцем (ProcessingJob.worker), который раз в
+OCR_JOB_HEARTBEAT_SECONDS обновляет heartbeat_at своих задач и проверяет чужие: задача
+возвращается в очередь, только если ее владелец завершился - процесса с таким pid на
+этом хосте нет или пульса нет дольше OCR_JOB_STALE_SECONDS. Медленная задача живого
+воркера (в том числе другого воркера gunicorn) повторно не запускается.
+"""
+import os
+import socket
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.files import File
+from django.db import close_old_connections, connections
+from django.db.models import F
+from django.utils import timezone
+
+from .manifest import write_manifest
+from .metrics import PipelineMetrics
+from .models import ProcessingJob
+from .results import serialize_row
+from .services import process_zip_file
+from .workspace import JobWorkspace, maybe_cleanup_stale_workspaces
+
+
+def serialize_results(rows):
+    """Приводит строки результата к JSON-совместимому виду (ключи-строки, Decimal -> str)."""
+    return [serialize_row(row) for row in rows]
+
+
+def get_job_workspace(job_id):
+    return JobWorkspace(job_id)
+
+
+_worker_id = None
+_worker_pid = None
+
+
+def current_worker():
+    """Метка процесса "хост:pid:случайная метка"; после fork у воркера своя метка."""
+    global _worker_id, _worker_pid
+    if _worker_pid != os.getpid():
+        _worker_pid = os.getpid()
+        _worker_id = f"{socket.gethostname()}:{_worker_pid}:{uuid.uuid4().hex[:8]}"
+    return _worker_id
+
+
+def _pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def worker_is_dead(worker, heartbeat_at, stale_before):
+    """Владелец задачи завершился: давно нет пульса или его процесса нет на этом хосте."""
+    if heartbeat_at is None or heartbeat_at < stale_before:
+        return True
+    host, _, rest = worker.partition(':')
+    pid = rest.partition(':')[0]
+    # На Windows os.kill(pid, 0) завершает процесс, там остается только пульс
+    if os.name == 'nt' or host != socket.gethostname() or not pid.isdigit():
+        return False
+    # pid мог достаться новому процессу - тогда владельца выдаст только отсутствие пульса
+    return not _pid_exists(int(pid))
+
+
+def _update_progress(job_id, current, total, message=""):
+    ProcessingJob.objects.filter(pk=job_id).update(
+        progress_current=current,
+        progress_total=total,
+        progress_message=message[:255],
+        updated_at=timezone.now(),
+    )
+
+
+def run_job(job_id):
+    """Выполняет одну задачу. Повторный вызов для уже взятой задачи ничего не делает."""
+    claimed = ProcessingJob.objects.filter(pk=job_id, status=ProcessingJob.STATUS_PENDING).update(
+        status=ProcessingJob.STATUS_RUNNING,
+        worker=current_worker(),
+        heartbeat_at=timezone.now(),
+        started_at=timezone.now(),
+        updated_at=timezone.now(),
+        attempts=F('attempts') + 1,
+    )
+    if not claimed:
+        print(f"[run_job] Job {job_id} is not pending anymore, skipping")
+        return
+
+    job = ProcessingJob.objects.get(pk=job_id)
+    params = job.params
+    print(f"[run_job] Started job {job_id} ({job.zip_filename}), attempt {job.attempts}")
+
+    def progress_callback(current, total, message=""):
+        _update_progress(job_id, current, total, message)
+
+    metrics = PipelineMetrics()
+    try:
+        selected_date = None
+        if params.get('date'):
+            from datetime import date as date_cls
+            selected_date = date_cls.fromisoformat(params['date'])
+
+        with open(job.zip_path, 'rb') as fh:
+            results = process_zip_file(
+                File(fh, name=job.zip_filename),
+                dollar_rate=Decimal(params.get('dollar_rate', '0')),
+                selected_date=selected_date,
+                tn_ved_code=params.get('tn_ved_code', ''),
+                bnd_code=params.get('bnd_code', ''),
+                nds_percent=Decimal(params.get('nds_percent', '0')),
+                save_photos=params.get('save_photos', False),
+                progress_callback=progress_callback,
+                workspace=get_job_workspace(job_id),
+                metrics=metrics,
+            )
+
+        # Картинки предпросмотра проверяются на диске один раз, здесь; предпросмотр доверяет манифесту
+        try:
+            write_manifest(get_job_workspace(job_id), results)
+        except Exception as e:
+            print(f"[run_job] Job {job_id}: cannot write image manifest: {e}")
+
+        ProcessingJob.objects.filter(pk=job_id).update(
+            status=ProcessingJob.STATUS_DONE,
+            result=serialize_results(results),
+            stats=metrics.as_dict(),
+            progress_current=len(results),
+            progress_total=len(results),
+            progress_message="Готово",
+            finished_at=timezone.now(),
+            updated_at=timezone.now(),
+        )
+        counters = metrics.counters
+        print(f"[run_job] Job {job_id} finished, {len(results)} result(s), "
+              f"OCR cache hits={counters.get('ocr_cache_hits', 0)} misses={counters.get('ocr_cache_misses', 0)}")
+    except Exception as e:
+        print(f"[run_job] Job {job_id} failed: {e}")
+        ProcessingJob.objects.filter(pk=job_id).update(
+            status=ProcessingJob.STATUS_FAILED,
+            error=str(e),
+            stats=metrics.as_dict(),
+            finished_at=timezone.now(),
+            updated_at=timezone.now(),
+        )
+
+
+class JobQueue:
+    """Локальная очередь задач поверх ThreadPoolExecutor."""
+
+    def __init__(self, max_workers=None, eager=None):
+        self.max_workers = max_workers or getattr(settings, 'OCR_JOB_WORKERS', 2)
+        self.eager = getattr(settings, 'OCR_JOBS_EAGER', False) if eager is None else eager
+        self._executor = None
+        self._lock = threading.Lock()
+        self._submitted = set()
+        self._heartbeat_thread = None
+        self._stop = threading.Event()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="ocr-job")
+            return self._executor
+
+    def _run_in_thread(self, job_id):
+        close_old_connections()
+        try:
+            run_job(job_id)
+        finally:
+            with self._lock:
+                self._submitted.discard(job_id)
+            connections.close_all()
+
+    def submit(self, job_id):
+        """Ставит задачу в очередь процесса; False, если она уже в ней."""
+        if self.eager:
+            run_job(job_id)
+            return True
+        with self._lock:
+            if job_id in self._submitted:
+                return False
+            self._submitted.add(job_id)
+        self._get_executor().submit(self._run_in_thread, job_id)
+        return True
+
+    def start(self):
+        """Запускает поток пульса; он же подхватывает задачи завершившихся воркеров."""
+        with self._lock:
+            if self.eager or self._heartbeat_thread is not None:
+                return
+            self._heartbeat_thread = threading.Thread(target=self._heartbeat_loop, name="ocr-job-heartbeat", daemon=True)
+            self._heartbeat_thread.start()
+
+    def _heartbeat_loop(self):
+        interval = getattr(settings, 'OCR_JOB_HEARTBEAT_SECONDS', 30)
+        while not self._stop.is_set():
+            try:
+                self.heartbeat()
+                self.recover()
+            except Exception as e:
+                print(f"[JobQueue] Heartbeat error: {e}")
+            finally:
+                connections.close_all()
+            self._stop.wait(interval)
+
+    def heartbeat(self):
+        """Отмечает, что задачи этого процесса еще выполняются."""
+        return ProcessingJob.objects.filter(
+            status=ProcessingJob.STATUS_RUNNING, worker=current_worker(),
+        ).update(heartbeat_at=timezone.now())
+
+    def recover(self):
+        """
+        Возвращает в очередь задачи, оставшиеся без исполнителя: все ожидающие и выполняющиеся,
+        владелец которых завершился (worker_is_dead). Задачи, исчерпавшие OCR_JOB_MAX_ATTEMPTS, помечаются ошибкой.
+        """
+        now = timezone.now()
+        stale_before = now - timedelta(seconds=getattr(settings, 'OCR_JOB_STALE_SECONDS', 120))
+        max_attempts = getattr(settings, 'OCR_JOB_MAX_ATTEMPTS', 3)
+
+        running = (
+            ProcessingJob.objects.filter(status=ProcessingJob.STATUS_RUNNING)
+            .exclude(worker=current_worker())
+            .values_list('id', 'worker', 'heartbeat_at', 'attempts')
+        )
+        for job_id, worker, heartbeat_at, attempts in running:
+            if not worker_is_dead(worker, heartbeat_at, stale_before):
+                continue
+            # Задачу, которую уже вернул в очередь и взял другой воркер, условие на владельца и пульс не тронет
+            orphan = ProcessingJob.objects.filter(
+                pk=job_id, status=ProcessingJob.STATUS_RUNNING, worker=worker, heartbeat_at=heartbeat_at,
+            )
+            if attempts >= max_attempts:
+                if orphan.update(status=ProcessingJob.STATUS_FAILED, error="Обработка прервана: превышено число попыток.",
+                                 finished_at=now, updated_at=now):
+                    print(f"[JobQueue] Job {job_id} of dead worker {worker} failed: too many attempts")
+            elif orphan.update(status=ProcessingJob.STATUS_PENDING, updated_at=now):
+                print(f"[JobQueue] Job {job_id} of dead worker {worker} returned to the queue")
+
+        pending_ids = list(
+            ProcessingJob.objects.filter(status=ProcessingJob.STATUS_PENDING)
+            .order_by('created_at')
+            .values_list('id', flat=True)
+        )
+        requeued = 0
+        for job_id in pending_ids:
+            if self.submit(job_id):
+                print(f"[JobQueue] Requeue job {job_id}")
+                requeued += 1
+        return requeued
+
+    def shutdown(self, wait=True):
+        self._stop.set()
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+
+def get_job_queue():
+    """Очередь процесса; при первом обращении запускает пульс, который подхватывает незавершенные задачи из БД."""
+    global _job_queue
+    with _job_queue_lock:
+        if _job_queue is None:
+            _job_queue = JobQueue()
+        queue = _job_queue
+    queue.start()
+    return queue
+
+
+def start_job_queue():
+    """
+    Запуск очереди при старте воркера сервера (config/gunicorn.conf.py): незавершенные задачи
+    прошлого запуска возвращаются в очередь сразу, не дожидаясь первого запроса, которому нужна очередь.
+    """
+    queue = get_job_queue()
+    requeued = queue.recover()
+    print(f"[JobQueue] Started in worker {current_worker()}, requeued {requeued} job(s)")
+    return queue
+
+
+def enqueue_job(user, zip_file, params, existing_excel=None):
+    """Сохраняет архив (и Excel для дозаписи) в рабочий каталог задачи и ставит задачу в очередь."""
+    active_ids = ProcessingJob.objects.filter(
+        status__in=[ProcessingJob.STATUS_PENDING, ProcessingJob.STATUS_RUNNING]
+    ).values_list('id', flat=True)
+    maybe_cleanup_stale_workspaces(active_keys=active_ids)
+
+    job = ProcessingJob(user=user, zip_filename=zip_file.name, params=params)
+    workspace = get_job_workspace(job.id).create()
+
+    job.zip_path = workspace.path("upload", "source.zip")
+    with open(job.zip_path, 'wb+') as destination:
+        for chunk in zip_file.chunks():
+            destination.write(chunk)
+
+    if existing_excel:
+        os.makedirs(workspace.existing_excel_dir, exist_ok=True)
+        existing_excel_path = os.path.join(workspace.existing_excel_dir, os.path.basename(existing_excel.name))
+        with open(existing_excel_path, 'wb+') as destination:
+            for chunk in existing_excel.chunks():
+                destination.write(chunk)
+        job.params['existing_excel_path'] = existing_excel_path
+
+    job.save()
+    print(f"[enqueue_job] Created job {job.id} for {job.zip_filename}")
+    get_job_queue().submit(job.id)
+    return job
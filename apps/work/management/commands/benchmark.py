@@ -0,0 +1,305 @@
+import math
+import os
+import tempfile
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+
+def legacy_deskew_image(img_cv):
+    """
+    Прежнее выравнивание всей страницы 300 dpi (медиана углов почти вертикальных линий).
+    Возвращает (выровненная страница, угол) - эталон для --stage deskew.
+    """
+    import cv2
+
+    gray = cv2.cvtColor(img_cv, cv2.COLOR_BGR2GRAY)
+    edges = cv2.Canny(gray, 50, 150, apertureSize=3)
+    lines = cv2.HoughLinesP(edges, 1, np.pi / 180, threshold=100, minLineLength=100, maxLineGap=10)
+
+    angles = []
+    if lines is not None:
+        for x1, y1, x2, y2 in lines.reshape(-1, 4):
+            angle_deg = math.degrees(math.atan2(y2 - y1, x2 - x1))
+            if abs(angle_deg) > 45:
+                angles.append(angle_deg - 90 if angle_deg > 0 else angle_deg + 90)
+
+    if not angles:
+        return img_cv, 0.0
+    median_angle = float(np.median(angles))
+    if abs(median_angle) < 0.1:
+        return img_cv, median_angle
+
+    h, w = img_cv.shape[:2]
+    M = cv2.getRotationMatrix2D((w // 2, h // 2), median_angle, 1.0)
+    rotated = cv2.warpAffine(
+        img_cv, M, (w, h),
+        flags=cv2.INTER_CUBIC,
+        borderMode=cv2.BORDER_CONSTANT,
+        borderValue=(255, 255, 255)
+    )
+    return rotated, median_angle
+
+
+def collect_pdfs(paths):
+    pdfs = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                pdfs.extend(os.path.join(root, f) for f in sorted(files) if f.lower().endswith('.pdf'))
+        elif path.lower().endswith('.pdf'):
+            pdfs.append(path)
+    return pdfs
+
+
+class Command(BaseCommand):
+    help = "Замеряет этапы обработки документов на наборе PDF и сверяет результат с исходной реализацией"
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', help="PDF-файлы или каталоги с PDF")
+        parser.add_argument('--stage', choices=['ocr', 'render', 'deskew', 'anchor'], default='ocr')
+        parser.add_argument('--map', dest='map_name', default='t1',
+                            help="Шаблон документа из documents.DOCUMENT_TEMPLATES (t1, t2, t3); поля первой страницы")
+        parser.add_argument('--repeat', type=int, default=1)
+
+    def handle(self, *args, **options):
+        pdfs = collect_pdfs(options['paths'])
+        if not pdfs:
+            raise CommandError("PDF-файлы не найдены")
+
+        handler = getattr(self, f"bench_{options['stage']}")
+        handler(pdfs, options)
+
+    def get_coords_map(self, options):
+        from apps.work.documents import get_template
+
+        try:
+            template = get_template(options['map_name'])
+        except KeyError:
+            raise CommandError(f"Неизвестный шаблон документа: {options['map_name']}")
+        return template.coords_map(0), template.apply_deskew
+
+    def bench_render(self, pdfs, options):
+        """Рендер полной страницы против рендера области полей (clip); пиксели на границе области могут отличаться - кропы сравниваются."""
+        from apps.work import services
+
+        coords_map, _ = self.get_coords_map(options)
+        region = services.coords_map_region(coords_map)
+        total_full = total_clip = 0.0
+        mismatches = 0
+        for pdf_path in pdfs:
+            t0 = time.perf_counter()
+            for _ in range(options['repeat']):
+                page_full = services.render_pdf_page(pdf_path, 0)
+            t1 = time.perf_counter()
+            for _ in range(options['repeat']):
+                page_clip = services.render_pdf_page(pdf_path, 0, region=region)
+            t2 = time.perf_counter()
+            if page_full is None:
+                continue
+
+            full_ms = (t1 - t0) * 1000 / options['repeat']
+            clip_ms = (t2 - t1) * 1000 / options['repeat']
+            total_full += full_ms
+            total_clip += clip_ms
+
+            crops_full = services.crop_fields(page_full, coords_map)
+            crops_clip = services.crop_fields(page_clip, coords_map)
+            for (field_name, crop_full), (_, crop_clip) in zip(crops_full, crops_clip):
+                if not np.array_equal(np.asarray(crop_full), np.asarray(crop_clip)):
+                    mismatches += 1
+                    self.stderr.write(f"  {os.path.basename(pdf_path)} / {field_name}: кропы различаются")
+
+            full_px = page_full.image.shape[0] * page_full.image.shape[1]
+            clip_px = page_clip.image.shape[0] * page_clip.image.shape[1]
+            self.stdout.write(
+                f"{os.path.basename(pdf_path)}: полная страница {full_ms:.0f} мс ({full_px / 1e6:.1f} Мпикс), "
+                f"область {clip_ms:.0f} мс ({clip_px / 1e6:.1f} Мпикс)"
+            )
+
+        self.stdout.write(
+            f"Итого {len(pdfs)} док.: полная страница {total_full:.0f} мс, область {total_clip:.0f} мс "
+            f"(x{total_full / total_clip if total_clip else 0:.2f})"
+        )
+        if mismatches:
+            self.stderr.write(self.style.ERROR(f"Расхождений: {mismatches}"))
+        else:
+            self.stdout.write(self.style.SUCCESS("Результаты совпадают"))
+
+    def legacy_render_deskewed(self, pdf_path):
+        """Прежний путь: полная страница 300 dpi, legacy_deskew_image по всей странице. Возвращает (страница, угол)."""
+        import cv2
+        import fitz
+        from apps.work import services
+
+        doc = fitz.open(pdf_path)
+        try:
+            pix = doc.load_page(0).get_pixmap(dpi=300)
+            img_np = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+            img_cv = cv2.cvtColor(img_np, cv2.COLOR_RGB2BGR if pix.n == 3 else cv2.COLOR_RGBA2BGR)
+        finally:
+            doc.close()
+        img_cv, angle = legacy_deskew_image(img_cv)
+        return services.RenderedPage(pdf_path, 0, cv2.cvtColor(img_cv, cv2.COLOR_BGR2RGB)), angle
+
+    def bench_deskew(self, pdfs, options):
+        """Прежнее выравнивание всей страницы против оценки угла по уменьшенной копии и поворота только полей."""
+        import fitz
+        from apps.work import services
+        from apps.work.documents import get_template
+
+        coords_map = get_template("t1").coords_map(0)
+        region = services.coords_map_region(coords_map)
+        total_old = total_new = 0.0
+        for pdf_path in pdfs:
+            t0 = time.perf_counter()
+            for _ in range(options['repeat']):
+                page_old, old_angle = self.legacy_render_deskewed(pdf_path)
+                crops_old = services.crop_fields(page_old, coords_map)
+            t1 = time.perf_counter()
+            for _ in range(options['repeat']):
+                page_new = services.render_pdf_page(pdf_path, 0, apply_deskew=True, region=region)
+                crops_new = services.crop_fields(page_new, coords_map)
+            t2 = time.perf_counter()
+
+            old_ms = (t1 - t0) * 1000 / options['repeat']
+            new_ms = (t2 - t1) * 1000 / options['repeat']
+            total_old += old_ms
+            total_new += new_ms
+
+            with fitz.open(pdf_path) as doc:
+                angle = services.estimate_page_skew(doc.load_page(0))
+            max_diff = 0
+            for (_, crop_old), (_, crop_new) in zip(crops_old, crops_new):
+                a, b = np.asarray(crop_old, dtype=np.int16), np.asarray(crop_new, dtype=np.int16)
+                if a.shape != b.shape:
+                    max_diff = 255
+                    break
+                if a.size:
+                    max_diff = max(max_diff, int(np.abs(a - b).max()))
+
+            self.stdout.write(
+                f"{os.path.basename(pdf_path)}: угол прежний {old_angle:.2f}°, новый {angle:.2f}°, прежнее {old_ms:.0f} мс, "
+                f"новое {new_ms:.0f} мс, макс. разница пикселей в полях {max_diff}"
+            )
+
+        self.stdout.write(
+            f"Итого {len(pdfs)} док.: прежнее {total_old:.0f} мс, новое {total_new:.0f} мс "
+            f"(x{total_old / total_new if total_new else 0:.2f})"
+        )
+
+    def bench_anchor(self, pdfs, options):
+        """OCR зоны якоря против поиска по образцу (образец создается по первому найденному OCR якорю)."""
+        from django.test.utils import override_settings
+        from apps.work import services
+        from apps.work.documents import get_template
+        from apps.work.metrics import PipelineMetrics
+        from apps.work.ocr import get_reader
+
+        reader = get_reader()
+        if reader is None:
+            raise CommandError("EasyOCR не загружен")
+
+        coords_map = get_template("t1").coords_map(0)
+        total_ocr = total_match = 0.0
+        hits = mismatches = 0
+        with tempfile.TemporaryDirectory(prefix="anchor_bench_") as tmp_dir:
+            for pdf_path in pdfs:
+                page = services.render_pdf_page(pdf_path, 0, apply_deskew=True)
+                if page is None:
+                    continue
+
+                t0 = time.perf_counter()
+                with override_settings(OCR_ANCHOR_MATCHING_ENABLED=False):
+                    for _ in range(options['repeat']):
+                        ocr_offset = services.find_anchor_offset(page, coords_map, pdf_path, tmp_dir, reader)[:2]
+                t1 = time.perf_counter()
+                metrics = PipelineMetrics()
+                for _ in range(options['repeat']):
+                    new_offset = services.find_anchor_offset(page, coords_map, pdf_path, tmp_dir, reader, metrics)[:2]
+                t2 = time.perf_counter()
+
+                ocr_ms = (t1 - t0) * 1000 / options['repeat']
+                new_ms = (t2 - t1) * 1000 / options['repeat']
+                total_ocr += ocr_ms
+                total_match += new_ms
+                hit = metrics.counters.get('anchor_template_hits', 0) > 0
+                hits += hit
+                if ocr_offset != new_offset:
+                    mismatches += 1
+                self.stdout.write(
+                    f"{os.path.basename(pdf_path)}: OCR {ocr_ms:.0f} мс {ocr_offset}, "
+                    f"{'образец' if hit else 'OCR (нет образца или слабое совпадение)'} {new_ms:.0f} мс {new_offset}"
+                )
+
+        self.stdout.write(
+            f"Итого {len(pdfs)} док.: OCR {total_ocr:.0f} мс, с образцом {total_match:.0f} мс "
+            f"(x{total_ocr / total_match if total_match else 0:.2f}), по образцу {hits}"
+        )
+        if mismatches:
+            self.stderr.write(self.style.WARNING(f"Смещения различаются: {mismatches}"))
+        else:
+            self.stdout.write(self.style.SUCCESS("Смещения совпадают"))
+
+    def bench_ocr(self, pdfs, options):
+        """Покадровый reader.readtext(png) по каждому полю против readtext_batched по странице."""
+        from PIL import Image
+        from apps.work import services
+        from apps.work.ocr import get_reader, readtext_batched
+
+        reader = get_reader()
+        if reader is None:
+            raise CommandError("EasyOCR не загружен")
+
+        coords_map, apply_deskew = self.get_coords_map(options)
+
+        total_single = total_batched = 0.0
+        mismatches = 0
+        with tempfile.TemporaryDirectory(prefix="ocr_bench_") as tmp_dir:
+            for pdf_path in pdfs:
+                img_full = services.render_pdf_page(pdf_path, 0, apply_deskew)
+                if img_full is None:
+                    continue
+                offset_x, offset_y, anchor_key = services.find_anchor_offset(img_full, coords_map, pdf_path, tmp_dir, reader)
+                crops = services.crop_fields(img_full, coords_map, offset_x, offset_y, anchor_key)
+
+                crop_paths = []
+                for field_name, crop_img in crops:
+                    crop_path = os.path.join(tmp_dir, services.get_safe_filename(pdf_path, field_name))
+                    Image.fromarray(crop_img).save(crop_path)
+                    crop_paths.append(crop_path)
+
+                t0 = time.perf_counter()
+                for _ in range(options['repeat']):
+                    single = [reader.readtext(p, detail=1) for p in crop_paths]
+                t1 = time.perf_counter()
+                for _ in range(options['repeat']):
+                    batched = readtext_batched([np.asarray(c) for _, c in crops], reader)
+                t2 = time.perf_counter()
+
+                single_ms = (t1 - t0) * 1000 / options['repeat']
+                batched_ms = (t2 - t1) * 1000 / options['repeat']
+                total_single += single_ms
+                total_batched += batched_ms
+
+                for (field_name, _), res_single, res_batched in zip(crops, single, batched):
+                    value_single = services.field_value_from_ocr(field_name, res_single)
+                    value_batched = services.field_value_from_ocr(field_name, res_batched)
+                    if value_single != value_batched:
+                        mismatches += 1
+                        self.stderr.write(f"  {os.path.basename(pdf_path)} / {field_name}: {value_single!r} != {value_batched!r}")
+
+                self.stdout.write(
+                    f"{os.path.basename(pdf_path)}: {len(crops)} полей, по полю {single_ms:.0f} мс, "
+                    f"пакетом {batched_ms:.0f} мс (x{single_ms / batched_ms if batched_ms else 0:.2f})"
+                )
+
+        self.stdout.write(
+            f"Итого {len(pdfs)} док.: по полю {total_single:.0f} мс, пакетом {total_batched:.0f} мс "
+            f"(x{total_single / total_batched if total_batched else 0:.2f})"
+        )
+        if mismatches:
+            self.stderr.write(self.style.ERROR(f"Расхождений: {mismatches}"))
+        else:
+            self.stdout.write(self.style.SUCCESS("Результаты совпадают"))
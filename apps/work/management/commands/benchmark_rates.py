@@ -0,0 +1,90 @@
+import os
+import time
+from decimal import Decimal, ROUND_DOWN
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Сохраненная страница курсов: вход по умолчанию и данные для тестов разбора (apps/work/tests.py)
+FIXTURE_PATH = settings.BASE_DIR / "tests" / "fixtures" / "nbkr_rates.html"
+
+
+def legacy_selected_usa_dollar(soup):
+    option = soup.find("option", value="15")
+    return '<option selected="" value="15">1 Доллар США' in str(option)
+
+
+def legacy_get_curs(soup, date):
+    # Исходный поиск курса: строка таблицы, в HTML которой есть дата
+    for tr in soup.find_all("tr"):
+        if f"{date}" in str(tr):
+            td = tr.find("td", class_="stat-right")
+            value = td.get_text()
+            rate_decimal = Decimal(value.replace(",", "."))
+            return (rate_decimal * Decimal("100")).quantize(Decimal("1"), rounding=ROUND_DOWN) / Decimal("100")
+
+
+class Command(BaseCommand):
+    help = "Замеряет разбор сохраненной страницы курсов НБКР и сверяет результат с разбором через BeautifulSoup"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'html_path', nargs='?', default=str(FIXTURE_PATH),
+            help=f"Сохраненная страница курсов НБКР (HTML), по умолчанию {FIXTURE_PATH}",
+        )
+        parser.add_argument('--save', action='store_true', help="Сначала скачать страницу НБКР в html_path (обновить образец)")
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        from bs4 import BeautifulSoup
+
+        from apps.work.rates import NBKRClient, parse_rate_rows
+
+        path = options['html_path']
+        if options['save']:
+            html = NBKRClient().fetch()
+            with open(path, 'w', encoding='utf-8') as fh:
+                fh.write(html)
+            self.stdout.write(f"Страница НБКР сохранена: {path} ({len(html)} символов)")
+        if not os.path.exists(path):
+            raise CommandError(f"Файл не найден: {path} (используйте --save, чтобы скачать страницу)")
+        with open(path, encoding='utf-8') as fh:
+            html = fh.read()
+
+        repeat = max(1, options['repeat'])
+        t0 = time.perf_counter()
+        for _ in range(repeat):
+            rows = parse_rate_rows(html)
+        new_ms = (time.perf_counter() - t0) * 1000 / repeat
+        if not rows:
+            raise CommandError("На странице не найдено ни одного курса")
+
+        # Старый путь: разбор страницы и поиск одной даты (так было на каждый запрос курса)
+        last_date = rows[-1].date.strftime("%d.%m.%Y")
+        t0 = time.perf_counter()
+        for _ in range(repeat):
+            soup = BeautifulSoup(html, "html.parser")
+            legacy_selected_usa_dollar(soup)
+            legacy_get_curs(soup, last_date)
+        legacy_ms = (time.perf_counter() - t0) * 1000 / repeat
+
+        soup = BeautifulSoup(html, "html.parser")
+        mismatches = 0
+        seen = set()
+        for row in rows:
+            if row.date in seen:
+                continue
+            seen.add(row.date)
+            date_str = row.date.strftime("%d.%m.%Y")
+            expected = legacy_get_curs(soup, date_str)
+            if expected != row.rate:
+                mismatches += 1
+                self.stderr.write(f"  {date_str}: {row.rate} != {expected}")
+
+        self.stdout.write(
+            f"{len(rows)} строк(и), {len(html) // 1024} КБ: regex {new_ms:.2f} мс на все даты, "
+            f"BeautifulSoup {legacy_ms:.2f} мс на одну дату (x{legacy_ms / new_ms if new_ms else 0:.1f})"
+        )
+        if mismatches:
+            raise CommandError(f"Курсы отличаются от разбора BeautifulSoup: {mismatches}")
+        self.stdout.write(self.style.SUCCESS("Курсы совпадают с разбором BeautifulSoup"))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from apps.work.models import ProcessingJob
+from apps.work.workspace import cleanup_stale_workspaces
+
+
+class Command(BaseCommand):
+    help = "Удаляет заброшенные рабочие каталоги задач (MEDIA_ROOT/temp_ocr/<job_id>) старше TTL"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--ttl",
+            type=int,
+            default=None,
+            help="Время жизни каталога в секундах (по умолчанию OCR_WORKSPACE_TTL_SECONDS)",
+        )
+
+    def handle(self, *args, **options):
+        active_ids = ProcessingJob.objects.filter(
+            status__in=[ProcessingJob.STATUS_PENDING, ProcessingJob.STATUS_RUNNING]
+        ).values_list("id", flat=True)
+        removed = cleanup_stale_workspaces(ttl_seconds=options["ttl"], active_keys=active_ids)
+        self.stdout.write(self.style.SUCCESS(f"Удалено рабочих каталогов: {len(removed)}"))
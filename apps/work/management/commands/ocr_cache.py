@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = "Статистика и обслуживание кэша результатов OCR"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--evict', action='store_true', help="Удалить просроченные и лишние записи")
+        parser.add_argument('--clear', action='store_true', help="Удалить все записи")
+
+    def handle(self, *args, **options):
+        from apps.work.ocr_cache import get_ocr_cache
+
+        cache = get_ocr_cache()
+        if cache is None:
+            raise CommandError("Кэш OCR выключен (OCR_CACHE_ENABLED=False)")
+
+        if options['clear']:
+            cache.clear()
+            self.stdout.write(self.style.SUCCESS("Кэш очищен"))
+        elif options['evict']:
+            removed = cache.evict()
+            self.stdout.write(self.style.SUCCESS(f"Удалено записей: {removed}"))
+
+        stats = cache.stats()
+        self.stdout.write(f"Файл: {stats['path']}")
+        self.stdout.write(f"Записей: {stats['entries']} из {stats['max_entries']}, TTL {stats['ttl_seconds']} с")
+        self.stdout.write(f"Версия модели: {stats['model_version']}")
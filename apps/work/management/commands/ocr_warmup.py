@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = "Загружает EasyOCR и выводит время импорта сервисов, загрузки модели и прогрева"
+
+    def handle(self, *args, **options):
+        t0 = time.perf_counter()
+        from apps.work import services  # noqa: F401 - импорт не должен загружать модель
+        import_seconds = time.perf_counter() - t0
+        self.stdout.write(f"Импорт apps.work.services: {import_seconds * 1000:.0f} мс")
+
+        from apps.work.ocr import reader_stats, warmup_reader
+
+        reader = warmup_reader()
+        stats = reader_stats()
+        if reader is None:
+            self.stderr.write(self.style.ERROR(f"EasyOCR не загружен: {stats['error']}"))
+            return
+
+        self.stdout.write(f"Импорт easyocr: {stats['import_seconds']:.2f} с")
+        self.stdout.write(f"Загрузка модели: {stats['load_seconds']:.2f} с")
+        self.stdout.write(f"Прогрев: {stats['warmup_seconds']:.2f} с")
+        self.stdout.write(self.style.SUCCESS("EasyOCR готов"))
@@ -0,0 +1,128 @@
+"""
+Манифест картинок предпросмотра задачи.
+
+Картинки строк (preview_images и field_images) проверяются на диске один раз - когда задача
+готова (run_job): в MANIFEST_NAME рабочего каталога записываются их пути (относительно
+MEDIA_ROOT), размеры и номера строк и полей. Пустые и отсутствующие файлы в манифест не попадают.
+Предпросмотр показывает только картинки из манифеста и к самим файлам не обращается; манифест
+читается один раз на процесс и перечитывается, только если изменился файл.
+Нет манифеста - нет и картинок: рабочий каталог удален после выгрузки Excel или уборкой по TTL.
+"""
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+MANIFEST_NAME = "crops.json"
+CACHE_MAX_MANIFESTS = 32
+
+
+class CropManifest:
+    def __init__(self, entries):
+        self.entries = entries  # путь -> {'size': байты, 'row': номер строки, 'field': номер поля или None}
+
+    def __contains__(self, path):
+        return path in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def filter(self, paths):
+        return [path for path in paths if path in self.entries]
+
+
+def _row_images(row):
+    """(путь, номер поля) всех картинок строки; превью страницы - с полем None."""
+    for path in row.get('preview_images') or []:
+        yield path, None
+    field_images = row.get('field_images')
+    if isinstance(field_images, dict):
+        for field_key, paths in field_images.items():
+            try:
+                field = int(field_key)
+            except (ValueError, TypeError):
+                field = None
+            for path in paths or []:
+                yield path, field
+
+
+def build_manifest(rows, media_root=None):
+    """Проверяет картинки строк на диске (один os.stat на файл) и возвращает CropManifest."""
+    media_root = str(media_root or settings.MEDIA_ROOT)
+    entries = {}
+    missing = 0
+    for idx, row in enumerate(rows):
+        for path, field in _row_images(row):
+            entry = entries.get(path)
+            if entry is not None:
+                if entry['field'] is None:
+                    entry['field'] = field
+                continue
+            try:
+                size = os.stat(os.path.join(media_root, path)).st_size
+            except OSError:
+                size = 0
+            if not size:
+                missing += 1
+                continue
+            entries[path] = {'size': size, 'row': idx, 'field': field}
+    if missing:
+        print(f"[manifest] {missing} image(s) are missing or empty and will not be shown")
+    return CropManifest(entries)
+
+
+def write_manifest(workspace, rows, media_root=None):
+    """Записывает манифест картинок строк в рабочий каталог задачи."""
+    manifest = build_manifest(rows, media_root)
+    path = workspace.path(MANIFEST_NAME)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as fh:
+        json.dump({'version': 1, 'images': manifest.entries}, fh, ensure_ascii=False)
+    os.replace(tmp_path, path)
+    print(f"[manifest] Wrote {len(manifest)} image(s) to {path}")
+    return manifest
+
+
+def ensure_manifest(workspace, rows, media_root=None):
+    """Манифест задачи; для задач, обработанных до появления манифеста, он строится один раз."""
+    manifest = load_manifest(workspace)
+    if manifest is None and workspace.exists():
+        manifest = write_manifest(workspace, rows, media_root)
+    return manifest
+
+
+_cache = OrderedDict()  # путь манифеста -> (mtime, CropManifest)
+_cache_lock = threading.Lock()
+
+
+def load_manifest(workspace):
+    """Манифест рабочего каталога (из кэша процесса, пока файл не изменился) или None, если его нет."""
+    path = workspace.path(MANIFEST_NAME)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        with _cache_lock:
+            _cache.pop(path, None)
+        return None
+
+    with _cache_lock:
+        cached = _cache.get(path)
+        if cached is not None and cached[0] == mtime:
+            _cache.move_to_end(path)
+            return cached[1]
+
+    try:
+        with open(path, encoding='utf-8') as fh:
+            manifest = CropManifest(json.load(fh).get('images', {}))
+    except (OSError, ValueError) as e:
+        print(f"[manifest] Cannot read {path}: {e}")
+        return None
+
+    with _cache_lock:
+        _cache[path] = (mtime, manifest)
+        _cache.move_to_end(path)
+        while len(_cache) > CACHE_MAX_MANIFESTS:
+            _cache.popitem(last=False)
+    return manifest
@@ -0,0 +1,130 @@
+"""
+Сопоставление ЭСФ/СНТ с водителями по фамилии в имени файла.
+
+SurnameMatcher строится один раз на архив для файлов одного типа: слова имен файлов
+индексируются по биграммам (с границами слова), поэтому difflib считается только для
+слов, имеющих с вариантом фамилии общую биграмму, а не для всех слов всех файлов.
+Правила совпадения прежние: вариант фамилии (normalize_surname) входит в имя файла
+целиком либо похож на слово имени с коэффициентом difflib выше FUZZY_THRESHOLD.
+
+assign() распределяет файлы между водителями сразу для всех: пары перебираются по
+убыванию качества совпадения, и каждый файл достается только одному водителю.
+"""
+import difflib
+import os
+import re
+from typing import NamedTuple
+
+FUZZY_THRESHOLD = 0.80
+
+# Качество совпадения: фамилия - отдельное слово имени файла, входит в имя как подстрока, похожа на слово
+RANK_WORD = 2
+RANK_SUBSTRING = 1
+RANK_FUZZY = 0
+
+
+class SurnameMatch(NamedTuple):
+    path: str
+    score: float  # 1.0 для точного совпадения, иначе коэффициент difflib
+    rank: int
+    alternatives: list  # [(path, score)] - не назначенные никому файлы с таким же качеством совпадения
+
+
+def _bigrams(text):
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+def _padded_bigrams(word):
+    # Границы слова дают общие биграммы и однобуквенным словам
+    return _bigrams(f"^{word}$")
+
+
+class SurnameMatcher:
+    def __init__(self, paths, variants=None):
+        if variants is None:
+            from .services import normalize_surname as variants
+        self.paths = list(paths)
+        self._variants = variants
+        self._names = [os.path.basename(p).lower() for p in self.paths]
+        self._name_words = [set(re.findall(r'\w+', name)) for name in self._names]
+        self._name_index = {}  # биграмма -> номера файлов, в имени которых она есть
+        self._word_index = {}  # биграмма слова -> {(номер файла, слово)}
+        for idx, name in enumerate(self._names):
+            for gram in _bigrams(name):
+                self._name_index.setdefault(gram, set()).add(idx)
+            for word in self._name_words[idx]:
+                for gram in _padded_bigrams(word):
+                    self._word_index.setdefault(gram, set()).add((idx, word))
+
+    def _substring_candidates(self, variant):
+        grams = _bigrams(variant)
+        if not grams:
+            return range(len(self._names))
+        postings = sorted((self._name_index.get(g, set()) for g in grams), key=len)
+        return set.intersection(*postings)
+
+    def candidates(self, surname):
+        """Подходящие фамилии файлы: [(номер файла, rank, score)] по убыванию качества, при равенстве - в порядке файлов."""
+        best = {}
+
+        def offer(idx, rank, score):
+            if (rank, score) > best.get(idx, (-1, 0.0)):
+                best[idx] = (rank, score)
+
+        for variant in self._variants(surname):
+            v_lower = variant.lower()
+            if not v_lower:
+                continue
+            # 1. Exact match
+            v_word = re.sub(r'\W+', '', v_lower)
+            for idx in self._substring_candidates(v_lower):
+                if v_lower in self._names[idx]:
+                    offer(idx, RANK_WORD if v_word in self._name_words[idx] else RANK_SUBSTRING, 1.0)
+
+            # 2. Fuzzy match (только для файлов без точного совпадения)
+            checked = set()
+            for gram in _padded_bigrams(v_lower):
+                for idx, word in self._word_index.get(gram, ()):
+                    if (idx, word) in checked or best.get(idx, (-1,))[0] > RANK_FUZZY:
+                        continue
+                    checked.add((idx, word))
+                    # Верхние оценки коэффициента отсекают большинство слов без полного расчета
+                    sm = difflib.SequenceMatcher(None, v_lower, word)
+                    if sm.real_quick_ratio() <= FUZZY_THRESHOLD or sm.quick_ratio() <= FUZZY_THRESHOLD:
+                        continue
+                    ratio = sm.ratio()
+                    if ratio > FUZZY_THRESHOLD:
+                        offer(idx, RANK_FUZZY, ratio)
+
+        return sorted(((idx, rank, score) for idx, (rank, score) in best.items()), key=lambda c: (-c[1], -c[2], c[0]))
+
+    def assign(self, surnames):
+        """
+        surnames - {ключ водителя: фамилия}. Возвращает {ключ: SurnameMatch} для водителей, получивших файл.
+        Пары (водитель, файл) выбираются по убыванию качества; при равенстве - в порядке водителей, затем файлов.
+        """
+        per_driver = {}
+        pairs = []
+        for order, (key, surname) in enumerate(surnames.items()):
+            found = self.candidates(surname)
+            per_driver[key] = found
+            pairs.extend((-rank, -score, order, idx, key) for idx, rank, score in found)
+        pairs.sort(key=lambda p: p[:4])
+
+        chosen = {}
+        used = set()
+        for neg_rank, neg_score, _, idx, key in pairs:
+            if key in chosen or idx in used:
+                continue
+            used.add(idx)
+            chosen[key] = (idx, -neg_rank, -neg_score)
+
+        # Альтернативы - только файлы, не доставшиеся никому: файл другого водителя неоднозначности не создает
+        result = {}
+        for key, (idx, best_rank, best_score) in chosen.items():
+            alternatives = [
+                (self.paths[other], score) for other, rank, score in per_driver[key]
+                if other not in used and (rank, score) == (best_rank, best_score)
+            ]
+            result[key] = SurnameMatch(self.paths[idx], best_score, best_rank, alternatives)
+        return result
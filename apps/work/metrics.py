@@ -0,0 +1,70 @@
+"""
+Счетчики и тайминги конвейера обработки.
+
+PipelineMetrics - простой picklable-объект: процессы пула OCR возвращают свои
+метрики вместе с результатом документа, а process_zip_file складывает их в
+метрики задачи (ProcessingJob.stats).
+"""
+import time
+from contextlib import contextmanager, nullcontext
+
+
+class PipelineMetrics:
+    def __init__(self):
+        self.counters = {}
+        self.timings = {}
+        self.gauges = {}  # максимальные наблюдавшиеся значения (например, глубина очереди конвейера)
+
+    def incr(self, key, n=1):
+        self.counters[key] = self.counters.get(key, 0) + n
+
+    def add_time(self, key, seconds):
+        total, count = self.timings.get(key, (0.0, 0))
+        self.timings[key] = (total + seconds, count + 1)
+
+    def gauge(self, key, value):
+        if value > self.gauges.get(key, value - 1):
+            self.gauges[key] = value
+
+    @contextmanager
+    def timer(self, key):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(key, time.perf_counter() - t0)
+
+    def merge(self, other):
+        if other is None:
+            return self
+        for key, n in other.counters.items():
+            self.incr(key, n)
+        for key, (total, count) in other.timings.items():
+            old_total, old_count = self.timings.get(key, (0.0, 0))
+            self.timings[key] = (old_total + total, old_count + count)
+        for key, value in getattr(other, 'gauges', {}).items():
+            self.gauge(key, value)
+        return self
+
+    def as_dict(self):
+        return {
+            'counters': dict(sorted(self.counters.items())),
+            'timings': {
+                key: {'seconds': round(total, 3), 'count': count}
+                for key, (total, count) in sorted(self.timings.items())
+            },
+            'gauges': dict(sorted(self.gauges.items())),
+        }
+
+
+def incr_metric(metrics, key, n=1):
+    """incr для необязательного объекта метрик (None - метрики не собираются)."""
+    if metrics is not None:
+        metrics.incr(key, n)
+
+
+def metric_timer(metrics, key):
+    """timer для необязательного объекта метрик."""
+    if metrics is None:
+        return nullcontext()
+    return metrics.timer(key)
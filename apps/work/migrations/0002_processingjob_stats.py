@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-17 06:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('work', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='processingjob',
+            name='stats',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
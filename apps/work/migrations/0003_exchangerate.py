@@ -0,0 +1,27 @@
+# Generated by Django 5.2.6 on 2026-10-17 06:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('work', '0002_processingjob_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExchangeRate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('currency', models.CharField(default='USD', max_length=3)),
+                ('date', models.DateField()),
+                ('rate', models.DecimalField(decimal_places=4, max_digits=12)),
+                ('fetched_at', models.DateTimeField()),
+            ],
+            options={
+                'ordering': ['-date'],
+                'constraints': [models.UniqueConstraint(fields=('currency', 'date'), name='work_exchangerate_currency_date')],
+            },
+        ),
+    ]
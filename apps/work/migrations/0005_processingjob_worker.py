@@ -0,0 +1,23 @@
+# Generated by Django 5.2.6 on 2026-10-17 07:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('work', '0004_previewrow'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='processingjob',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='processingjob',
+            name='worker',
+            field=models.CharField(blank=True, default='', max_length=128),
+        ),
+    ]
@@ -1,3 +1,104 @@
+import uuid
+
+from django.conf import settings
 from django.db import models
 
-# Create your models here.
+
+class ProcessingJob(models.Model):
+    """Фоновая обработка загруженного ZIP-архива (OCR + сопоставление документов)."""
+
+    STATUS_PENDING = "pending"
+    STATUS_RUNNING = "running"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+
+    STATUS_CHOICES = [
+        (STATUS_PENDING, "В очереди"),
+        (STATUS_RUNNING, "Обрабатывается"),
+        (STATUS_DONE, "Готово"),
+        (STATUS_FAILED, "Ошибка"),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name="processing_jobs",
+    )
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_PENDING, db_index=True)
+
+    zip_filename = models.CharField(max_length=255)
+    zip_path = models.CharField(max_length=500)
+    # Параметры формы загрузки: курс, дата, коды ТН ВЭД/БНД, НДС, save_photos, existing_excel_path
+    params = models.JSONField(default=dict)
+
+    progress_current = models.PositiveIntegerField(default=0)
+    progress_total = models.PositiveIntegerField(default=0)
+    progress_message = models.CharField(max_length=255, blank=True, default="")
+
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True, default="")
+    attempts = models.PositiveSmallIntegerField(default=0)
+    # Процесс, который выполняет задачу ("хост:pid:метка"), и его последний пульс (apps/work/jobs.py)
+    worker = models.CharField(max_length=128, blank=True, default="")
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    # Метрики обработки (PipelineMetrics.as_dict): попадания в кэш OCR, тайминги этапов
+    stats = models.JSONField(default=dict, blank=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["-created_at"]
+
+    def __str__(self):
+        return f"{self.zip_filename} ({self.get_status_display()})"
+
+    @property
+    def is_finished(self):
+        return self.status in (self.STATUS_DONE, self.STATUS_FAILED)
+
+    @property
+    def progress_percent(self):
+        if not self.progress_total:
+            return 0
+        return int(self.progress_current * 100 / self.progress_total)
+
+
+class ExchangeRate(models.Model):
+    """Курс валюты НБКР на дату (apps/work/rates.py)."""
+
+    currency = models.CharField(max_length=3, default="USD")
+    date = models.DateField()
+    rate = models.DecimalField(max_digits=12, decimal_places=4)
+    fetched_at = models.DateTimeField()
+
+    class Meta:
+        ordering = ["-date"]
+        constraints = [
+            models.UniqueConstraint(fields=["currency", "date"], name="work_exchangerate_currency_date"),
+        ]
+
+    def __str__(self):
+        return f"{self.currency} {self.date:%d.%m.%Y}: {self.rate}"
+
+
+class PreviewRow(models.Model):
+    """Строка предпросмотра задачи (apps/work/results.py): правки и перерасчет сохраняются построчно."""
+
+    job = models.ForeignKey(ProcessingJob, on_delete=models.CASCADE, related_name="preview_rows")
+    index = models.PositiveIntegerField()
+    # Строка в виде serialize_row: ключи-строки колонок, Decimal -> str, preview_images/field_images/sources/errors/warnings
+    data = models.JSONField(default=dict)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ["job", "index"]
+        constraints = [
+            models.UniqueConstraint(fields=["job", "index"], name="work_previewrow_job_index"),
+        ]
+
+    def __str__(self):
+        return f"{self.job_id} #{self.index}"
@@ -0,0 +1,192 @@
+"""
+Ленивая загрузка EasyOCR.
+
+Модель загружается при первом обращении к get_reader(), а не при импорте services.py,
+поэтому manage.py-команды, миграции и страницы без OCR не ждут загрузки весов.
+Каждый процесс (воркер gunicorn, процесс пула OCR) держит один экземпляр reader.
+"""
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+from django.conf import settings
+
+OCR_LANGUAGES = ["ru", "en"]
+
+_reader = None
+_reader_failed = False
+_reader_lock = threading.Lock()
+_reader_stats = {
+    'loaded': False,
+    'pid': None,
+    'import_seconds': None,
+    'load_seconds': None,
+    'warmup_seconds': None,
+    'error': None,
+}
+
+
+def get_reader():
+    """Возвращает EasyOCR reader текущего процесса, загружая его при первом вызове (None, если загрузка не удалась)."""
+    global _reader, _reader_failed
+    if _reader is not None or _reader_failed:
+        return _reader
+
+    with _reader_lock:
+        if _reader is not None or _reader_failed:
+            return _reader
+        try:
+            t0 = time.perf_counter()
+            import easyocr
+            t1 = time.perf_counter()
+            _reader = easyocr.Reader(OCR_LANGUAGES, gpu=False)
+            t2 = time.perf_counter()
+            _reader_stats.update({
+                'loaded': True,
+                'pid': os.getpid(),
+                'import_seconds': round(t1 - t0, 3),
+                'load_seconds': round(t2 - t1, 3),
+            })
+            print(f"[OCR] EasyOCR reader loaded in {t2 - t0:.2f}s (import {t1 - t0:.2f}s, model {t2 - t1:.2f}s), pid={os.getpid()}")
+        except Exception as e:
+            print(f"Error initializing EasyOCR: {e}")
+            _reader_failed = True
+            _reader_stats['error'] = str(e)
+    return _reader
+
+
+def warmup_reader():
+    """Загружает reader и прогоняет пустое изображение, чтобы первый реальный документ не платил за инициализацию."""
+    reader = get_reader()
+    if reader is None or _reader_stats['warmup_seconds'] is not None:
+        return reader
+    t0 = time.perf_counter()
+    try:
+        reader.readtext(np.full((32, 96, 3), 255, dtype=np.uint8), detail=1)
+    except Exception as e:
+        print(f"[OCR] Warmup error: {e}")
+    _reader_stats['warmup_seconds'] = round(time.perf_counter() - t0, 3)
+    print(f"[OCR] Warmup finished in {_reader_stats['warmup_seconds']:.2f}s, pid={os.getpid()}")
+    return reader
+
+
+def reader_stats():
+    return dict(_reader_stats)
+
+
+def _prepare_crop(image):
+    """
+    Готовит кроп так же, как easyocr.utils.reformat_input для PNG-файла:
+    RGB-изображение для детектора и оттенки серого для распознавателя.
+    """
+    image = np.ascontiguousarray(image)
+    if image.ndim == 2:
+        return cv2.cvtColor(image, cv2.COLOR_GRAY2RGB), image
+    if image.shape[2] == 4:
+        image = np.ascontiguousarray(image[:, :, :3])
+    return image, cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+
+
+def _clip_box(box, width, height):
+    """Горизонтальная рамка [x_min, x_max, y_min, y_max], обрезанная по кропу, как в easyocr.utils.get_image_list."""
+    x_min, x_max = max(0, int(box[0])), min(int(box[1]), width)
+    y_min, y_max = max(0, int(box[2])), min(int(box[3]), height)
+    if x_max <= x_min or y_max <= y_min:
+        return None
+    return [x_min, x_max, y_min, y_max]
+
+
+def _detect_chunk(reader, prepared, chunk):
+    """
+    Детекция (CRAFT) одним вызовом для кропов chunk: кропы кладутся в левый верхний угол
+    общего белого холста. При mag_ratio=1 масштаб не меняется, поэтому рамки остаются
+    в координатах кропа. Возвращает [(horizontal_list, free_list)] в порядке chunk.
+    """
+    height = max(prepared[i][0].shape[0] for i in chunk)
+    width = max(prepared[i][0].shape[1] for i in chunk)
+    batch = np.full((len(chunk), height, width, 3), 255, dtype=np.uint8)
+    for pos, i in enumerate(chunk):
+        img = prepared[i][0]
+        batch[pos, :img.shape[0], :img.shape[1]] = img
+    horizontal_agg, free_agg = reader.detect(batch, reformat=False)
+    return list(zip(horizontal_agg, free_agg))
+
+
+def _recognize_chunk(reader, prepared, chunk, detected, batch_size):
+    """
+    Распознавание строк всех кропов chunk одним вызовом reader.recognize: серые кропы
+    ставятся друг под другом, рамки обрезаются по своему кропу и сдвигаются на его место,
+    поэтому распознаватель видит те же фрагменты, что и при readtext по кропу.
+    Наклонные рамки (free_list) распознаются по своему кропу отдельно.
+    Возвращает {номер кропа: результаты в формате readtext(detail=1)}.
+    """
+    width = max(prepared[i][1].shape[1] for i in chunk)
+    offsets = []
+    y = 0
+    for i in chunk:
+        offsets.append(y)
+        y += prepared[i][1].shape[0]
+    mosaic = np.full((y, width), 255, dtype=np.uint8)
+
+    boxes = []
+    owners = {}  # (x_min, y_min, x_max, y_max) на мозаике -> [(номер кропа, порядок рамки)]
+    for i, offset, (horizontal_list, _) in zip(chunk, offsets, detected):
+        grey = prepared[i][1]
+        mosaic[offset:offset + grey.shape[0], :grey.shape[1]] = grey
+        for order, box in enumerate(horizontal_list):
+            box = _clip_box(box, grey.shape[1], grey.shape[0])
+            if box is None:
+                continue
+            x_min, x_max, y_min, y_max = box[0], box[1], box[2] + offset, box[3] + offset
+            boxes.append([x_min, x_max, y_min, y_max])
+            owners.setdefault((x_min, y_min, x_max, y_max), []).append((i, order, offset))
+
+    found = {i: [] for i in chunk}
+    if boxes:
+        for bbox, text, prob in reader.recognize(mosaic, boxes, [], detail=1, reformat=False, batch_size=batch_size):
+            (x_min, y_min), (x_max, y_max) = bbox[0], bbox[2]
+            i, order, offset = owners[(int(x_min), int(y_min), int(x_max), int(y_max))].pop(0)
+            local = [[int(px), int(py) - offset] for px, py in bbox]
+            found[i].append((order, (local, text, prob)))
+
+    results = {}
+    for i, (_, free_list) in zip(chunk, detected):
+        # Порядок как у readtext: горизонтальные рамки в порядке детектора, затем наклонные
+        results[i] = [item for _, item in sorted(found[i], key=lambda f: f[0])]
+        if len(free_list):
+            results[i] += reader.recognize(prepared[i][1], [], free_list, detail=1, reformat=False)
+    return results
+
+
+def readtext_batched(images, reader=None, batch_size=None):
+    """
+    Распознает список кропов (numpy RGB или оттенки серого) и возвращает список результатов
+    в формате reader.readtext(..., detail=1) для каждого кропа в исходном порядке.
+
+    Кропы идут пакетами по batch_size (близкие по размеру вместе, чтобы холст детектора был
+    меньше): на пакет один вызов детектора по кропам на общем белом холсте и один вызов
+    распознавателя по всем найденным строкам (см. _detect_chunk и _recognize_chunk).
+    Рамки и высоты в raw_items остаются в координатах своего кропа. Распознаватель
+    дополняет строки пакета до общей ширины, как readtext(batch_size=N); при
+    OCR_RECOGNIZE_BATCH_SIZE=1 каждая строка распознается отдельно, как в readtext по умолчанию.
+    """
+    results = [[] for _ in images]
+    reader = reader or get_reader()
+    if reader is None or not images:
+        return results
+
+    batch_size = batch_size or getattr(settings, 'OCR_DETECT_BATCH_SIZE', 16)
+    recognize_batch_size = getattr(settings, 'OCR_RECOGNIZE_BATCH_SIZE', 16)
+    prepared = [_prepare_crop(img) for img in images]
+
+    indices = [idx for idx, (img, _) in enumerate(prepared) if img.shape[0] and img.shape[1]]
+    indices.sort(key=lambda idx: prepared[idx][0].shape[:2], reverse=True)
+
+    for start in range(0, len(indices), batch_size):
+        chunk = indices[start:start + batch_size]
+        detected = _detect_chunk(reader, prepared, chunk)
+        for i, found in _recognize_chunk(reader, prepared, chunk, detected, recognize_batch_size).items():
+            results[i] = found
+    return results
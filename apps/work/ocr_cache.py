@@ -0,0 +1,197 @@
+"""
+Постоянный кэш результатов OCR.
+
+Ключ - sha256 содержимого PDF, номер страницы, карта координат с параметрами полей
+(FieldSpec: предобработка, min_height, raw, текст якоря), флаг выравнивания и версия
+модели/конвейера, поэтому повторная загрузка того же архива не запускает OCR заново,
+а любое изменение файла, карты или описания поля дает новый ключ. Хранится в отдельном
+SQLite-файле (settings.OCR_CACHE_PATH), доступном из процессов пула OCR без Django ORM.
+Размер ограничен OCR_CACHE_MAX_ENTRIES (вытесняются давно не использованные записи),
+записи старше OCR_CACHE_TTL_SECONDS не используются и удаляются.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from importlib import metadata
+
+from django.conf import settings
+
+from .documents import field_spec
+from .ocr import OCR_LANGUAGES
+
+# Увеличивать при любом изменении рендеринга, кропов или предобработки полей,
+# чтобы старые записи перестали совпадать по ключу.
+OCR_PIPELINE_VERSION = 4
+
+EVICT_EVERY_N_WRITES = 100
+
+_hash_cache = {}
+_hash_cache_lock = threading.Lock()
+
+
+def file_sha256(path):
+    """sha256 файла; повторные вызовы для неизмененного файла (та же mtime и размер) не читают его заново."""
+    st = os.stat(path)
+    stamp = (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+    with _hash_cache_lock:
+        cached = _hash_cache.get(stamp)
+    if cached:
+        return cached
+
+    h = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b''):
+            h.update(chunk)
+    digest = h.hexdigest()
+    with _hash_cache_lock:
+        if len(_hash_cache) > 1024:
+            _hash_cache.clear()
+        _hash_cache[stamp] = digest
+    return digest
+
+
+def ocr_model_version():
+    try:
+        easyocr_version = metadata.version("easyocr")
+    except metadata.PackageNotFoundError:
+        easyocr_version = "unknown"
+    return f"easyocr-{easyocr_version}:{'+'.join(OCR_LANGUAGES)}:pipeline-{OCR_PIPELINE_VERSION}"
+
+
+def field_key(name, rect):
+    """Часть ключа для поля: прямоугольник и параметры FieldSpec, от которых зависит сохраненное значение."""
+    spec = field_spec(name)
+    if spec is None:
+        return {'rect': list(rect)}
+    return {
+        'rect': list(rect),
+        'preprocessing': spec.preprocessing,
+        'min_height': spec.min_height,
+        'raw': spec.raw,
+        'anchor_text': spec.anchor_text,
+    }
+
+
+class OCRResultCache:
+    def __init__(self, path=None, max_entries=None, ttl_seconds=None):
+        self.path = str(path or settings.OCR_CACHE_PATH)
+        self.max_entries = max_entries if max_entries is not None else getattr(settings, 'OCR_CACHE_MAX_ENTRIES', 20000)
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else getattr(settings, 'OCR_CACHE_TTL_SECONDS', 30 * 24 * 60 * 60)
+        self.model_version = ocr_model_version()
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS ocr_results ("
+                " key TEXT PRIMARY KEY,"
+                " value TEXT NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " last_used REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS ocr_results_last_used ON ocr_results (last_used)")
+            self._local.conn = conn
+        return conn
+
+    def make_key(self, pdf_path, page_num, coords_map, apply_deskew, digest=None):
+        coords = json.dumps({k: field_key(k, v) for k, v in coords_map.items()}, sort_keys=True, ensure_ascii=False)
+        raw = "|".join([
+            digest or file_sha256(pdf_path),
+            str(page_num),
+            coords,
+            "deskew" if apply_deskew else "raw",
+            self.model_version,
+        ])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT value FROM ocr_results WHERE key = ? AND created_at >= ?",
+            (key, now - self.ttl_seconds),
+        ).fetchone()
+        if row is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        conn.execute("UPDATE ocr_results SET last_used = ? WHERE key = ?", (now, key))
+        conn.commit()
+        with self._lock:
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        now = time.time()
+        conn = self._connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO ocr_results (key, value, created_at, last_used) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(value, ensure_ascii=False), now, now),
+        )
+        conn.commit()
+        with self._lock:
+            self._writes += 1
+            evict = self._writes % EVICT_EVERY_N_WRITES == 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """Удаляет просроченные записи и самые давно использованные сверх max_entries. Возвращает число удаленных."""
+        conn = self._connect()
+        removed = conn.execute(
+            "DELETE FROM ocr_results WHERE created_at < ?", (time.time() - self.ttl_seconds,)
+        ).rowcount
+        removed += conn.execute(
+            "DELETE FROM ocr_results WHERE key IN ("
+            " SELECT key FROM ocr_results ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        ).rowcount
+        conn.commit()
+        if removed:
+            print(f"[OCRResultCache] Evicted {removed} entr(y/ies)")
+        return removed
+
+    def clear(self):
+        conn = self._connect()
+        conn.execute("DELETE FROM ocr_results")
+        conn.commit()
+
+    def stats(self):
+        conn = self._connect()
+        entries = conn.execute("SELECT COUNT(*) FROM ocr_results").fetchone()[0]
+        return {
+            'path': self.path,
+            'entries': entries,
+            'max_entries': self.max_entries,
+            'ttl_seconds': self.ttl_seconds,
+            'model_version': self.model_version,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_ocr_cache():
+    """Кэш текущего процесса или None, если он выключен (OCR_CACHE_ENABLED=False)."""
+    global _cache
+    if not getattr(settings, 'OCR_CACHE_ENABLED', True):
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = OCRResultCache()
+        return _cache
@@ -0,0 +1,106 @@
+"""
+Кэш открытых PDF и отрендеренных страниц в пределах одной задачи.
+
+Один и тот же файл читается несколько раз: текстовый слой, страница 1 и 2 ЭСФ,
+повторная обработка при принудительном сопоставлении. DocumentCache открывает
+каждый PDF один раз (из байтов, попутно считая sha256 для кэша OCR) и хранит
+отрендеренные страницы, так что любые карты полей применяются к странице за
+один рендер. Память ограничена OCR_PAGE_CACHE_MAX_MB (вытесняются давно не
+использованные страницы) и OCR_DOC_CACHE_MAX_DOCUMENTS открытыми документами.
+
+PyMuPDF не потокобезопасен: все обращения к fitz (открытие, рендер, текстовый слой,
+закрытие) выполняются под FITZ_LOCK, так как страницы рендерятся и в потоках
+конвейера (apps/work/pipeline.py).
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+import fitz
+from django.conf import settings
+
+FITZ_LOCK = threading.RLock()
+
+
+class DocumentCache:
+    def __init__(self, max_documents=None, max_bytes=None):
+        self.max_documents = max_documents or getattr(settings, 'OCR_DOC_CACHE_MAX_DOCUMENTS', 16)
+        self.max_bytes = max_bytes or getattr(settings, 'OCR_PAGE_CACHE_MAX_MB', 256) * 1024 * 1024
+        self._docs = OrderedDict()  # pdf_path -> (fitz.Document, sha256)
+        self._pages = OrderedDict()  # (pdf_path, page_num, apply_deskew) -> (RenderedPage, nbytes)
+        self._pages_bytes = 0
+        self._lock = threading.RLock()
+        self.stats = {'doc_opens': 0, 'doc_hits': 0, 'page_renders': 0, 'page_hits': 0, 'page_evictions': 0}
+
+    def _open(self, pdf_path):
+        entry = self._docs.get(pdf_path)
+        if entry is not None and not entry[0].is_closed:
+            self._docs.move_to_end(pdf_path)
+            self.stats['doc_hits'] += 1
+            return entry
+
+        with open(pdf_path, 'rb') as fh:
+            data = fh.read()
+        with FITZ_LOCK:
+            document = fitz.open(stream=data, filetype="pdf")
+        entry = (document, hashlib.sha256(data).hexdigest())
+        self._docs[pdf_path] = entry
+        self.stats['doc_opens'] += 1
+        while len(self._docs) > self.max_documents:
+            old_path, (old_doc, _) = self._docs.popitem(last=False)
+            self._drop_pages(old_path)
+            with FITZ_LOCK:
+                old_doc.close()
+        return entry
+
+    def document(self, pdf_path):
+        with self._lock:
+            return self._open(pdf_path)[0]
+
+    def sha256(self, pdf_path):
+        with self._lock:
+            return self._open(pdf_path)[1]
+
+    def get_page(self, pdf_path, page_num, apply_deskew, region=None):
+        """Отрендеренная страница, покрывающая region (None - вся страница)."""
+        key = (pdf_path, page_num, apply_deskew)
+        with self._lock:
+            entry = self._pages.get(key)
+            page = entry[0] if entry is not None else None
+            if page is not None and (page.is_full or (region is not None and page.covers_region(region))):
+                self._pages.move_to_end(key)
+                self.stats['page_hits'] += 1
+                return page
+
+        # Для уже рендеренной страницы с другой областью рендерим страницу целиком: к ней применяют несколько карт
+        render_region = region if page is None else None
+        from .services import render_pdf_page
+        page = render_pdf_page(pdf_path, page_num, apply_deskew, region=render_region, doc=self.document(pdf_path))
+        if page is None:
+            return None
+        page.cache = self
+
+        with self._lock:
+            self.stats['page_renders'] += 1
+            old = self._pages.pop(key, None)
+            if old is not None:
+                self._pages_bytes -= old[1]
+            self._pages[key] = (page, page.nbytes)
+            self._pages_bytes += page.nbytes
+            while self._pages_bytes > self.max_bytes and len(self._pages) > 1:
+                _, (_, evicted_bytes) = self._pages.popitem(last=False)
+                self._pages_bytes -= evicted_bytes
+                self.stats['page_evictions'] += 1
+        return page
+
+    def _drop_pages(self, pdf_path):
+        for key in [k for k in self._pages if k[0] == pdf_path]:
+            self._pages_bytes -= self._pages.pop(key)[1]
+
+    def close(self):
+        with self._lock, FITZ_LOCK:
+            for doc, _ in self._docs.values():
+                doc.close()
+            self._docs.clear()
+            self._pages.clear()
+            self._pages_bytes = 0
@@ -0,0 +1,126 @@
+"""
+Конвейер последовательного режима: рендер страниц заранее, пока идет OCR текущего документа.
+
+Без пула процессов документы обрабатываются по очереди, и OCR простаивает, пока PyMuPDF
+рендерит страницу, а рендер - пока идет OCR. PagePrefetcher рендерит в пуле потоков
+(OCR_PIPELINE_RENDER_THREADS) страницы следующих документов в DocumentCache задачи:
+очередь ограничена OCR_PIPELINE_QUEUE_SIZE документами впереди текущего, поэтому память
+под страницы не растет с размером архива. Обработка документа (OCR, очистка полей)
+начинается после take(), который дожидается рендера его страниц; сопоставление и расчет
+сумм идут после этапа, как раньше.
+
+Сам PyMuPDF не потокобезопасен, поэтому все вызовы fitz идут под pdf_cache.FITZ_LOCK;
+параллельно выполняются рендер и OCR (easyocr отпускает GIL на вычислениях torch).
+В пуле процессов (OCR_PARALLEL_WORKERS > 1) документы и так обрабатываются одновременно,
+и конвейер не используется.
+
+Метрики: pipeline_render (время рендера в потоках), pipeline_wait (ожидание в take()),
+pipeline_waits / pipeline_ready (документ пришлось ждать / был готов), глубина очереди
+при take() - pipeline_queue_depth (максимум) и pipeline_queue_depth_sum / pipeline_takes (среднее).
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from .documents import get_template
+from .metrics import incr_metric
+
+
+def prefetch_enabled():
+    """Страницы рендерятся заранее, только если рендер точно понадобится (превью или OCR без кэша)."""
+    if getattr(settings, 'OCR_PIPELINE_QUEUE_SIZE', 2) <= 0:
+        return False
+    return getattr(settings, 'OCR_SAVE_PREVIEW_IMAGES', True) or not getattr(settings, 'OCR_CACHE_ENABLED', True)
+
+
+def document_pages(pdf_path, template):
+    """Страницы плана шаблона: [(page_num, apply_deskew, region)]; запасные страницы не рендерятся заранее."""
+    from .services import coords_map_region
+
+    pages = []
+    for step in template.plan.steps:
+        if step.use_text_layer and getattr(settings, 'OCR_TEXT_LAYER_ENABLED', True) \
+                and not step.apply_deskew and not getattr(settings, 'OCR_SAVE_PREVIEW_IMAGES', True):
+            # Поля, скорее всего, прочитаются из текстового слоя, и страница не понадобится
+            continue
+        pages.append((step.page_num, step.apply_deskew, coords_map_region(step.coords_map)))
+    return pages
+
+
+class PagePrefetcher:
+    """
+    documents - список задач этапа, для каждой [(pdf_path, ключ шаблона)] (None и .xlsx пропускаются).
+    Использование: with PagePrefetcher(doc_cache, documents, metrics) as prefetcher: prefetcher.take(i) перед задачей i.
+    """
+
+    def __init__(self, doc_cache, documents, metrics=None, threads=None, depth=None):
+        self.doc_cache = doc_cache
+        self.metrics = metrics
+        self.threads = threads or getattr(settings, 'OCR_PIPELINE_RENDER_THREADS', 2)
+        depth = depth if depth is not None else getattr(settings, 'OCR_PIPELINE_QUEUE_SIZE', 2)
+        # Документы очереди и текущий должны помещаться в кэш открытых PDF, иначе они вытеснят друг друга
+        per_task = max((len(docs) for docs in documents), default=1) or 1
+        self.depth = max(0, min(depth, doc_cache.max_documents // per_task - 1))
+        self.documents = [
+            [(path, get_template(key)) for path, key in docs if path and path.lower().endswith('.pdf')]
+            for docs in documents
+        ]
+        self._executor = None
+        self._futures = {}
+        self._next = 0
+
+    def __enter__(self):
+        if self.depth:
+            self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="render")
+            self._fill(0)
+        return self
+
+    def __exit__(self, *exc):
+        if self._executor is not None:
+            for future in self._futures.values():
+                future.cancel()
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        return False
+
+    def _render(self, idx):
+        t0 = time.perf_counter()
+        for pdf_path, template in self.documents[idx]:
+            for page_num, apply_deskew, region in document_pages(pdf_path, template):
+                try:
+                    self.doc_cache.get_page(pdf_path, page_num, apply_deskew, region)
+                except Exception as e:
+                    # Ошибка повторится при обработке документа и будет обработана там
+                    print(f"[PagePrefetcher] Render error for {pdf_path}, page {page_num + 1}: {e}")
+        return time.perf_counter() - t0
+
+    def _fill(self, current):
+        # В очереди не больше depth документов впереди текущего
+        while self._next < len(self.documents) and self._next <= current + self.depth:
+            if self.documents[self._next]:
+                self._futures[self._next] = self._executor.submit(self._render, self._next)
+            self._next += 1
+
+    def take(self, idx):
+        """Дожидается рендера страниц задачи idx и ставит в очередь следующие документы."""
+        if self._executor is None:
+            return
+        self._fill(idx)
+        future = self._futures.pop(idx, None)
+        queued = sum(1 for i, f in self._futures.items() if i > idx and f.done())
+        incr_metric(self.metrics, 'pipeline_takes')
+        incr_metric(self.metrics, 'pipeline_queue_depth_sum', queued)
+        if self.metrics is not None:
+            self.metrics.gauge('pipeline_queue_depth', queued)
+        if future is None:
+            return
+        if future.done():
+            incr_metric(self.metrics, 'pipeline_ready')
+        else:
+            incr_metric(self.metrics, 'pipeline_waits')
+        t0 = time.perf_counter()
+        render_seconds = future.result()
+        if self.metrics is not None:
+            self.metrics.add_time('pipeline_wait', time.perf_counter() - t0)
+            self.metrics.add_time('pipeline_render', render_seconds)
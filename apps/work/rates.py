@@ -0,0 +1,360 @@
+"""
+Курс доллара США НБКР.
+
+Страница НБКР содержит таблицу курсов за несколько дат. RateService разбирает ее
+один раз в таблицу {дата: курс}, сохраняет все даты в ExchangeRate и дальше отвечает
+из памяти процесса или из БД, не обращаясь к сайту. Курс прошлых дат не меняется и
+хранится бессрочно; курс на сегодня (и отсутствие курса на дату) перепроверяется не
+чаще раза в NBKR_RATE_TODAY_TTL_SECONDS.
+
+Клиент сети подменяется настройкой NBKR_RATE_CLIENT (путь к классу с методом fetch(timeout),
+возвращающим HTML страницы) или аргументом RateService(client=...), например для
+запуска без интернета с локальной страницей. Стандартный NBKRClient ходит через общую
+для процесса requests.Session с пулом keep-alive соединений.
+
+Загрузки страницы не дублируются: пока одна идет, остальные потоки ждут ее результат.
+RateBudget ограничивает общее время обращений к НБКР в пределах одного запроса
+пользователя. Если сайт недоступен (ошибка сети, ответ не 200 или страница без курсов),
+lookup(..., allow_stale=True) возвращает последний известный курс с пометкой stale,
+чтобы вызывающий код показал это в ошибках строки.
+"""
+import html as html_lib
+import re
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from datetime import datetime
+from decimal import Decimal, ROUND_DOWN
+from typing import NamedTuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+NBKR_URL = "https://www.nbkr.kg/index1.jsp?item=1562&lang=RUS&valuta_id=15"
+USD = "USD"
+
+DATE_RE = re.compile(r'\b(\d{2}\.\d{2}\.\d{4})\b')
+# Страница разбирается регулярными выражениями за один проход, без построения дерева BeautifulSoup
+ROW_RE = re.compile(r'<tr\b[^>]*>(.*?)</tr\s*>', re.IGNORECASE | re.DOTALL)
+RATE_CELL_RE = re.compile(
+    r'<td\b[^>]*\bclass\s*=\s*["\']?[^"\'>]*\bstat-right\b[^>]*>(.*?)</td\s*>', re.IGNORECASE | re.DOTALL
+)
+USD_OPTION_RE = re.compile(r'<option\b(?=[^>]*\bvalue\s*=\s*["\']?15["\'\s>])([^>]*)>([^<]*)', re.IGNORECASE)
+TAG_RE = re.compile(r'<[^>]+>')
+
+
+class NetworkError(Exception):
+    def __init__(self, user_message, technical_details):
+        self.user_message = user_message
+        self.technical_details = technical_details
+        super().__init__(user_message)
+
+
+class RateBudget:
+    """Общий лимит времени (секунды) на обращения к НБКР в пределах одного запроса пользователя."""
+
+    def __init__(self, seconds=None):
+        self.seconds = seconds if seconds is not None else getattr(settings, 'NBKR_REQUEST_BUDGET_SECONDS', 15)
+        self._deadline = time.monotonic() + self.seconds
+
+    def remaining(self):
+        return max(0.0, self._deadline - time.monotonic())
+
+    @property
+    def exhausted(self):
+        return self.remaining() <= 0
+
+    def timeout_error(self):
+        return NetworkError(
+            "Сайт НБКР не ответил вовремя",
+            f"Исчерпан лимит времени на запросы к сайту НБКР ({self.seconds} с)",
+        )
+
+
+class RateLookup(NamedTuple):
+    rate: Decimal
+    stale: bool = False
+    source_date: object = None  # дата, на которую взят курс при stale
+    reason: str = ""  # почему использован последний известный курс
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_http_session():
+    """Общая для процесса сессия с пулом keep-alive соединений к НБКР."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            pool_size = getattr(settings, 'NBKR_HTTP_POOL_SIZE', 4)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+            _session = requests.Session()
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+
+class NBKRClient:
+    def __init__(self, url=NBKR_URL, connect_timeout=None, read_timeout=None, session=None):
+        self.url = url
+        self.connect_timeout = connect_timeout or getattr(settings, 'NBKR_CONNECT_TIMEOUT', 3)
+        self.read_timeout = read_timeout or getattr(settings, 'NBKR_READ_TIMEOUT', 10)
+        self.session = session
+
+    def fetch(self, timeout=None):
+        """HTML страницы курсов. timeout - сколько секунд осталось у вызывающего (None - без ограничения)."""
+        connect_timeout, read_timeout = self.connect_timeout, self.read_timeout
+        if timeout is not None:
+            connect_timeout, read_timeout = min(connect_timeout, timeout), min(read_timeout, timeout)
+        session = self.session or get_http_session()
+        try:
+            resp = session.get(self.url, timeout=(connect_timeout, read_timeout))
+            resp.raise_for_status()
+            return resp.text
+        except requests.HTTPError as e:
+            user_message = "Сайт НБКР временно недоступен"
+            technical_details = f"Сайт НБКР ответил с ошибкой {e.response.status_code}: {str(e)}"
+            raise NetworkError(user_message, technical_details)
+        except requests.RequestException as e:
+            user_message = "Проверьте подключение к интернету"
+            technical_details = f"Ошибка при подключении к сайту НБКР: {str(e)}"
+            raise NetworkError(user_message, technical_details)
+
+
+class RateRow(NamedTuple):
+    date: object  # datetime.date
+    rate: Decimal
+
+
+def _cell_text(fragment):
+    return html_lib.unescape(TAG_RE.sub(" ", fragment)).strip()
+
+
+def selected_usa_dollar(html):
+    match = USD_OPTION_RE.search(html)
+    if not match:
+        return False
+    attrs, text = match.groups()
+    return bool(re.search(r'\bselected\b', attrs, re.IGNORECASE)) and text.strip().startswith("1 Доллар США")
+
+
+def truncate_rate(value):
+    rate_decimal = Decimal(value.replace(",", "."))
+    return (rate_decimal * Decimal("100")).quantize(Decimal("1"), rounding=ROUND_DOWN) / Decimal("100")
+
+
+def parse_rate_rows(html):
+    """Все строки таблицы курсов за один проход: [RateRow] в порядке страницы."""
+    if not selected_usa_dollar(html):
+        raise Exception("На странице НБКР не выбран доллар США")
+
+    rows = []
+    for row_match in ROW_RE.finditer(html):
+        row = row_match.group(1)
+        cell = RATE_CELL_RE.search(row)
+        if cell is None:
+            continue
+        match = DATE_RE.search(_cell_text(row))
+        if not match:
+            continue
+        try:
+            day = datetime.strptime(match.group(1), "%d.%m.%Y").date()
+            rate = truncate_rate(_cell_text(cell.group(1)))
+        except (ValueError, ArithmeticError):
+            continue
+        rows.append(RateRow(day, rate))
+    return rows
+
+
+def parse_rates(html):
+    """{date: Decimal} по странице курсов; для повторяющейся даты берется первая строка."""
+    rates = {}
+    for row in parse_rate_rows(html):
+        rates.setdefault(row.date, row.rate)
+    return rates
+
+
+def parse_date(date_str):
+    match = DATE_RE.search(str(date_str or ""))
+    if not match:
+        return None
+    try:
+        return datetime.strptime(match.group(1), "%d.%m.%Y").date()
+    except ValueError:
+        return None
+
+
+class RateService:
+    def __init__(self, client=None, today_ttl=None):
+        if client is None:
+            client = import_string(getattr(settings, 'NBKR_RATE_CLIENT', 'apps.work.rates.NBKRClient'))()
+        self.client = client
+        self.today_ttl = today_ttl if today_ttl is not None else getattr(settings, 'NBKR_RATE_TODAY_TTL_SECONDS', 60 * 60)
+        self._rates = {}  # date -> (Decimal, fetched_at)
+        self._last_fetch = None  # time.time() последней загрузки страницы
+        self._inflight = None  # Future идущей загрузки страницы
+        self._lock = threading.Lock()
+        # lookup идет из нескольких потоков: счетчики меняются только под _lock
+        self.stats = {'memory_hits': 0, 'db_hits': 0, 'fetches': 0}
+
+    def _is_fresh(self, day, fetched_at):
+        if day < timezone.localdate():
+            return True
+        return time.time() - fetched_at < self.today_ttl
+
+    def _from_memory(self, day):
+        with self._lock:
+            entry = self._rates.get(day)
+            if entry is not None and self._is_fresh(day, entry[1]):
+                self.stats['memory_hits'] += 1
+                return entry[0]
+        return None
+
+    def _from_db(self, day):
+        from .models import ExchangeRate
+        row = ExchangeRate.objects.filter(currency=USD, date=day).first()
+        if row is None:
+            return None
+        fetched_at = row.fetched_at.timestamp()
+        if not self._is_fresh(day, fetched_at):
+            return None
+        # В БД 4 знака после запятой, курс уже усечен до 2
+        rate = row.rate.quantize(Decimal("0.01"))
+        with self._lock:
+            self._rates[day] = (rate, fetched_at)
+            self.stats['db_hits'] += 1
+        return rate
+
+    def refresh(self, budget=None):
+        """
+        Загружает страницу НБКР и сохраняет все ее курсы. Возвращает {date: Decimal}.
+        Если загрузка уже идет в другом потоке, ждет ее результат вместо повторного запроса.
+        """
+        with self._lock:
+            inflight = self._inflight
+            leader = inflight is None
+            if leader:
+                inflight = self._inflight = Future()
+
+        if not leader:
+            try:
+                return inflight.result(timeout=budget.remaining() if budget else None)
+            except FutureTimeout:
+                raise budget.timeout_error()
+
+        try:
+            rates = self._fetch(budget)
+            inflight.set_result(rates)
+            return rates
+        except BaseException as e:
+            inflight.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight = None
+
+    def _fetch(self, budget):
+        from .models import ExchangeRate
+        if budget is not None and budget.exhausted:
+            raise budget.timeout_error()
+        html = self.client.fetch(timeout=budget.remaining() if budget else None)
+        # Страница без курсов (заглушка, измененная верстка) - тоже недоступность НБКР,
+        # чтобы lookup(allow_stale=True) вернул последний известный курс
+        try:
+            rates = parse_rates(html)
+        except Exception as e:
+            raise NetworkError("Сайт НБКР вернул страницу без курсов", f"Не удалось разобрать страницу НБКР: {e}")
+        if not rates:
+            raise NetworkError("Сайт НБКР вернул страницу без курсов", "На странице НБКР не найдено ни одного курса")
+        now = time.time()
+        with self._lock:
+            self.stats['fetches'] += 1
+            self._last_fetch = now
+            for day, rate in rates.items():
+                self._rates[day] = (rate, now)
+        fetched_at = timezone.now()
+        ExchangeRate.objects.bulk_create(
+            [ExchangeRate(currency=USD, date=day, rate=rate, fetched_at=fetched_at) for day, rate in rates.items()],
+            update_conflicts=True,
+            unique_fields=["currency", "date"],
+            update_fields=["rate", "fetched_at"],
+        )
+        print(f"[RateService] Fetched {len(rates)} rate(s) from NBKR")
+        return rates
+
+    def _last_known(self, day):
+        """Последний известный курс на дату day или ближайшую предыдущую: (rate, date) или None."""
+        from .models import ExchangeRate
+        candidates = []
+        with self._lock:
+            known = [d for d in self._rates if d <= day]
+            if known:
+                source_date = max(known)
+                candidates.append((source_date, self._rates[source_date][0]))
+        row = ExchangeRate.objects.filter(currency=USD, date__lte=day).order_by("-date").first()
+        if row is not None:
+            candidates.append((row.date, row.rate.quantize(Decimal("0.01"))))
+        if not candidates:
+            return None
+        source_date, rate = max(candidates, key=lambda c: c[0])
+        return rate, source_date
+
+    def lookup(self, date_str, budget=None, allow_stale=False):
+        """
+        Курс на дату 'ДД.ММ.ГГГГ' (RateLookup). Страница НБКР загружается, только если курса нет в памяти и в БД.
+        allow_stale - при недоступности НБКР вернуть последний известный курс с stale=True вместо NetworkError.
+        """
+        if not date_str:
+            print("[RateService] date_str is empty or None")
+            raise Exception("Дата не указана")
+        day = parse_date(date_str)
+        if day is None:
+            raise Exception(f"Не удалось найти курс на дату {date_str}")
+
+        rate = self._from_memory(day)
+        if rate is None:
+            rate = self._from_db(day)
+        if rate is None:
+            with self._lock:
+                recently_fetched = self._last_fetch is not None and time.time() - self._last_fetch < self.today_ttl
+            # Даты нет на недавно загруженной странице - повторная загрузка ее не добавит
+            if not recently_fetched:
+                try:
+                    rate = self.refresh(budget).get(day)
+                except NetworkError as e:
+                    last_known = self._last_known(day) if allow_stale else None
+                    if last_known is None:
+                        raise
+                    print(f"[RateService] NBKR unavailable for {date_str}, using last known rate {last_known[0]} on {last_known[1]}: {e.technical_details}")
+                    return RateLookup(last_known[0], stale=True, source_date=last_known[1], reason=e.technical_details)
+
+        if rate is None:
+            print(f"[RateService] rate not found for date {date_str}")
+            raise Exception(f"Не удалось найти курс на дату {date_str}")
+        print(f"Получен курс доллара США на {date_str}: {rate}")
+        return RateLookup(rate)
+
+    def get_rate(self, date_str, budget=None):
+        return self.lookup(date_str, budget=budget).rate
+
+    def clear(self):
+        with self._lock:
+            self._rates.clear()
+            self._last_fetch = None
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_rate_service():
+    """Сервис курсов текущего процесса."""
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = RateService()
+        return _service
@@ -0,0 +1,108 @@
+"""
+Строки предпросмотра задачи на сервере.
+
+Раньше все строки (пути превью и картинок полей, источники, ошибки) лежали в
+request.session['preview_data'] и целиком перезаписывались при каждом перерасчете.
+Теперь в сессии только job_id, а строки хранятся в PreviewRow: по строке на запись,
+с номером строки в задаче. PreviewStore читает их порциями (CHUNK_SIZE строк за запрос)
+или страницами предпросмотра и сохраняет только изменившиеся строки.
+
+ProcessingJob.result остается исходным результатом обработки: при открытии результата
+задачи (job_result_view) строки предпросмотра заполняются из него заново, как раньше сессия.
+"""
+from decimal import Decimal
+
+from django.core.paginator import Paginator
+from django.db import transaction
+from django.utils import timezone
+
+from .models import PreviewRow
+
+CHUNK_SIZE = 200
+
+
+def serialize_row(row):
+    """Приводит строку результата к JSON-совместимому виду (ключи-строки, Decimal -> str)."""
+    row_ser = {}
+    for key, value in row.items():
+        key_str = str(key)
+        if key_str in ('field_images', 'sources') and isinstance(value, dict):
+            row_ser[key_str] = {str(k): v for k, v in value.items()}
+        elif key_str in ('preview_images', 'errors', 'warnings'):
+            row_ser[key_str] = value
+        elif isinstance(value, Decimal):
+            row_ser[key_str] = str(value)
+        else:
+            row_ser[key_str] = value
+    return row_ser
+
+
+class PreviewStore:
+    def __init__(self, job_id, chunk_size=None):
+        self.job_id = job_id
+        self.chunk_size = chunk_size or CHUNK_SIZE
+
+    def _queryset(self):
+        return PreviewRow.objects.filter(job_id=self.job_id)
+
+    def reset(self, rows):
+        """Заменяет строки задачи строками rows (уже сериализованными)."""
+        with transaction.atomic():
+            self._queryset().delete()
+            PreviewRow.objects.bulk_create(
+                (PreviewRow(job_id=self.job_id, index=idx, data=row) for idx, row in enumerate(rows)),
+                batch_size=self.chunk_size,
+            )
+
+    def exists(self):
+        return self._queryset().exists()
+
+    def count(self):
+        return self._queryset().count()
+
+    def rows(self, start=0, stop=None):
+        """[(номер строки, строка)] для номеров start <= номер < stop."""
+        qs = self._queryset().filter(index__gte=start)
+        if stop is not None:
+            qs = qs.filter(index__lt=stop)
+        return list(qs.order_by('index').values_list('index', 'data'))
+
+    def get(self, indexes):
+        """{номер строки: строка} для номеров indexes (несуществующие пропускаются)."""
+        if not indexes:
+            return {}
+        return dict(self._queryset().filter(index__in=list(indexes)).values_list('index', 'data'))
+
+    def page(self, number, per_page):
+        """Страница предпросмотра (django.core.paginator.Page) из пар (номер строки, строка); неверный номер - ближайшая страница."""
+        qs = self._queryset().order_by('index').values_list('index', 'data')
+        return Paginator(qs, per_page).get_page(number)
+
+    def iter_rows(self):
+        """Все строки задачи по порядку; из БД читается по chunk_size строк."""
+        start = 0
+        while True:
+            chunk = list(
+                self._queryset().filter(index__gte=start).order_by('index')
+                .values_list('index', 'data')[:self.chunk_size]
+            )
+            yield from chunk
+            if len(chunk) < self.chunk_size:
+                return
+            start = chunk[-1][0] + 1
+
+    def update(self, changed):
+        """changed - {номер строки: строка}; сохраняет только эти строки. Возвращает число обновленных."""
+        if not changed:
+            return 0
+        objs = list(self._queryset().filter(index__in=list(changed)).only('id', 'index'))
+        now = timezone.now()
+        for obj in objs:
+            obj.data = changed[obj.index]
+            obj.updated_at = now  # bulk_update не заполняет auto_now
+        with transaction.atomic():
+            PreviewRow.objects.bulk_update(objs, ['data', 'updated_at'], batch_size=self.chunk_size)
+        return len(objs)
+
+    def clear(self):
+        self._queryset().delete()
@@ -1,168 +1,105 @@
 import os
-import zipfile
 import shutil
 import re
-import math
 import hashlib
 import fitz # PyMuPDF
-import easyocr
 import cv2 # OpenCV для обработки изображений
 import numpy as np
 from PIL import Image
-from decimal import Decimal, ROUND_HALF_UP, ROUND_DOWN
+from decimal import Decimal, ROUND_HALF_UP
 from datetime import datetime
 import openpyxl
 import warnings
 warnings.filterwarnings("ignore", category=UserWarning) # Suppress torch/easyocr warnings
 from openpyxl.worksheet.table import Table, TableStyleInfo
 from openpyxl.styles import PatternFill, Font
-import requests 
-from bs4 import BeautifulSoup
 from django.conf import settings
-import difflib # For fuzzy matching
-
-class NetworkError(Exception):
-    def __init__(self, user_message, technical_details):
-        self.user_message = user_message
-        self.technical_details = technical_details
-        super().__init__(user_message)
-
-NBKR_URL = "https://www.nbkr.kg/index1.jsp?item=1562&lang=RUS&valuta_id=15"
-
-def selected_usa_dollar(soup):
-    option = soup.find("option", value="15")
-    # print(f"[get_current_dollar_rate.selected_usa_dollar] option found: {option}")
-    value_text = '<option selected="" value="15">1 Доллар США'
-    if value_text in str(option):
-        return True
-    else:
-        return False
-
-def get_curs(soup, date):
-    table = soup.find_all("tr")
-
-    for tr in table:
-        if f"{date}" in str(tr):
-            td = tr.find("td", class_="stat-right")
-            value = td.get_text()
-            rate_decimal = Decimal(value.replace(",", "."))
-            rate_truncated = (rate_decimal * Decimal("100")).quantize(Decimal("1"), rounding=ROUND_DOWN) / Decimal("100")
-            print("Курс:", rate_truncated)
-            return rate_truncated
+import multiprocessing
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from .anchors import get_anchor_locator
+from .documents import classify_file, field_spec, get_template, safe_decimal
+from .image_writer import get_image_writer
+from .ingest import ingest_zip
+from .matching import SurnameMatcher
+from .metrics import PipelineMetrics, incr_metric, metric_timer
+from .ocr import get_reader, readtext_batched, warmup_reader
+from .ocr_cache import get_ocr_cache
+from .pdf_cache import FITZ_LOCK, DocumentCache
+from .pipeline import PagePrefetcher, prefetch_enabled
+from .rates import NetworkError, get_rate_service
+from .workspace import JobWorkspace
 
 def get_current_dollar_rate(date_str=None):
-    try:
-        resp = requests.get(NBKR_URL, timeout=10)
-        html = resp.text
-        # print(f"[get_current_dollar_rate] Fetched NBKR_URL status={resp.status_code} length={len(html)} for date={date_str}")
-    except requests.RequestException as e:
-        # print(f"[get_current_dollar_rate] RequestException: {e} (url={NBKR_URL})")
-        user_message = "Проверьте подключение к интернету"
-        technical_details = f"Ошибка при подключении к сайту НБКР: {str(e)}"
-        raise NetworkError(user_message, technical_details)
-
-    soup = BeautifulSoup(html, "html.parser")
-    
-    if not selected_usa_dollar(soup):
-        raise Exception("На странице НБКР не выбран доллар США")
-    
-    if not date_str:
-        print("[get_current_dollar_rate] date_str is empty or None")
-        raise Exception("Дата не указана")
-    
-    rate = get_curs(soup, date_str)
-    
-    if rate:
-        print(f"Получен курс доллара США на {date_str}: {rate}")
-        return rate
-    else:
-        print(f"[get_current_dollar_rate] rate not found for date {date_str}")
-        raise Exception(f"Не удалось найти курс на дату {date_str}")
-
-FIELDS_MAP_TYPE_1 = {
-    "Дата (1)": (880, 2520, 390, 140),
-    "ФИО Водит. (4)": (850, 2450, 500, 150),
-    "Кол.тон (7)": (1500, 1390, 300, 80),
-    "Марка": (380, 2730, 350, 70),
-    "Гос_номер ()": (-80, 2730, 700, 170), 
-    "Якорь (1)": (0, 500, 500, 1000), # Anchor for alignment
-}
+    """Курс доллара НБКР на дату; страница НБКР разбирается один раз и кэшируется (apps/work/rates.py)."""
+    return get_rate_service().get_rate(date_str)
 
-FIELDS_MAP_TYPE_2 = {
-    "Цена (8)": (1450, 2150, 250, 160),
-    "№ счет факт (Инвойс) (16)": (500, 200, 500, 60),
-}
-
-FIELDS_MAP_TYPE_3 = {
-    "№ сопров.накл. KZ (15)": (360, 250, 330, 200),
-    "Дата сопр.накл (13)": (360, 250, 330, 200)
-}
-
-FIELDS_MAP_TYPE_2_PAGE_2 = {
-    "Цена (8) Alt": (1500, 100, 150, 120),
-}
-
-MIN_HEIGHT_CONFIG = {
-    "ФИО Водит. (4)": 20,
-    "Марка_Гос_номер ()": 38,
-}
-
-try:
-    reader = easyocr.Reader(["ru", "en"], gpu=False)
-except Exception as e:
-    print(f"Error initializing EasyOCR: {e}")
-    reader = None
-
-def deskew_image(img_cv):
+def get_parallel_workers():
+    """Число процессов для параллельного OCR (settings.OCR_PARALLEL_WORKERS); 0 или 1 - последовательный режим."""
     try:
-        gray = cv2.cvtColor(img_cv, cv2.COLOR_BGR2GRAY)
-
-        edges = cv2.Canny(gray, 50, 150, apertureSize=3)
+        return max(0, int(getattr(settings, 'OCR_PARALLEL_WORKERS', 0) or 0))
+    except (TypeError, ValueError):
+        return 0
 
-        lines = cv2.HoughLinesP(edges, 1, np.pi / 180, threshold=100, minLineLength=100, maxLineGap=10)
-
-        angles = []
-        if lines is not None:
-            for line in lines:
-                x1, y1, x2, y2 = line[0]
-
-                angle_rad = math.atan2(y2 - y1, x2 - x1)
-                angle_deg = math.degrees(angle_rad)
-
-                if abs(angle_deg) > 45:
-                    if angle_deg > 0:
-                        deviation = angle_deg - 90
-                    else:
-                        deviation = angle_deg + 90
-
-                    angles.append(deviation)
-
-        if not angles:
-            return img_cv
-
-        median_angle = np.median(angles)
-
-        if abs(median_angle) < 0.1:
-            return img_cv
-
-        print(f" [Deskew] Обнаружен перекос: {median_angle:.2f} градусов. Исправляем...")
-
-        (h, w) = img_cv.shape[:2]
-        center = (w // 2, h // 2)
-
-        M = cv2.getRotationMatrix2D(center, median_angle, 1.0)
-
-        rotated = cv2.warpAffine(
-            img_cv, M, (w, h),
-            flags=cv2.INTER_CUBIC,
-            borderMode=cv2.BORDER_CONSTANT,
-            borderValue=(255, 255, 255)
-        )
-
-        return rotated
+def _init_ocr_worker(torch_threads):
+    # Каждый процесс пула держит собственный EasyOCR reader, прогретый один раз при старте процесса.
+    # Ограничиваем потоки torch, чтобы N процессов не конкурировали за одни и те же ядра.
+    try:
+        import torch
+        torch.set_num_threads(torch_threads)
     except Exception as e:
-        print(f" [Deskew Error] Не удалось выровнять: {e}")
-        return img_cv
+        print(f"[OCR worker] Could not limit torch threads: {e}")
+    reader = warmup_reader()
+    print(f"[OCR worker] pid={os.getpid()} ready, reader={'ok' if reader is not None else 'None'}, torch_threads={torch_threads}")
+
+def create_ocr_process_pool(workers):
+    # spawn вместо fork: torch и OpenMP небезопасны после fork из многопоточного процесса
+    torch_threads = max(1, (os.cpu_count() or 1) // workers)
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_ocr_worker,
+        initargs=(torch_threads,),
+    )
+
+def estimate_skew_angle(gray, scale=1.0):
+    """
+    Угол перекоса страницы в градусах по почти вертикальным линиям.
+    gray - страница в оттенках серого в RENDER_DPI * scale. Прежняя оценка (медиана углов линий
+    от 100 px при 300 dpi) на копии в 150 dpi не видит перекос меньше ~1°: короткие штрихи букв
+    после уменьшения ложатся ровно в 90° и перевешивают линии рамки. Поэтому берутся линии
+    от 300 px исходного разрешения, шаг угла 0.5° и медиана, взвешенная по длине линий;
+    сравнение углов - manage.py benchmark --stage deskew.
+    """
+    edges = cv2.Canny(gray, 50, 150, apertureSize=3)
+    lines = cv2.HoughLinesP(
+        edges, 1, np.pi / 360,
+        threshold=max(10, int(100 * scale)),
+        minLineLength=max(10, int(300 * scale)),
+        maxLineGap=max(1, int(round(40 * scale))),
+    )
+    if lines is None:
+        return 0.0
+
+    x1, y1, x2, y2 = lines.reshape(-1, 4).astype(np.float64).T
+    dx, dy = x2 - x1, y2 - y1
+    angles = np.degrees(np.arctan2(dy, dx))
+    vertical = np.abs(angles) > 45
+    if not vertical.any():
+        return 0.0
+    deviations = np.where(angles[vertical] > 0, angles[vertical] - 90, angles[vertical] + 90)
+    lengths = np.hypot(dx, dy)[vertical]
+
+    order = np.argsort(deviations)
+    cum_lengths = np.cumsum(lengths[order])
+    return float(deviations[order][np.searchsorted(cum_lengths, cum_lengths[-1] / 2)])
+
+def estimate_page_skew(page):
+    """Оценивает перекос страницы PDF по уменьшенной копии (OCR_DESKEW_SCALE от 300 dpi)."""
+    scale = getattr(settings, 'OCR_DESKEW_SCALE', 0.5)
+    pix = page.get_pixmap(dpi=int(RENDER_DPI * scale), colorspace=fitz.csGRAY)
+    gray = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width)
+    return estimate_skew_angle(gray, pix.width / (page.rect.width * RENDER_SCALE))
 
 class DataCleaner:
     @staticmethod
@@ -236,6 +173,27 @@ class DataCleaner:
     @staticmethod
     def clean_3(data, context): return ""
     
+    @staticmethod
+    def clean_marka(data, context):
+        # Марка - весь текст рамки
+        if not isinstance(data, list):
+            return str(data).strip() if data else ""
+        return " ".join([t.strip() for t, h in data if t.strip()])
+
+    @staticmethod
+    def clean_gos_number(data, context):
+        # Обычно [номер, регион]: первая и последняя строки нужной высоты
+        cleaned_list = DataCleaner.get_cleaned_big_3_list(data)
+        if not cleaned_list:
+            return ""
+        if len(cleaned_list) >= 2:
+            return f"{DataCleaner.clean_plate_text(cleaned_list[0])} / {DataCleaner.clean_plate_text(cleaned_list[-1])}"
+        return DataCleaner.clean_plate_text(cleaned_list[0])
+
+    @staticmethod
+    def clean_fio(data, context):
+        return DataCleaner.clean_fio_raw(data if data is not None else [], context)[0]
+
     @staticmethod
     def clean_fio_raw(data, context):
         if not isinstance(data, list):
@@ -350,22 +308,6 @@ def normalize_surname(surname):
 
     return list(variants)
 
-def safe_decimal(value, field_name):
-    if not value:
-        return Decimal("0")
-    cleaned = ""
-    for ch in value:
-        if ch.isdigit() or ch in ".,":
-            cleaned += ch
-    cleaned = cleaned.replace(",", ".")
-    if cleaned == "":
-        return Decimal("0")
-    try:
-        return Decimal(cleaned)
-    except Exception as e:
-        print(f"Ошибка Decimal для '{field_name}': '{value}' в '{cleaned}': {e}")
-        return Decimal("0")
-
 CYRILLIC_TO_LATIN = {
     'А': 'A', 'Б': 'B', 'В': 'V', 'Г': 'G', 'Д': 'D', 'Е': 'E', 'Ё': 'E',
     'Ж': 'Zh', 'З': 'Z', 'И': 'I', 'Й': 'Y', 'К': 'K', 'Л': 'L', 'М': 'M',
@@ -413,201 +355,581 @@ def get_safe_filename(original_name, field_name):
     
     return f"{safe_base}_{hash_hex}_{safe_field}.png"
 
-def extract_text_from_pdf(pdf_path, coords_map, save_dir, apply_deskew=False, page_num=0):
-    extracted_data = {}
-    try:
-        # print(f"[extract_text_from_pdf] Processing {pdf_path} with coords_map keys: {list(coords_map.keys())}, apply_deskew={apply_deskew}")
-        doc = fitz.open(pdf_path)
-        if page_num >= len(doc):
-            print(f"[extract_text_from_pdf] Page {page_num} does not exist in {pdf_path}")
-            return {}
-        page = doc.load_page(page_num)
-        pix = page.get_pixmap(dpi=300)
-        
-        img_np = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
-        
-        if pix.n == 3:
-            img_cv = cv2.cvtColor(img_np, cv2.COLOR_RGB2BGR)
-        elif pix.n == 4:
-            img_cv = cv2.cvtColor(img_np, cv2.COLOR_RGBA2BGR)
-        else:
-            img_cv = cv2.cvtColor(img_np, cv2.COLOR_GRAY2BGR)
-
-        if apply_deskew:
-            img_cv = deskew_image(img_cv)
-
-        img_rgb = cv2.cvtColor(img_cv, cv2.COLOR_BGR2RGB)
-        img_full = Image.fromarray(img_rgb)
+RENDER_DPI = 300
+RENDER_SCALE = RENDER_DPI / 72  # пиксели 300 dpi на пункт PDF
 
-        os.makedirs(save_dir, exist_ok=True)
+class RenderedPage:
+    """
+    Страница PDF в 300 dpi (RGB numpy-массив): целиком или только нужная область (origin - ее левый верхний угол).
+    crop() и width/height работают в пикселях полной страницы, поэтому find_anchor_offset
+    и crop_fields не зависят от режима рендеринга.
+    Если запрошенный прямоугольник выходит за отрендеренную область, он вырезается из страницы,
+    отрендеренной целиком (full_page); сама RenderedPage не меняется - ее могут читать другие потоки.
+    rotation - матрица выравнивания (cv2.getRotationMatrix2D): поворачивается не вся страница,
+    а только вырезаемые прямоугольники.
+    cache - DocumentCache, из которого получена страница (его заполняет сам кэш).
+    """
 
-        os.makedirs(save_dir, exist_ok=True)
+    def __init__(self, pdf_path, page_num, image, origin=(0, 0), page_size=None, doc=None, rotation=None, apply_deskew=False):
+        self.pdf_path = pdf_path
+        self.page_num = page_num
+        self.image = image
+        self.origin = origin
+        self.width, self.height = page_size or (image.shape[1], image.shape[0])
+        self.doc = doc
+        self.rotation = rotation
+        self.apply_deskew = apply_deskew
+        self.cache = None
+
+    @property
+    def nbytes(self):
+        return self.image.nbytes
+
+    @property
+    def is_full(self):
+        return self.origin == (0, 0) and self.image.shape[:2] == (self.height, self.width)
+
+    def covers_region(self, box):
+        # Часть прямоугольника за пределами страницы заполняется черным - так же, как для полной страницы
+        x0, y0, x1, y1 = box
+        x0, y0 = max(x0, 0), max(y0, 0)
+        x1, y1 = min(x1, self.width), min(y1, self.height)
+        if x0 >= x1 or y0 >= y1:
+            return True
+        rx, ry = self.origin
+        return rx <= x0 and ry <= y0 and x1 <= rx + self.image.shape[1] and y1 <= ry + self.image.shape[0]
+
+    def _rotated_crop(self, box):
+        # Тот же результат, что warpAffine всей страницы и crop: матрица сдвигается в начало прямоугольника.
+        # Часть за пределами страницы остается черной, как при crop полной страницы.
+        x0, y0, x1, y1 = box
+        canvas = np.zeros((max(0, y1 - y0), max(0, x1 - x0), 3), dtype=np.uint8)
+        cx0, cy0 = max(x0, 0), max(y0, 0)
+        cx1, cy1 = min(x1, self.width), min(y1, self.height)
+        if cx0 < cx1 and cy0 < cy1:
+            M = self.rotation.copy()
+            M[0, 2] -= cx0
+            M[1, 2] -= cy0
+            canvas[cy0 - y0:cy1 - y0, cx0 - x0:cx1 - x0] = cv2.warpAffine(
+                self.image, M, (cx1 - cx0, cy1 - cy0),
+                flags=cv2.INTER_CUBIC,
+                borderMode=cv2.BORDER_CONSTANT,
+                borderValue=(255, 255, 255)
+            )
+        return canvas
+
+    def full_page(self):
+        """
+        Эта страница целиком. Страница из DocumentCache дорендеривается через кэш: полная страница
+        заменяет в нем область с учетом занятой памяти, и следующие кропы берутся уже из нее.
+        """
+        if self.cache is not None:
+            return self.cache.get_page(self.pdf_path, self.page_num, self.apply_deskew)
+        with FITZ_LOCK:
+            doc = self.doc if self.doc is not None and not self.doc.is_closed else None
+            return render_pdf_page(self.pdf_path, self.page_num, doc=doc)
+
+    def crop(self, box):
+        """Копия прямоугольника (x0, y0, x1, y1) страницы как RGB-массив; вне страницы - черный."""
+        if self.rotation is not None:
+            return self._rotated_crop(box)
+        if not self.is_full and not self.covers_region(box):
+            print(f"[RenderedPage] {box} is outside of the rendered region, rendering full page of {os.path.basename(self.pdf_path)}")
+            return self.full_page().crop(box)
+        rx, ry = self.origin
+        x0, y0, x1, y1 = box
+        canvas = np.zeros((max(0, y1 - y0), max(0, x1 - x0), 3), dtype=np.uint8)
+        h, w = self.image.shape[:2]
+        sx0, sy0 = max(x0 - rx, 0), max(y0 - ry, 0)
+        sx1, sy1 = min(x1 - rx, w), min(y1 - ry, h)
+        if sx0 < sx1 and sy0 < sy1:
+            canvas[sy0 - (y0 - ry):sy1 - (y0 - ry), sx0 - (x0 - rx):sx1 - (x0 - rx)] = self.image[sy0:sy1, sx0:sx1]
+        return canvas
+
+def coords_map_region(coords_map, margin=None):
+    """
+    Прямоугольник (x0, y0, x1, y1) в пикселях страницы, покрывающий все поля карты координат.
+    Смещение по якорю неотрицательно и не больше размера зоны якоря, поэтому область расширяется
+    вправо и вниз на размер зоны якоря; margin - дополнительный запас со всех сторон.
+    """
+    if margin is None:
+        margin = getattr(settings, 'OCR_RENDER_CLIP_MARGIN', 16)
+    x0 = min(x for x, y, w, h in coords_map.values())
+    y0 = min(y for x, y, w, h in coords_map.values())
+    x1 = max(x + w for x, y, w, h in coords_map.values())
+    y1 = max(y + h for x, y, w, h in coords_map.values())
+    for k, (ax, ay, aw, ah) in coords_map.items():
+        if "Якорь" in k or "Anchor" in k:
+            x1 += aw
+            y1 += ah
+            break
+    return (max(0, x0 - margin), max(0, y0 - margin), x1 + margin, y1 + margin)
+
+def render_pdf_page(pdf_path, page_num=0, apply_deskew=False, region=None, doc=None):
+    """
+    Рендерит страницу PDF в 300 dpi и возвращает RenderedPage (None, если страницы нет).
+    region=(x0, y0, x1, y1) в пикселях - рендерить только эту область (clip в PyMuPDF);
+    apply_deskew - оценить перекос по уменьшенной копии; если он больше OCR_DESKEW_MIN_ANGLE,
+    рендерится вся страница, а поворот применяется при вырезании полей (RenderedPage.rotation).
+    Для повернутых в PDF страниц всегда рендерится вся страница.
+    doc - уже открытый документ (из DocumentCache); иначе файл открывается и закрывается здесь.
+    """
+    # PyMuPDF не потокобезопасен (страницы рендерятся и в потоках конвейера, см. pipeline.py)
+    with FITZ_LOCK:
+        own_doc = doc is None
+        if own_doc:
+            doc = fitz.open(pdf_path)
+        try:
+            if page_num >= len(doc):
+                print(f"[extract_text_from_pdf] Page {page_num} does not exist in {pdf_path}")
+                return None
+            page = doc.load_page(page_num)
 
-        offset_x = 0
-        offset_y = 0
-
-        # Check for explicit Anchor definition in the map
-        anchor_rect = None
-        anchor_key = None
-        for k, v in coords_map.items():
-            if "Якорь" in k or "Anchor" in k:
-                anchor_rect = v
-                anchor_key = k
-                break
-        
-        if anchor_rect:
-            # ONLY run anchor logic if the map has an anchor key
-            ax, ay, aw, ah = anchor_rect
-            # Safety checks
-            ax = max(0, ax)
-            ay = max(0, ay)
-            anchor_crop = img_full.crop((ax, ay, ax + aw, ay + ah))
-            
-            # Save debug image
-            base_fname = os.path.basename(pdf_path)
-            anchor_img_name = f"debug_anchor_{base_fname}.png"
-            anchor_img_path = os.path.join(save_dir, anchor_img_name)
-            anchor_crop.save(anchor_img_path)
-            
-            if reader is not None:
+            skew_angle = 0.0
+            if apply_deskew:
                 try:
-                    print("=" * 35)
-                    print(f"данные читаетсья вот из этого фото: {anchor_img_path}")
-                    print("=" * 35)
-
-                    # Fix: Pass numpy array to EasyOCR to avoid OpenCV 'can't open/read file' error with Cyrillic paths
-                    # Convert PIL to BGR numpy array
-                    anchor_np = cv2.cvtColor(np.array(anchor_crop), cv2.COLOR_RGB2BGR)
-                    anchor_results = reader.readtext(anchor_np, detail=1)
-                    
-                    print("сырые данные из этого фото которые были взяты")
-                    print("=" * 35)
-                    
-                    # DEBUG: Print all raw findings in anchor zone
-                    # print(f"\n[ANCHOR DEBUG RAW] File: {base_fname}")
-                    # print("  RAW (Все найденное в зоне якоря):")
-                    if not anchor_results:
-                        print("    (Пусто, OCR ничего не увидел)")
-                    else:
-                        for (bbox, text, prob) in anchor_results:
-                             # bbox=[[x1,y1],[x2,y1],[x2,y2],[x1,y2]]
-                             h = int(bbox[2][1] - bbox[0][1]) 
-                             print(f"    - '{text}' (H: {h}, Prob: {prob:.2f})")
-
-                    target_anchor_text = "ИНН" # ТО ЧТО МЫ ИЩЕМ (можно менять на "1" или "CMR" и т.д.)
-                    
-                    found_anchor = False
-                    for (bbox, text, prob) in anchor_results:
-                        if target_anchor_text in text:
-                            # Found anchor. Offset is relative to the anchor box top-left
-                            # The bbox is local to the crop.
-                            local_x = int(bbox[0][0])
-                            local_y = int(bbox[0][1])
-                            
-                            # Global shift:
-                            # We expected '1' at (0,0) inside the crop (ideal case).
-                            # Found at (local_x, local_y).
-                            # Shift = local_x, local_y
-                            
-                            offset_x = local_x
-                            offset_y = local_y
-                            
-                            print(f"[ANCHOR DEBUG] Якорь мы искали '{target_anchor_text}' нашли: '{text}'")
-                            print(f"[ANCHOR DEBUG] Координаты которые мы ожидаем: х=0, у=0")
-                            print(f"[ANCHOR DEBUG] Координаты найденного якоря: x={offset_x}, y={offset_y}")
-                            print(f"[ANCHOR DEBUG] Расчет смещения: сдвиг по х={offset_x}, сдвиг по у={offset_y}")
-                            
-                            found_anchor = True
-                            break
-                    
-                    if not found_anchor:
-                         print(f"[ANCHOR DEBUG] Якорь '{target_anchor_text}' не найден в {anchor_rect}. Смещение (0,0).")
-                         print(f"[ANCHOR DEBUG] Сохранено фото области поиска для проверки: {anchor_img_path}")
+                    skew_angle = estimate_page_skew(page)
                 except Exception as e:
-                    print(f"[ANCHOR] Error: {e}")
-
-        for field_name, (x0, y0, w, h) in coords_map.items():
-            # Skip the anchor field itself if it shouldn't be extracted as data
-            if field_name == anchor_key:
-                continue
+                    print(f" [Deskew Error] Не удалось оценить перекос: {e}")
+                if abs(skew_angle) < getattr(settings, 'OCR_DESKEW_MIN_ANGLE', 0.1):
+                    skew_angle = 0.0
+
+            if region is not None and not skew_angle and page.rotation == 0:
+                page_irect = (page.rect * fitz.Matrix(RENDER_SCALE, RENDER_SCALE)).irect
+                clip = fitz.Rect(*[v / RENDER_SCALE for v in region]) & page.rect
+                if not clip.is_empty:
+                    pix = page.get_pixmap(dpi=RENDER_DPI, clip=clip)
+                    return RenderedPage(
+                        pdf_path, page_num, pixmap_to_array(pix), (pix.x, pix.y), (page_irect.width, page_irect.height),
+                        doc=None if own_doc else doc, apply_deskew=apply_deskew
+                    )
+
+            image = pixmap_to_array(page.get_pixmap(dpi=RENDER_DPI))
+        finally:
+            if own_doc:
+                doc.close()
+
+    rotation = None
+    if skew_angle:
+        print(f" [Deskew] Обнаружен перекос: {skew_angle:.2f} градусов. Исправляем...")
+        rotation = cv2.getRotationMatrix2D((image.shape[1] // 2, image.shape[0] // 2), skew_angle, 1.0)
+    return RenderedPage(pdf_path, page_num, image, rotation=rotation, apply_deskew=apply_deskew)
+
+def pixmap_to_array(pix):
+    """Pixmap PyMuPDF -> RGB-массив HxWx3 (uint8)."""
+    image = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+    if pix.n == 1:
+        return cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+    if pix.n == 4:
+        return np.ascontiguousarray(image[:, :, :3])
+    return image
+
+def find_anchor_offset(img_full, coords_map, pdf_path, save_dir, reader, metrics=None):
+    """
+    Ищет якорь ("ИНН") в зоне якоря и возвращает (offset_x, offset_y, anchor_key).
+    Сначала по сохраненному образцу (anchors.AnchorLocator), OCR зоны якоря - только если
+    образца нет или совпадение ниже OCR_ANCHOR_MATCH_THRESHOLD; найденный OCR якорь становится образцом.
+    """
+    offset_x = 0
+    offset_y = 0
+
+    # Check for explicit Anchor definition in the map
+    anchor_rect = None
+    anchor_key = None
+    for k, v in coords_map.items():
+        if "Якорь" in k or "Anchor" in k:
+            anchor_rect = v
+            anchor_key = k
+            break
+    
+    if anchor_rect:
+        # ONLY run anchor logic if the map has an anchor key
+        ax, ay, aw, ah = anchor_rect
+        # Safety checks
+        ax = max(0, ax)
+        ay = max(0, ay)
+        anchor_crop = img_full.crop((ax, ay, ax + aw, ay + ah))
+        
+        # Save debug image (в фоне и только при OCR_SAVE_DEBUG_IMAGES)
+        base_fname = os.path.basename(pdf_path)
+        anchor_img_name = f"debug_anchor_{base_fname}.png"
+        anchor_img_path = os.path.join(save_dir, anchor_img_name)
+        if getattr(settings, 'OCR_SAVE_DEBUG_IMAGES', False):
+            get_image_writer().submit(anchor_crop, anchor_img_path)
+
+        # ТО ЧТО МЫ ИЩЕМ: текст якоря из шаблона документа (FieldSpec.anchor_text)
+        anchor_spec = field_spec(anchor_key)
+        target_anchor_text = anchor_spec.anchor_text if anchor_spec is not None and anchor_spec.is_anchor else "ИНН"
+
+        locator = get_anchor_locator()
+        if locator is not None:
+            try:
+                with metric_timer(metrics, 'anchor_match'):
+                    match = locator.match(anchor_crop, anchor_key, target_anchor_text)
+            except Exception as e:
+                print(f"[ANCHOR] Template match error: {e}")
+                match = None
+            if match is not None and match[2] >= locator.threshold:
+                offset_x, offset_y, score = match
+                incr_metric(metrics, 'anchor_template_hits')
+                print(f"[ANCHOR DEBUG] Якорь '{target_anchor_text}' найден по образцу (score={score:.2f}): сдвиг по х={offset_x}, сдвиг по у={offset_y}")
+                return offset_x, offset_y, anchor_key
+            if match is not None:
+                print(f"[ANCHOR DEBUG] Совпадение с образцом '{target_anchor_text}' слабое (score={match[2]:.2f}), ищем OCR")
+
+        if reader is not None:
+            try:
+                print("=" * 35)
+                print(f"данные читаетсья вот из этого фото: {anchor_img_path}")
+                print("=" * 35)
+
+                # Fix: Pass numpy array to EasyOCR to avoid OpenCV 'can't open/read file' error with Cyrillic paths
+                # Convert RGB crop to BGR numpy array
+                anchor_np = cv2.cvtColor(anchor_crop, cv2.COLOR_RGB2BGR)
+                with metric_timer(metrics, 'anchor_ocr'):
+                    anchor_results = reader.readtext(anchor_np, detail=1)
                 
-            # Apply anchor offset
-            if offset_x != 0 or offset_y != 0:
-                 x0 = max(0, x0 + offset_x)
-                 y0 = max(0, y0 + offset_y)
-                 if anchor_key: # Only log if we actually used an anchor
-                     print(f"[ANCHOR DEBUG] Применяем к полю '{field_name}'... New coords: ({x0}, {y0})")
-
-            x1 = min(x0 + w, img_full.width)
-            y1 = min(y0 + h, img_full.height)
-            
-            crop_img = img_full.crop((x0, y0, x1, y1))
-            
-            if any(x in field_name for x in ["ФИО Водит.", "Марка", "Гос_номер"]):
-                r, g, b = crop_img.split()
-                crop_img = b 
+                print("сырые данные из этого фото которые были взяты")
+                print("=" * 35)
                 
-                if "ФИО Водит." in field_name:
-                    threshold = 170
-                    crop_img = crop_img.point(lambda p: 255 if p > threshold else 0)
-                elif "Гос_номер" in field_name:
-                    threshold = 165
-                    crop_img = crop_img.point(lambda p: 255 if p > threshold else 0)
-            
-            img_filename = get_safe_filename(pdf_path, field_name)
-            img_path = os.path.join(save_dir, img_filename)
-            crop_img.save(img_path)
-            # print(f"[extract_text_from_pdf] Saved image: {img_filename} (original: {os.path.basename(pdf_path)}_{field_name})")
-
-            if reader is None:
-                print(f"[extract_text_from_pdf] OCR reader is not initialized. Skipping OCR for {img_path}")
-                results = []
-            else:
-                try:
-                    if not os.path.exists(img_path):
-                        print(f"[extract_text_from_pdf] ERROR: Image file does not exist: {img_path}")
-                        results = []
-                    else:
-                        test_img = cv2.imread(img_path)
-                        if test_img is None:
-                            print(f"[extract_text_from_pdf] ERROR: cv2.imread returned None for {img_path}. File may have encoding issues.")
-                            results = []
-                        else:
-                            results = reader.readtext(img_path, detail=1)
-                            # print(f"[extract_text_from_pdf] OCR successful for {img_filename}, found {len(results)} text regions")
-                except Exception as e:
-                    print(f"[extract_text_from_pdf] OCR error for {img_path}: {e}")
-                    import traceback
-                    traceback.print_exc()
-                    results = []
-            text_parts = []
-            raw_items = []
-            
-            min_height = MIN_HEIGHT_CONFIG.get(field_name, 0)
-            
-            for (bbox, text, prob) in results:
-                height = int(((bbox[3][1] - bbox[0][1]) + (bbox[2][1] - bbox[1][1])) / 2)
+                # DEBUG: Print all raw findings in anchor zone
+                # print(f"\n[ANCHOR DEBUG RAW] File: {base_fname}")
+                # print("  RAW (Все найденное в зоне якоря):")
+                if not anchor_results:
+                    print("    (Пусто, OCR ничего не увидел)")
+                else:
+                    for (bbox, text, prob) in anchor_results:
+                         # bbox=[[x1,y1],[x2,y1],[x2,y2],[x1,y2]]
+                         h = int(bbox[2][1] - bbox[0][1]) 
+                         print(f"    - '{text}' (H: {h}, Prob: {prob:.2f})")
+
+                found_anchor = False
+                for (bbox, text, prob) in anchor_results:
+                    if target_anchor_text in text:
+                        # Found anchor. Offset is relative to the anchor box top-left
+                        # The bbox is local to the crop.
+                        local_x = int(bbox[0][0])
+                        local_y = int(bbox[0][1])
+                        
+                        # Global shift:
+                        # We expected '1' at (0,0) inside the crop (ideal case).
+                        # Found at (local_x, local_y).
+                        # Shift = local_x, local_y
+                        
+                        offset_x = local_x
+                        offset_y = local_y
+                        
+                        print(f"[ANCHOR DEBUG] Якорь мы искали '{target_anchor_text}' нашли: '{text}'")
+                        print(f"[ANCHOR DEBUG] Координаты которые мы ожидаем: х=0, у=0")
+                        print(f"[ANCHOR DEBUG] Координаты найденного якоря: x={offset_x}, y={offset_y}")
+                        print(f"[ANCHOR DEBUG] Расчет смещения: сдвиг по х={offset_x}, сдвиг по у={offset_y}")
+                        
+                        found_anchor = True
+                        if locator is not None:
+                            try:
+                                locator.learn(anchor_crop, anchor_key, target_anchor_text, bbox, text, reader)
+                            except Exception as e:
+                                print(f"[ANCHOR] Error saving anchor template: {e}")
+                        break
                 
-                raw_items.append((text, height))
+                if not found_anchor:
+                     print(f"[ANCHOR DEBUG] Якорь '{target_anchor_text}' не найден в {anchor_rect}. Смещение (0,0).")
+                     print(f"[ANCHOR DEBUG] Сохранено фото области поиска для проверки: {anchor_img_path}")
+            except Exception as e:
+                print(f"[ANCHOR] Error: {e}")
 
-                if height >= min_height:
-                    text_parts.append(text)
-                else:
-                    pass
-                    # print(f"[extract_text_from_pdf] Filtered out text '{text}' in '{field_name}' due to height {height} < {min_height}")
+    return offset_x, offset_y, anchor_key
+
+def crop_fields(img_full, coords_map, offset_x=0, offset_y=0, anchor_key=None):
+    """Вырезает поля карты координат (со сдвигом по якорю) и возвращает список (field_name, кроп-массив)."""
+    crops = []
+    for field_name, (x0, y0, w, h) in coords_map.items():
+        # Skip the anchor field itself if it shouldn't be extracted as data
+        if field_name == anchor_key:
+            continue
             
-            if any(x in field_name for x in ["ФИО Водит.", "Марка", "Гос_номер"]):
-                extracted_data[field_name] = raw_items
-            else:
-                extracted_data[field_name] = " ".join(text_parts)
-                extracted_data[field_name] = " ".join(text_parts).strip()
+        # Apply anchor offset
+        if offset_x != 0 or offset_y != 0:
+             x0 = max(0, x0 + offset_x)
+             y0 = max(0, y0 + offset_y)
+             if anchor_key: # Only log if we actually used an anchor
+                 print(f"[ANCHOR DEBUG] Применяем к полю '{field_name}'... New coords: ({x0}, {y0})")
+
+        x1 = min(x0 + w, img_full.width)
+        y1 = min(y0 + h, img_full.height)
         
-        doc.close()
+        crop_img = img_full.crop((x0, y0, x1, y1))
+        spec = field_spec(field_name)
+        if spec is not None and spec.preprocessing:
+            crop_img = preprocess_crop(crop_img, spec.preprocessing)
+
+        crops.append((field_name, crop_img))
+    return crops
+
+def preprocess_crop(crop, spec):
+    """
+    Предобработка RGB-кропа по описанию FieldSpec.preprocessing; возвращает массив (канал или бинарное изображение).
+    channel: "r" / "g" / "b" / "gray"; denoise: размер окна медианного фильтра (нечетный);
+    threshold: число (фиксированный порог), "otsu" или "adaptive" (block_size, c - параметры cv2.adaptiveThreshold).
+    """
+    channel = spec.get("channel")
+    if channel == "gray":
+        img = cv2.cvtColor(crop, cv2.COLOR_RGB2GRAY)
+    elif channel:
+        img = np.ascontiguousarray(crop[:, :, "rgb".index(channel)])
+    else:
+        img = crop
+    if img.size == 0:
+        return img
+
+    threshold = spec.get("threshold")
+    if threshold is not None and img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+
+    if spec.get("denoise"):
+        img = cv2.medianBlur(img, spec["denoise"])
+
+    if threshold is None:
+        return img
+    if threshold == "otsu":
+        _, img = cv2.threshold(img, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    elif threshold == "adaptive":
+        img = cv2.adaptiveThreshold(
+            img, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY,
+            spec.get("block_size", 31), spec.get("c", 10)
+        )
+    else:
+        # Пиксели ярче порога - белые, остальные - черные
+        _, img = cv2.threshold(img, threshold, 255, cv2.THRESH_BINARY)
+    return img
+
+def field_value_from_ocr(field_name, results):
+    """Собирает значение поля из результата OCR: список (text, height) для полей с FieldSpec.raw, иначе строку."""
+    text_parts = []
+    raw_items = []
+    
+    spec = field_spec(field_name)
+    min_height = spec.min_height if spec is not None else 0
+    
+    for (bbox, text, prob) in results:
+        height = int(((bbox[3][1] - bbox[0][1]) + (bbox[2][1] - bbox[1][1])) / 2)
+        
+        raw_items.append((text, height))
+
+        if height >= min_height:
+            text_parts.append(text)
+    
+    if spec is not None and spec.raw:
+        return raw_items
+    return " ".join(text_parts).strip()
+
+def save_preview_crops(pdf_path, crops, save_dir):
+    # Кропы для превью пишутся в фоне; перед чтением save_dir нужен get_image_writer().flush(save_dir)
+    if not getattr(settings, 'OCR_SAVE_PREVIEW_IMAGES', True):
+        return
+    writer = get_image_writer()
+    for field_name, crop_img in crops:
+        img_filename = get_safe_filename(pdf_path, field_name)
+        writer.submit(crop_img, os.path.join(save_dir, img_filename))
+
+def read_text_layer_fields(pdf_path, page_num, coords_map, metrics=None, doc=None):
+    """
+    Читает поля из текстового слоя PDF (ЭСФ/СНТ формируются программно и обычно его имеют).
+    Возвращает {field_name: text} только для полей, прошедших FieldSpec.text_layer_check;
+    остальные поля распознаются OCR. Карты с якорем не поддерживаются (смещение ищет OCR).
+    """
+    if any("Якорь" in k or "Anchor" in k for k in coords_map):
+        return {}
+
+    values = {}
+    with FITZ_LOCK:
+        own_doc = doc is None
+        if own_doc:
+            doc = fitz.open(pdf_path)
+        try:
+            if page_num >= len(doc):
+                return {}
+            page = doc.load_page(page_num)
+            if page.rotation != 0:
+                return {}
+            for field_name, (x0, y0, w, h) in coords_map.items():
+                clip = fitz.Rect(x0, y0, x0 + w, y0 + h) / RENDER_SCALE
+                words = page.get_text("words", clip=clip)
+                # (x0, y0, x1, y1, word, block_no, line_no, word_no) - порядок чтения по блокам и строкам
+                words.sort(key=lambda wd: (wd[5], wd[6], wd[7]))
+                text = " ".join(wd[4] for wd in words).strip()
+                if not text:
+                    incr_metric(metrics, 'text_layer_empty')
+                    continue
+                spec = field_spec(field_name)
+                if spec is not None and spec.text_layer_check is not None and not spec.text_layer_check(text):
+                    print(f"[text_layer] '{field_name}' in {os.path.basename(pdf_path)} failed validation: '{text}'")
+                    incr_metric(metrics, 'text_layer_rejected')
+                    continue
+                values[field_name] = text
+        finally:
+            if own_doc:
+                doc.close()
+    return values
+
+def extract_text_from_pdf(pdf_path, coords_map, save_dir, apply_deskew=False, page_num=0, metrics=None, use_text_layer=False, doc_cache=None):
+    extracted_data = {}
+
+    def get_page():
+        region = coords_map_region(coords_map)
+        with metric_timer(metrics, 'render'):
+            if doc_cache is not None:
+                return doc_cache.get_page(pdf_path, page_num, apply_deskew, region)
+            return render_pdf_page(pdf_path, page_num, apply_deskew, region=region)
+
+    cache = get_ocr_cache()
+    cache_key = None
+    try:
+        # print(f"[extract_text_from_pdf] Processing {pdf_path} with coords_map keys: {list(coords_map.keys())}, apply_deskew={apply_deskew}")
+        # 1. Текстовый слой PDF; OCR остается только для полей, которые из него не прочитались
+        text_data = {}
+        if use_text_layer and not apply_deskew and getattr(settings, 'OCR_TEXT_LAYER_ENABLED', True):
+            try:
+                with metric_timer(metrics, 'text_layer'):
+                    doc = doc_cache.document(pdf_path) if doc_cache is not None else None
+                    text_data = read_text_layer_fields(pdf_path, page_num, coords_map, metrics, doc=doc)
+            except Exception as e:
+                print(f"[text_layer] Error reading {pdf_path}: {e}")
+                text_data = {}
+        incr_metric(metrics, 'fields_text_layer', len(text_data))
+        extracted_data.update(text_data)
+
+        ocr_map = {k: v for k, v in coords_map.items() if k not in text_data}
+        if not any("Якорь" not in k and "Anchor" not in k for k in ocr_map):
+            # Все поля взяты из текстового слоя; страница рендерится только ради картинок превью
+            if getattr(settings, 'OCR_SAVE_PREVIEW_IMAGES', True):
+                img_full = get_page()
+                if img_full is not None:
+                    os.makedirs(save_dir, exist_ok=True)
+                    save_preview_crops(pdf_path, crop_fields(img_full, coords_map), save_dir)
+            return extracted_data
+
+        # 2. Кэш OCR (ключ - по полям, которым нужен OCR)
+        if cache is not None:
+            try:
+                digest = doc_cache.sha256(pdf_path) if doc_cache is not None else None
+                cache_key = cache.make_key(pdf_path, page_num, ocr_map, apply_deskew, digest=digest)
+                cached = cache.get(cache_key)
+            except Exception as e:
+                print(f"[OCRResultCache] Lookup error for {pdf_path}: {e}")
+                cache_key, cached = None, None
+
+            if cached is not None:
+                incr_metric(metrics, 'ocr_cache_hits')
+                incr_metric(metrics, 'fields_ocr_cached', len(cached['data']))
+                # OCR не нужен; страница рендерится только ради картинок превью
+                if getattr(settings, 'OCR_SAVE_PREVIEW_IMAGES', True):
+                    img_full = get_page()
+                    if img_full is not None:
+                        os.makedirs(save_dir, exist_ok=True)
+                        crops = crop_fields(img_full, coords_map, cached['offset_x'], cached['offset_y'], cached['anchor_key'])
+                        save_preview_crops(pdf_path, crops, save_dir)
+                # JSON хранит пары (text, height) списками
+                extracted_data.update({k: [tuple(item) for item in v] if isinstance(v, list) else v for k, v in cached['data'].items()})
+                return extracted_data
+            incr_metric(metrics, 'ocr_cache_misses')
+
+        # 3. Рендер, якорь и OCR
+        reader = get_reader()
+        img_full = get_page()
+        if img_full is None:
+            return extracted_data
+
+        os.makedirs(save_dir, exist_ok=True)
+
+        with metric_timer(metrics, 'anchor'):
+            offset_x, offset_y, anchor_key = find_anchor_offset(img_full, ocr_map, pdf_path, save_dir, reader, metrics)
+        crops = crop_fields(img_full, coords_map, offset_x, offset_y, anchor_key)
+        save_preview_crops(pdf_path, crops, save_dir)
+        ocr_crops = [(field_name, crop_img) for field_name, crop_img in crops if field_name in ocr_map]
+
+        # Все поля страницы распознаются одним пакетом (см. ocr.readtext_batched)
+        ocr_ok = False
+        if reader is None:
+            print(f"[extract_text_from_pdf] OCR reader is not initialized. Skipping OCR for {pdf_path}")
+            all_results = [[] for _ in ocr_crops]
+        else:
+            try:
+                with metric_timer(metrics, 'ocr'):
+                    all_results = readtext_batched([crop_img for _, crop_img in ocr_crops], reader)
+                ocr_ok = True
+            except Exception as e:
+                print(f"[extract_text_from_pdf] OCR error for {pdf_path}: {e}")
+                import traceback
+                traceback.print_exc()
+                all_results = [[] for _ in ocr_crops]
+        incr_metric(metrics, 'fields_ocr', len(ocr_crops))
+
+        ocr_data = {}
+        for (field_name, _), results in zip(ocr_crops, all_results):
+            ocr_data[field_name] = field_value_from_ocr(field_name, results)
+        extracted_data.update(ocr_data)
+
+        if cache_key and ocr_ok:
+            try:
+                cache.set(cache_key, {
+                    'data': ocr_data,
+                    'offset_x': offset_x,
+                    'offset_y': offset_y,
+                    'anchor_key': anchor_key,
+                })
+            except Exception as e:
+                print(f"[OCRResultCache] Store error for {pdf_path}: {e}")
     except Exception as e:
         print(f"Error processing {pdf_path}: {e}")
     
     return extracted_data
+
+def clean_field(field_name, value, context):
+    """Очищает значение поля методом DataCleaner из шаблона документа (FieldSpec.cleaner)."""
+    spec = field_spec(field_name)
+    if spec is None or not spec.cleaner:
+        return value
+    return getattr(DataCleaner, spec.cleaner)(value, context)
+
+def extract_document(pdf_path, template, save_dir, context=None, metrics=None, doc_cache=None):
+    """
+    Извлекает поля PDF по плану шаблона (documents.DocumentTemplate.plan): каждая страница плана
+    рендерится и распознается один раз, затем при необходимости читаются запасные страницы.
+    Возвращает (data, columns): сырые значения полей и {колонка: очищенное значение} для полей с column.
+    """
+    plan = template.plan
+    data = {}
+    for step in plan.steps:
+        data.update(extract_text_from_pdf(
+            pdf_path, step.coords_map, save_dir, apply_deskew=step.apply_deskew, page_num=step.page_num,
+            metrics=metrics, use_text_layer=step.use_text_layer, doc_cache=doc_cache
+        ))
+
+    for fallback, step in plan.fallbacks:
+        value = clean_field(fallback.target, data.get(fallback.target), context)
+        if fallback.is_valid(value):
+            continue
+        print(f" [Fallback] '{fallback.target}' is {value!r}, checking page {step.page_num + 1} of {os.path.basename(pdf_path)}...")
+        alt_data = extract_text_from_pdf(
+            pdf_path, step.coords_map, save_dir, apply_deskew=step.apply_deskew, page_num=step.page_num,
+            metrics=metrics, use_text_layer=step.use_text_layer, doc_cache=doc_cache
+        )
+        alt_value = alt_data.get(fallback.field.name)
+        if alt_value:
+            print(f" [Fallback] Found '{fallback.target}' on page {step.page_num + 1}: {alt_value}")
+            data[fallback.target] = alt_value
+        else:
+            print(f" [Fallback] No '{fallback.target}' on page {step.page_num + 1}.")
+
+    columns = {
+        spec.column: clean_field(spec.name, data.get(spec.name), context)
+        for step in plan.steps for spec in step.fields if spec.column is not None
+    }
+    return data, columns
+
 def extract_data_from_xlsx(xlsx_path):
+    """Основной документ в XLSX: (сырые значения, {колонка: значение}, {колонка: ячейка})."""
     extracted_data = {}
     try:
         print(f"[extract_data_from_xlsx] Loading xlsx {xlsx_path}")
@@ -638,7 +960,15 @@ def extract_data_from_xlsx(xlsx_path):
         wb.close()
     except Exception as e:
         print(f"[extract_data_from_xlsx] Error processing XLSX {xlsx_path}: {e}")
-    
+
+    # Те же колонки строки, что дает план шаблона t1 для PDF
+    columns = {
+        2: extracted_data.get("Марка_XLSX", ""),
+        3: extracted_data.get("Гос.номер_XLSX", ""),
+        4: extracted_data.get("ФИО Водит. (4)", ""),
+        7: DataCleaner.clean_7(extracted_data.get("Кол.тон (7)", ""), {}),
+    }
+
     source_map = {
         1: "K75/K76",
         2: "G89",
@@ -647,67 +977,446 @@ def extract_data_from_xlsx(xlsx_path):
         7: "U43"
     }
     
-    return extracted_data, source_map
+    return extracted_data, columns, source_map
 
-def process_zip_file(zip_file, dollar_rate, selected_date, tn_ved_code, bnd_code, nds_percent, save_photos=False):
-    base_temp_dir = os.path.join(settings.MEDIA_ROOT, "temp_ocr")
-    upload_dir = os.path.join(base_temp_dir, "upload")
-    extract_dir = os.path.join(base_temp_dir, "extracted")
-    imgs_root_dir = os.path.join(settings.MEDIA_ROOT, "imgs")
-    preview_imgs_dir = os.path.join(base_temp_dir, "preview_imgs")
+def extract_driver_document(obj_idx, t1_path, job_ctx, doc_cache=None):
+    """
+    Этап 1 обработки водителя: основной документ (Type 1) - поля, превью и фамилия для сопоставления.
+    Не использует общего состояния, поэтому может выполняться в пуле процессов.
+    doc_cache - DocumentCache задачи (в последовательном режиме); без него создается свой на документ.
+    Возвращает словарь водителя для attach_linked_documents (row_data, surname, context, metrics...).
+    """
+    if doc_cache is not None:
+        return _extract_driver_document(obj_idx, t1_path, job_ctx, doc_cache)
+
+    doc_cache = DocumentCache()
+    try:
+        driver = _extract_driver_document(obj_idx, t1_path, job_ctx, doc_cache)
+    finally:
+        doc_cache.close()
+    add_doc_cache_metrics(driver['metrics'], doc_cache)
+    return driver
 
-    if os.path.exists(base_temp_dir):
-        print(f"[process_zip_file] Cleaning up old temp dir: {base_temp_dir}")
-        shutil.rmtree(base_temp_dir)
+def attach_linked_documents(driver, t2_path, t3_path, job_ctx, doc_cache=None):
+    """
+    Этап 3 (после общего сопоставления в process_zip_file): поля назначенных водителю ЭСФ/СНТ
+    (None - файл не найден) и расчет сумм. Возвращает (row_data, PipelineMetrics водителя).
+    doc_cache - как в extract_driver_document.
+    """
+    if doc_cache is not None:
+        return _attach_linked_documents(driver, t2_path, t3_path, job_ctx, doc_cache)
+
+    doc_cache = DocumentCache()
+    try:
+        result = _attach_linked_documents(driver, t2_path, t3_path, job_ctx, doc_cache)
+    finally:
+        doc_cache.close()
+    add_doc_cache_metrics(result[1], doc_cache)
+    return result
+
+def add_doc_cache_metrics(metrics, doc_cache):
+    for key, n in doc_cache.stats.items():
+        if n:
+            metrics.incr(f"pdf_cache_{key}", n)
+
+def t1_debug_columns(t1_data):
+    """Отладочные колонки Type 1: 17 - весь OCR марки и номера, 18 - строки номера нужной высоты."""
+    brand_raw = t1_data.get("Марка") or []
+    plate_raw = t1_data.get("Гос_номер ()") or []
+
+    raw_details_parts = []
+    if brand_raw:
+        raw_details_parts.append(f"Brand: {' '.join([t for t, h in brand_raw])}")
+    if plate_raw:
+        raw_details_parts.append(f"Plate: {' | '.join([f'{t} (H: {h})' for t, h in plate_raw])}")
+
+    return {
+        17: " | ".join(raw_details_parts),
+        18: " | ".join(f"{text} (H: {h})" for text, h in plate_raw if 35 < h < 46),
+    }
+
+def _extract_driver_document(obj_idx, t1_path, job_ctx, doc_cache):
+    base_temp_dir = job_ctx['base_temp_dir']
+    preview_imgs_dir = job_ctx['preview_imgs_dir']
+    imgs_root_dir = job_ctx['imgs_root_dir']
+    media_root = job_ctx['media_root']
+    zip_filename = job_ctx['zip_filename']
+    type_2_files = job_ctx['type_2_files']
+    type_3_files = job_ctx['type_3_files']
+    save_photos = job_ctx['save_photos']
+    selected_date = job_ctx['selected_date']
+    tn_ved_code = job_ctx['tn_ved_code']
+    bnd_code = job_ctx['bnd_code']
+    dollar_rate = job_ctx['dollar_rate']
+    nds_percent = job_ctx['nds_percent']
+
+    metrics = PipelineMetrics()
+
+    print(f"Processing Type 1 file: {t1_path} (Basename: {os.path.basename(t1_path)})")
+
+    temp_img_path = os.path.join(base_temp_dir, f"temp_imgs_processing_obj_{obj_idx}")
+    if os.path.exists(temp_img_path):
+        shutil.rmtree(temp_img_path)
+    os.makedirs(temp_img_path, exist_ok=True)
+
+    is_xlsx = t1_path.lower().endswith('.xlsx')
+
+    # Колонки строки из основного документа (марка, номер, ФИО, кол. тонн): для PDF - по плану шаблона t1
+    if is_xlsx:
+        t1_data, t1_columns, source_map = extract_data_from_xlsx(t1_path)
+        source_map.pop(1, None)
     else:
-        print(f"[process_zip_file] No old temp dir tokens to clean: {base_temp_dir}")
-    
-    os.makedirs(imgs_root_dir, exist_ok=True)
-    os.makedirs(upload_dir, exist_ok=True)
-    os.makedirs(extract_dir, exist_ok=True)
-    os.makedirs(preview_imgs_dir, exist_ok=True)
+        t1_data, t1_columns = extract_document(t1_path, get_template("t1"), temp_img_path, {}, metrics=metrics, doc_cache=doc_cache)
+        source_map = {}
 
-    zip_path = os.path.join(upload_dir, "upload.zip")
-    with open(zip_path, 'wb+') as destination:
-        total_written = 0
-        for chunk in zip_file.chunks():
-            try:
-                destination.write(chunk)
-                total_written += len(chunk)
-            except Exception as e:
-                print(f"[process_zip_file] Error writing chunk to {zip_path}: {e}")
-        print(f"[process_zip_file] Wrote zip to {zip_path}, bytes={total_written}")
+    surname_full = t1_columns.get(4) or ""
 
-    print(f"Extracting ZIP to: {extract_dir}")
-    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-        zip_ref.extractall(extract_dir)
+    context = {
+        'surname': surname_full.split()[0].strip() if surname_full else "",
+        'zip_filename': zip_filename,
+        'type_2_files': type_2_files,
+        'type_3_files': type_3_files,
+        'filename': os.path.basename(t1_path)
+    }
 
-    type_1_files = []
-    type_2_files = []
-    type_3_files = []
+    surname_clean = surname_full.split()[0].strip() if surname_full else "Unknown"
+    print(f"[MATCH DEBUG] File: {os.path.basename(t1_path)}")
+    print(f" [MATCH DEBUG] Extracted Raw FIO: {t1_data.get('ФИО Водит. (4)', [])}")
+    print(f" [MATCH DEBUG] Cleaned Surname: '{surname_clean}'")
 
-    print("Scanning extracted files...")
-    for root, dirs, files in os.walk(extract_dir):
-        for file in files:
-            full_path = os.path.join(root, file)
-            
-            if re.match(r'^[\d\.]+(\s*(cmp|смп|смр|cmr))?\s*\.(pdf|xlsx)$', file, re.IGNORECASE):
-                type_1_files.append(full_path)
-                print(f" [SCAN] Found Type 1 (Main): {file}")
-            elif file.lower().endswith('.pdf'):
-                if re.match(r'^(эсф|электронный\s*(-)?\s*счет\s*(-)?\s*фактура)', file.lower()):
-                    type_2_files.append(full_path)
-                    print(f" [SCAN] Found Type 2 (ESF): {file}")
-                elif re.match(r'^(снт|сопроводительная\s*накладная\s*(на)?\s*товары)', file.lower()):
-                    type_3_files.append(full_path)
-                    print(f" [SCAN] Found Type 3 (SNT): {file}")
-                else:
-                    # print(f" [SCAN] Ignored PDF: {file}")
-                    pass
-            else:
-                # print(f" [SCAN] Ignored file: {file}")
-                pass
+    date_clean = clean_field("Дата (1)", t1_data.get("Дата (1)"), context)
+    if not date_clean:
+        date_clean = "Unknown_Date"
+
+    date_folder = date_clean.replace("/", "-").replace("\\", "-")
+
+    person_img_dir = os.path.join(imgs_root_dir, date_folder, surname_clean)
+
+    preview_obj_dir = os.path.join(preview_imgs_dir, f"obj_{obj_idx}")
+    os.makedirs(preview_obj_dir, exist_ok=True)
+    preview_image_paths = []
+
+    get_image_writer().flush(temp_img_path)
+    if os.path.exists(temp_img_path):
+        for img_file in os.listdir(temp_img_path):
+            src_path = os.path.join(temp_img_path, img_file)
+            dst_path = os.path.join(preview_obj_dir, img_file)
+            shutil.copy2(src_path, dst_path)
+            rel_path = os.path.relpath(dst_path, media_root)
+            preview_image_paths.append(rel_path.replace("\\", "/"))
+
+    if save_photos:
+        os.makedirs(person_img_dir, exist_ok=True)
+        if os.path.exists(temp_img_path):
+            for img_file in os.listdir(temp_img_path):
+                shutil.move(os.path.join(temp_img_path, img_file), os.path.join(person_img_dir, img_file))
+
+    if selected_date:
+        user_date_str = selected_date.strftime('%d.%m.%Y') if hasattr(selected_date, 'strftime') else str(selected_date)
+    else:
+        user_date_str = ""
+
+    field_images = {}
+
+    if os.path.exists(preview_obj_dir):
+        print(f"[process_zip_file] Scanning preview_obj_dir: {preview_obj_dir}")
+        for img_file in os.listdir(preview_obj_dir):
+            img_path = os.path.join(preview_obj_dir, img_file)
+            if os.path.isfile(img_path):
+                rel_path = os.path.relpath(img_path, media_root)
+                rel_path = rel_path.replace("\\", "/")
+
+                img_file_lower = img_file.lower()
+                print(f"[process_zip_file] Checking file: {img_file}")
+
+                if (("date" in img_file_lower or "дата" in img_file_lower) and 
+                    ("_1" in img_file_lower or "(1)" in img_file or img_file_lower.endswith("_1.png"))):
+                    if 1 not in field_images:
+                        field_images[1] = []
+                    field_images[1].append(rel_path)
+                    print(f"[process_zip_file] Added to field_images[1]: {img_file}")
+                elif (("fio" in img_file_lower or "фио" in img_file_lower or "vodit" in img_file_lower or "водит" in img_file_lower) and 
+                      ("_4" in img_file_lower or "(4)" in img_file or "4" in img_file_lower)):
+                    if 4 not in field_images:
+                        field_images[4] = []
+                    field_images[4].append(rel_path)
+                    print(f"[process_zip_file] Added to field_images[4]: {img_file}")
+                elif (("kol" in img_file_lower or "кол" in img_file_lower) and 
+                      ("ton" in img_file_lower or "тон" in img_file_lower or "_7" in img_file_lower or "(7)" in img_file)):
+                    if 7 not in field_images:
+                        field_images[7] = []
+                    field_images[7].append(rel_path)
+                    print(f"[process_zip_file] Added to field_images[7]: {img_file}")
+                elif (("marka" in img_file_lower or "марка" in img_file_lower) and 
+                      not ("gos" in img_file_lower or "гос" in img_file_lower or 
+                           "nomer" in img_file_lower or "номер" in img_file_lower)):
+                    if 2 not in field_images:
+                        field_images[2] = []
+                    field_images[2].append(rel_path)
+                    print(f"[process_zip_file] Added to field_images[2]: {img_file}")
+                elif (("gos" in img_file_lower or "гос" in img_file_lower or 
+                       "nomer" in img_file_lower or "номер" in img_file_lower) and
+                      not ("marka" in img_file_lower or "марка" in img_file_lower)):
+                    if 3 not in field_images:
+                        field_images[3] = []
+                    field_images[3].append(rel_path)
+                    print(f"[process_zip_file] Added to field_images[3]: {img_file}")
+
+        print(f"[process_zip_file] Final field_images keys: {list(field_images.keys())}")
+
+    row_data = {
+        1: user_date_str,
+        2: "", 3: "", 4: "",
+        5: tn_ved_code,
+        6: bnd_code,
+        7: None, 8: None, 9: None, 10: dollar_rate,
+        11: None,
+        12: None, 13: None,
+        14: DataCleaner.clean_14(None, context),
+        15: None, 16: None,
+        17: "", 18: "",
+        'preview_images': preview_image_paths,
+        'field_images': field_images,
+        'sources': source_map,
+        'errors': [],
+        # Предупреждения показываются в предпросмотре, но, в отличие от errors, не останавливают обработку
+        'warnings': []
+    }
+    row_data.update(t1_columns)
+    if not is_xlsx:
+        row_data.update(t1_debug_columns(t1_data))
+
+    return {
+        'obj_idx': obj_idx,
+        't1_path': t1_path,
+        'surname': surname_clean,
+        'context': context,
+        'row_data': row_data,
+        'preview_obj_dir': preview_obj_dir,
+        'person_img_dir': person_img_dir,
+        'metrics': metrics,
+    }
+
+def _attach_linked_documents(driver, t2_path, t3_path, job_ctx, doc_cache):
+    obj_idx = driver['obj_idx']
+    surname_clean = driver['surname']
+    context = driver['context']
+    row_data = driver['row_data']
+    preview_obj_dir = driver['preview_obj_dir']
+    person_img_dir = driver['person_img_dir']
+    metrics = driver['metrics']
+    preview_image_paths = row_data['preview_images']
+    field_images = row_data['field_images']
+    media_root = job_ctx['media_root']
+    save_photos = job_ctx['save_photos']
+    dollar_rate = job_ctx['dollar_rate']
+    nds_percent = job_ctx['nds_percent']
+
+    found_t2 = False
+    found_t3 = False
+
+    if surname_clean and surname_clean != "Unknown":
+        if t2_path:
+            print(f" Match confirmed for Type 2: {t2_path}")
+            t2_preview_dir = os.path.join(preview_obj_dir, "type2")
+            os.makedirs(t2_preview_dir, exist_ok=True)
+
+            _, t2_columns = extract_document(t2_path, get_template("t2"), t2_preview_dir, context, metrics=metrics, doc_cache=doc_cache)
+            row_data.update(t2_columns)
+
+            get_image_writer().flush(t2_preview_dir)
+            if os.path.exists(t2_preview_dir):
+                print(f"[process_zip_file] Scanning t2_preview_dir: {t2_preview_dir}")
+                for img_file in os.listdir(t2_preview_dir):
+                    img_path = os.path.join(t2_preview_dir, img_file)
+                    if os.path.isfile(img_path):
+                        rel_path = os.path.relpath(img_path, media_root)
+                        rel_path = rel_path.replace("\\", "/")
+                        preview_image_paths.append(rel_path)
+
+                        img_file_lower = img_file.lower()
+                        print(f"[process_zip_file] Checking t2 file: {img_file}")
+
+                        has_16 = ("_16" in img_file_lower or "(16)" in img_file or "16.png" in img_file_lower or
+                                  "schet" in img_file_lower or "счет" in img_file_lower or 
+                                  "fakt" in img_file_lower or "факт" in img_file_lower or
+                                  "invoice" in img_file_lower or "инвойс" in img_file_lower or
+                                  "invois" in img_file_lower)
+
+                        has_8 = ("_8" in img_file_lower or "(8)" in img_file or 
+                                 "8.png" in img_file_lower or "_8_" in img_file_lower or 
+                                 ("cena" in img_file_lower or "цена" in img_file_lower or 
+                                  "price" in img_file_lower or "tsena" in img_file_lower))
+
+                        if has_16:
+                            if 16 not in field_images:
+                                field_images[16] = []
+                            field_images[16].append(rel_path)
+                            print(f"[process_zip_file] Added to field_images[16]: {img_file}")
+                        elif has_8 or not has_16:
+                            if 8 not in field_images:
+                                field_images[8] = []
+                            field_images[8].append(rel_path)
+                            print(f"[process_zip_file] Added to field_images[8]: {img_file}")
+
+            if save_photos:
+                os.makedirs(person_img_dir, exist_ok=True)
+                if os.path.exists(t2_preview_dir):
+                    for img_file in os.listdir(t2_preview_dir):
+                        src_path = os.path.join(t2_preview_dir, img_file)
+                        dst_path = os.path.join(person_img_dir, f"type2_{img_file}")
+                        shutil.copy2(src_path, dst_path)
+
+            found_t2 = True
+
+        if not found_t2:
+            row_data['errors'].append("Не найден файл ЭСФ (Счет-фактура) для этого водителя.")
+            print(f"[process_zip_file] Warning: no Type2 (ЭСФ) match for surname {surname_clean} in object {obj_idx}")
+
+        if t3_path:
+            print(f" Match confirmed for Type 3: {t3_path}")
+            t3_preview_dir = os.path.join(preview_obj_dir, "type3")
+            os.makedirs(t3_preview_dir, exist_ok=True)
+
+            _, t3_columns = extract_document(t3_path, get_template("t3"), t3_preview_dir, context, metrics=metrics, doc_cache=doc_cache)
+            row_data.update(t3_columns)
+
+            get_image_writer().flush(t3_preview_dir)
+            if os.path.exists(t3_preview_dir):
+                print(f"[process_zip_file] Scanning t3_preview_dir: {t3_preview_dir}")
+                t3_files_list = []
+                for img_file in os.listdir(t3_preview_dir):
+                    img_path = os.path.join(t3_preview_dir, img_file)
+                    if os.path.isfile(img_path) and img_file.lower().endswith('.png'):
+                        rel_path = os.path.relpath(img_path, media_root)
+                        rel_path = rel_path.replace("\\", "/")
+                        preview_image_paths.append(rel_path)
+                        t3_files_list.append((img_file, rel_path))
+
+                for img_file, rel_path in t3_files_list:
+                    img_file_lower = img_file.lower()
+                    print(f"[process_zip_file] Checking t3 file: {img_file}")
+
+                    has_kz_15 = ("kz" in img_file_lower or "_15" in img_file_lower or "(15)" in img_file or 
+                                    "15.png" in img_file_lower or "_15_" in img_file_lower or
+                                    "soprovozhdenie" in img_file_lower or "soprovozhd" in img_file_lower)
+
+                    has_13 = ("_13" in img_file_lower or "(13)" in img_file or 
+                                "13.png" in img_file_lower or "_13_" in img_file_lower)
+                    has_date_keyword = ("date" in img_file_lower or "data" in img_file_lower or "дата" in img_file_lower or
+                                        "datar" in img_file_lower) 
+                    has_sopr_nakl = ("sopr" in img_file_lower or "сопров" in img_file_lower or "сопр" in img_file_lower or
+                                        "nakl" in img_file_lower or "накл" in img_file_lower)
+
+                    if has_kz_15 and not has_13:
+                        if 15 not in field_images:
+                            field_images[15] = []
+                        field_images[15].append(rel_path)
+                        print(f"[process_zip_file] Added to field_images[15]: {img_file}")
+                    elif (has_13 or (has_date_keyword and has_sopr_nakl)) and not has_kz_15:
+                        if 13 not in field_images:
+                            field_images[13] = []
+                        field_images[13].append(rel_path)
+                        print(f"[process_zip_file] Added to field_images[13]: {img_file}")
+                    elif 13 not in field_images and 15 not in field_images:
+                        file_index = [i for i, (f, _) in enumerate(t3_files_list) if f == img_file][0]
+                        if file_index == 0:
+                            if 15 not in field_images:
+                                field_images[15] = []
+                            field_images[15].append(rel_path)
+                            print(f"[process_zip_file] Added to field_images[15] by order (first): {img_file}")
+                        else:
+                            if 13 not in field_images:
+                                field_images[13] = []
+                            field_images[13].append(rel_path)
+                            print(f"[process_zip_file] Added to field_images[13] by order (second): {img_file}")
+                    elif 15 in field_images and 13 not in field_images:
+                        if 13 not in field_images:
+                            field_images[13] = []
+                        field_images[13].append(rel_path)
+                        print(f"[process_zip_file] Added to field_images[13] (15 already filled): {img_file}")
+                    elif 13 in field_images and 15 not in field_images:
+                        if 15 not in field_images:
+                            field_images[15] = []
+                        field_images[15].append(rel_path)
+                        print(f"[process_zip_file] Added to field_images[15] (13 already filled): {img_file}")
+
+            if save_photos:
+                os.makedirs(person_img_dir, exist_ok=True)
+                if os.path.exists(t3_preview_dir):
+                    for img_file in os.listdir(t3_preview_dir):
+                        src_path = os.path.join(t3_preview_dir, img_file)
+                        dst_path = os.path.join(person_img_dir, f"type3_{img_file}")
+                        shutil.copy2(src_path, dst_path)
+
+            found_t3 = True
+
+        if not found_t3:
+            row_data['errors'].append("Не найден файл СНТ (Накладная) для этого водителя.")
+            print(f"[process_zip_file] Warning: no Type3 (СНТ) match for surname {surname_clean} in object {obj_idx}")
+    else:
+        print(f"[process_zip_file] Surname not found or empty ('{surname_clean}'), skipping ESF/SNT matching.")
+
+    try:
+        kol_ton = safe_decimal(row_data[7], "Кол.тон (7)")
+        kol_ton = kol_ton / Decimal("1000")
+        row_data[7] = kol_ton
+
+        cena = safe_decimal(row_data[8], "Цена (8)")
+        row_data[8] = cena
 
+        sum_dollar = (kol_ton * cena).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+        row_data[9] = sum_dollar
+
+        sum_som = (sum_dollar * dollar_rate).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+        row_data[11] = sum_som
+
+        nds_percent_value = nds_percent if isinstance(nds_percent, Decimal) else Decimal(str(nds_percent))
+        nds_sum = (sum_som * nds_percent_value / Decimal("100")).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+        row_data[12] = nds_sum
+
+        if found_t3 and not row_data.get(15):
+            row_data['errors'].append("Не удалось найти '№ сопров.накл. KZ'. Проверьте файл СНТ.")
+        if found_t2 and not row_data.get(16):
+            row_data['errors'].append("Не удалось найти '№ счет факт'. Проверьте файл ЭСФ.")
+        if found_t3 and not row_data.get(13):
+            row_data['errors'].append("Не удалось найти 'Дата сопр.накл'. Проверьте файл СНТ.")
+
+    except Exception as e:
+        print(f"[process_zip_file] Calculation error for object {obj_idx}: {e}")
+
+
+    return row_data, metrics
+
+
+def process_zip_file(zip_file, dollar_rate, selected_date, tn_ved_code, bnd_code, nds_percent, save_photos=False, progress_callback=None, workspace=None, metrics=None):
+    # Все временные файлы живут в каталоге задачи, чтобы параллельные загрузки не мешали друг другу
+    # metrics (PipelineMetrics) заполняется счетчиками кэша OCR и таймингами этапов
+    if metrics is None:
+        metrics = PipelineMetrics()
+    if workspace is None:
+        workspace = JobWorkspace()
+    workspace.create()
+    print(f"[process_zip_file] Using workspace: {workspace.root}")
+
+    base_temp_dir = workspace.root
+    extract_dir = workspace.extract_dir
+    imgs_root_dir = os.path.join(settings.MEDIA_ROOT, "imgs")
+    preview_imgs_dir = workspace.preview_imgs_dir
+
+    os.makedirs(imgs_root_dir, exist_ok=True)
+    os.makedirs(extract_dir, exist_ok=True)
+    os.makedirs(preview_imgs_dir, exist_ok=True)
+
+    # Из архива распаковываются только документы Type 1/2/3 (тип определяется по имени файла шаблонами
+    # documents.DOCUMENT_TEMPLATES); ограничения от zip-бомб проверяются во время распаковки
+    print(f"Extracting documents from ZIP to: {extract_dir}")
+    files_by_template = {"t1": [], "t2": [], "t3": []}
+    files_by_template.update(ingest_zip(zip_file, extract_dir, metrics=metrics))
+
+    type_1_files = files_by_template["t1"]
+    type_2_files = files_by_template["t2"]
+    type_3_files = files_by_template["t3"]
 
     # print(f"[process_zip_file] Found {len(type_1_files)} type_1, {len(type_2_files)} type_2, {len(type_3_files)} type_3 files")
 
@@ -717,494 +1426,116 @@ def process_zip_file(zip_file, dollar_rate, selected_date, tn_ved_code, bnd_code
 
     final_results = []
     
-    used_type_2 = set()
-    used_type_3 = set()
-    
     driver_debug_info = [] # Store debug string for each driver
 
-    for obj_idx, t1_path in enumerate(type_1_files):
-        print(f"Processing Type 1 file: {t1_path} (Basename: {os.path.basename(t1_path)})")
-        
-        temp_img_path = os.path.join(base_temp_dir, f"temp_imgs_processing_obj_{obj_idx}")
-        if os.path.exists(temp_img_path):
-            shutil.rmtree(temp_img_path)
-        os.makedirs(temp_img_path, exist_ok=True)
-        
-        is_xlsx = t1_path.lower().endswith('.xlsx')
-        t1_data = {}
-        
-        if is_xlsx:
-            t1_data, source_map = extract_data_from_xlsx(t1_path)
-            if isinstance(source_map, dict):
-                source_map.pop(1, None)
-        else:
-            t1_data = extract_text_from_pdf(t1_path, FIELDS_MAP_TYPE_1, temp_img_path, apply_deskew=True)
-            source_map = {}
-        
-        fio_raw_data = t1_data.get("ФИО Водит. (4)", [])
-        
-        if is_xlsx:
-            fio_str = str(fio_raw_data).strip()
-            fio_formatted = fio_str
-            fio_clean = fio_str
-        else:
-            fio_formatted, fio_clean = DataCleaner.clean_fio_raw(fio_raw_data, {})
-        
-        surname_full = fio_clean
-        
-        context = {
-            'surname': surname_full.split()[0].strip() if surname_full else "",
-            'zip_filename': zip_file.name,
-            'type_2_files': type_2_files,
-            'type_3_files': type_3_files,
-            'filename': os.path.basename(t1_path)
-        }
-        
-        surname_clean = surname_full.split()[0].strip() if surname_full else "Unknown"
-        print(f"[MATCH DEBUG] File: {os.path.basename(t1_path)}")
-        print(f" [MATCH DEBUG] Extracted Raw FIO: {fio_raw_data}")
-        print(f" [MATCH DEBUG] Cleaned Surname: '{surname_clean}'")
-        
-        # DEBUG: Print raw FIO data and selected name
-        # if not is_xlsx:
-        #     print(f"\n[DEBUG FIO] File: {os.path.basename(t1_path)}")
-            
-        #     print("  RAW (Все найденное):")
-        #     for t, h in fio_raw_data:
-        #         print(f"    - '{t}' (H: {h})")
-            
-        #     print("  FILTERED (Прошло фильтр > 35):")
-        #     passed_filter = []
-        #     for t, h in fio_raw_data:
-        #         if 35 < h < 500 and not re.search(r'\d{2}\.\d{2}\.\d{4}', t):
-        #             passed_filter.append(f"    - '{t}' (H: {h})")
-        #     if passed_filter:
-        #         print("\n".join(passed_filter))
-        #     else:
-        #         print("    (Пусто)")
-                
-        #     print(f"  SELECTED (Итого): '{surname_clean}'\n")
-        #     d_info = f"\n[FILE: {os.path.basename(t1_path)}]\n  RAW (Все найденное):\n"
-        #     if not fio_raw_data:
-        #         d_info += "    (Нет данных)\n"
-        #     else:
-        #         for t, h in fio_raw_data: d_info += f"    - '{t}' (H: {h})\n"
-            
-        #     d_info += "  FILTERED (Прошло фильтр > 35):\n"
-        #     if passed_filter: 
-        #         d_info += "\n".join(passed_filter) + "\n"
-        #     else: 
-        #         d_info += "    (Пусто)\n"
-            
-        #     d_info += f"  SELECTED (Итого): '{surname_clean}'\n"
-        #     driver_debug_info.append(d_info)
-        # else:
-        #      print(f"\n[DEBUG FIO] File: {os.path.basename(t1_path)}")
-        #      print(f"  Raw Data (XLSX): {fio_raw_data}")
-        #      print(f"  Selected: {surname_clean}\n")
-        #      driver_debug_info.append(f"[XLSX] {os.path.basename(t1_path)}: Selected='{surname_clean}'")
-
-        found_t2 = False
-        found_t3 = False
-
-        raw_date = t1_data.get("Дата (1)")
-        date_clean = DataCleaner.clean_1(raw_date, context)
-        if not date_clean:
-            date_clean = "Unknown_Date"
-        
-        date_folder = date_clean.replace("/", "-").replace("\\", "-")
-
-        person_img_dir = os.path.join(imgs_root_dir, date_folder, surname_clean)
-        
-        preview_obj_dir = os.path.join(preview_imgs_dir, f"obj_{len(final_results)}")
-        os.makedirs(preview_obj_dir, exist_ok=True)
-        preview_image_paths = []
-        
-        if os.path.exists(temp_img_path):
-            for img_file in os.listdir(temp_img_path):
-                src_path = os.path.join(temp_img_path, img_file)
-                dst_path = os.path.join(preview_obj_dir, img_file)
-                shutil.copy2(src_path, dst_path)
-                rel_path = os.path.relpath(dst_path, settings.MEDIA_ROOT)
-                preview_image_paths.append(rel_path.replace("\\", "/"))
-        
-        if save_photos:
-            os.makedirs(person_img_dir, exist_ok=True)
-            if os.path.exists(temp_img_path):
-                for img_file in os.listdir(temp_img_path):
-                    shutil.move(os.path.join(temp_img_path, img_file), os.path.join(person_img_dir, img_file))
-        
-        plate_val = ""
-        car_val = ""
-        big_3_cleaned_list = []
-
-        if is_xlsx:
-            plate_val = t1_data.get("Гос.номер_XLSX", "")
-            car_val = t1_data.get("Марка_XLSX", "")
-            big_3_cleaned_list = [car_val, plate_val]
-        else:
-            # --- Process BRAND ---
-            brand_raw = t1_data.get("Марка", [])
-            # For brand, we just take all text found in the box
-            car_val = " ".join([t.strip() for t, h in brand_raw if t.strip()])
-            
-            # --- Process PLATE ---
-            plate_raw = t1_data.get("Гос_номер ()", [])
-            plate_cleaned_list = DataCleaner.get_cleaned_big_3_list(plate_raw)
-            
-            # Debug: Capture filtered items with heights for Plate
-            filtered_debug = []
-            for text, h in plate_raw:
-                if 35 < h < 46:
-                     filtered_debug.append(f"{text} (H: {h})")
-            filtered_debug_str = " | ".join(filtered_debug)
-            
-            if plate_cleaned_list:
-                if len(plate_cleaned_list) >= 2:
-                    # Assume first is number, last is region, or vice versa. 
-                    # Usually: [Number, Region]
-                    p1 = DataCleaner.clean_plate_text(plate_cleaned_list[0])
-                    p2 = DataCleaner.clean_plate_text(plate_cleaned_list[-1])
-                    plate_val = f"{p1} / {p2}"
-                else:
-                    plate_val = DataCleaner.clean_plate_text(plate_cleaned_list[0])
-        
-        if selected_date:
-            user_date_str = selected_date.strftime('%d.%m.%Y') if hasattr(selected_date, 'strftime') else str(selected_date)
-        else:
-            user_date_str = ""
-        
-        field_images = {}
-        
-        if os.path.exists(preview_obj_dir):
-            print(f"[process_zip_file] Scanning preview_obj_dir: {preview_obj_dir}")
-            for img_file in os.listdir(preview_obj_dir):
-                img_path = os.path.join(preview_obj_dir, img_file)
-                if os.path.isfile(img_path):
-                    rel_path = os.path.relpath(img_path, settings.MEDIA_ROOT)
-                    rel_path = rel_path.replace("\\", "/")
-                    
-                    img_file_lower = img_file.lower()
-                    print(f"[process_zip_file] Checking file: {img_file}")
-                    
-                    if (("date" in img_file_lower or "дата" in img_file_lower) and 
-                        ("_1" in img_file_lower or "(1)" in img_file or img_file_lower.endswith("_1.png"))):
-                        if 1 not in field_images:
-                            field_images[1] = []
-                        field_images[1].append(rel_path)
-                        print(f"[process_zip_file] Added to field_images[1]: {img_file}")
-                    elif (("fio" in img_file_lower or "фио" in img_file_lower or "vodit" in img_file_lower or "водит" in img_file_lower) and 
-                          ("_4" in img_file_lower or "(4)" in img_file or "4" in img_file_lower)):
-                        if 4 not in field_images:
-                            field_images[4] = []
-                        field_images[4].append(rel_path)
-                        print(f"[process_zip_file] Added to field_images[4]: {img_file}")
-                    elif (("kol" in img_file_lower or "кол" in img_file_lower) and 
-                          ("ton" in img_file_lower or "тон" in img_file_lower or "_7" in img_file_lower or "(7)" in img_file)):
-                        if 7 not in field_images:
-                            field_images[7] = []
-                        field_images[7].append(rel_path)
-                        print(f"[process_zip_file] Added to field_images[7]: {img_file}")
-                    elif (("marka" in img_file_lower or "марка" in img_file_lower) and 
-                          not ("gos" in img_file_lower or "гос" in img_file_lower or 
-                               "nomer" in img_file_lower or "номер" in img_file_lower)):
-                        if 2 not in field_images:
-                            field_images[2] = []
-                        field_images[2].append(rel_path)
-                        print(f"[process_zip_file] Added to field_images[2]: {img_file}")
-                    elif (("gos" in img_file_lower or "гос" in img_file_lower or 
-                           "nomer" in img_file_lower or "номер" in img_file_lower) and
-                          not ("marka" in img_file_lower or "марка" in img_file_lower)):
-                        if 3 not in field_images:
-                            field_images[3] = []
-                        field_images[3].append(rel_path)
-                        print(f"[process_zip_file] Added to field_images[3]: {img_file}")
-            
-            print(f"[process_zip_file] Final field_images keys: {list(field_images.keys())}")
-        
-        row_data = {
-            1: user_date_str,
-            2: car_val,
-            3: plate_val,
-            4: fio_formatted,
-            5: tn_ved_code,
-            6: bnd_code,
-            7: DataCleaner.clean_7(t1_data.get("Кол.тон (7)"), context),
-            8: None, 9: None, 10: dollar_rate,
-            11: None,
-            12: None, 13: None,
-            14: DataCleaner.clean_14(None, context),
-            15: None, 16: None,
-            15: None, 16: None,
-            17: "",
-            18: filtered_debug_str if not is_xlsx else "",
-            'preview_images': preview_image_paths,
-            'field_images': field_images,
-            'sources': source_map,
-            'errors': []
-        }
-
-        if not is_xlsx:
-            brand_raw = t1_data.get("Марка", [])
-            plate_raw = t1_data.get("Гос_номер ()", [])
-            
-            raw_details_parts = []
-            if brand_raw:
-                 raw_details_parts.append(f"Brand: {' '.join([t for t, h in brand_raw])}")
-            if plate_raw:
-                 plate_debug = " | ".join([f"{t} (H: {h})" for t, h in plate_raw])
-                 raw_details_parts.append(f"Plate: {plate_debug}")
-            
-            row_data[17] = " | ".join(raw_details_parts)
-
-        if surname_clean and surname_clean != "Unknown":
-            surname_variants = normalize_surname(surname_clean)
-            print(f" [MATCH DEBUG] Generated variants for '{surname_clean}': {surname_variants}")
-            # print(f"[process_zip_file] Searching for ESF/SNT files with surname variants: {surname_variants}")
-            
-            for t2_path in type_2_files:
-                fname = os.path.basename(t2_path).lower()
-                
-                match_found = False
-                # 1. Exact match
-                for variant in surname_variants:
-                    if variant.lower() in fname:
-                        match_found = True
-                        print(f" [MATCH] Exact match found Type 2: {t2_path}")
-                        break
-                
-                # 2. Fuzzy match
-                if not match_found:
-                    fname_words = re.findall(r'\w+', fname)
-                    for variant in surname_variants:
-                        v_lower = variant.lower()
-                        for word in fname_words:
-                            ratio = difflib.SequenceMatcher(None, v_lower, word).ratio()
-                            if ratio > 0.80: # Threshold 80%
-                                match_found = True
-                                print(f" [MATCH] Fuzzy match ({ratio:.2f}) found Type 2: {t2_path} (variant: {variant}, word: {word})")
-                                break
-                        if match_found: break
-                
-                if match_found:
-                    print(f" Match confirmed for Type 2: {t2_path}")
-                    t2_preview_dir = os.path.join(preview_obj_dir, "type2")
-                    os.makedirs(t2_preview_dir, exist_ok=True)
-                    
-                    t2_data = extract_text_from_pdf(t2_path, FIELDS_MAP_TYPE_2, t2_preview_dir)
-                    
-                    price_raw = t2_data.get("Цена (8)")
-                    price_val_str = DataCleaner.clean_8(price_raw, context)
-                    
-                    check_price = safe_decimal(price_val_str, "Check Price")
-                    
-                    if check_price == Decimal("7") or check_price <= Decimal("1"):
-                        print(f" [Price Check] Price is {check_price}, checking 2nd page of ESF...")
-                        t2_data_p2 = extract_text_from_pdf(t2_path, FIELDS_MAP_TYPE_2_PAGE_2, t2_preview_dir, page_num=1)
-                        price_alt_raw = t2_data_p2.get("Цена (8) Alt")
-                        if price_alt_raw:
-                            print(f" [Price Check] Found price on 2nd page: {price_alt_raw}")
-                            t2_data["Цена (8)"] = price_alt_raw
-                        else:
-                            print(" [Price Check] No price found on 2nd page.")
+    def report_progress(current, message):
+        if progress_callback is not None:
+            try:
+                progress_callback(current, 2 * len(type_1_files), message)
+            except Exception as e:
+                print(f"[process_zip_file] progress_callback error: {e}")
+
+    job_ctx = {
+        'base_temp_dir': base_temp_dir,
+        'preview_imgs_dir': preview_imgs_dir,
+        'imgs_root_dir': imgs_root_dir,
+        'media_root': str(settings.MEDIA_ROOT),
+        'zip_filename': zip_file.name,
+        'type_2_files': type_2_files,
+        'type_3_files': type_3_files,
+        'save_photos': save_photos,
+        'selected_date': selected_date,
+        'tn_ved_code': tn_ved_code,
+        'bnd_code': bnd_code,
+        'dollar_rate': dollar_rate,
+        'nds_percent': nds_percent,
+    }
 
-                    row_data[8] = DataCleaner.clean_8(t2_data.get("Цена (8)"), context)
-                    row_data[16] = DataCleaner.clean_16(t2_data.get("№ счет факт (Инвойс) (16)"), context)
-                    
-                    if os.path.exists(t2_preview_dir):
-                        print(f"[process_zip_file] Scanning t2_preview_dir: {t2_preview_dir}")
-                        for img_file in os.listdir(t2_preview_dir):
-                            img_path = os.path.join(t2_preview_dir, img_file)
-                            if os.path.isfile(img_path):
-                                rel_path = os.path.relpath(img_path, settings.MEDIA_ROOT)
-                                rel_path = rel_path.replace("\\", "/")
-                                preview_image_paths.append(rel_path)
-                                
-                                img_file_lower = img_file.lower()
-                                print(f"[process_zip_file] Checking t2 file: {img_file}")
-                                
-                                has_16 = ("_16" in img_file_lower or "(16)" in img_file or "16.png" in img_file_lower or
-                                          "schet" in img_file_lower or "счет" in img_file_lower or 
-                                          "fakt" in img_file_lower or "факт" in img_file_lower or
-                                          "invoice" in img_file_lower or "инвойс" in img_file_lower or
-                                          "invois" in img_file_lower)
-                                
-                                has_8 = ("_8" in img_file_lower or "(8)" in img_file or 
-                                         "8.png" in img_file_lower or "_8_" in img_file_lower or 
-                                         ("cena" in img_file_lower or "цена" in img_file_lower or 
-                                          "price" in img_file_lower or "tsena" in img_file_lower))
-                                
-                                if has_16:
-                                    if 16 not in field_images:
-                                        field_images[16] = []
-                                    field_images[16].append(rel_path)
-                                    print(f"[process_zip_file] Added to field_images[16]: {img_file}")
-                                elif has_8 or not has_16:
-                                    if 8 not in field_images:
-                                        field_images[8] = []
-                                    field_images[8].append(rel_path)
-                                    print(f"[process_zip_file] Added to field_images[8]: {img_file}")
-                    
-                    if save_photos:
-                        os.makedirs(person_img_dir, exist_ok=True)
-                        if os.path.exists(t2_preview_dir):
-                            for img_file in os.listdir(t2_preview_dir):
-                                src_path = os.path.join(t2_preview_dir, img_file)
-                                dst_path = os.path.join(person_img_dir, f"type2_{img_file}")
-                                shutil.copy2(src_path, dst_path)
-                    
-                    found_t2 = True
-                    used_type_2.add(t2_path)
-                    break 
-                if found_t2: break
-            
-            if not found_t2:
-                row_data['errors'].append("Не найден файл ЭСФ (Счет-фактура) для этого водителя.")
-                print(f"[process_zip_file] Warning: no Type2 (ЭСФ) match for surname {surname_clean} in object {len(final_results)}")
-            
-            for t3_path in type_3_files:
-                fname = os.path.basename(t3_path).lower()
-                
-                match_found = False
-                # 1. Exact match
-                for variant in surname_variants:
-                    if variant.lower() in fname:
-                        match_found = True
-                        print(f" [MATCH] Exact match found Type 3: {t3_path}")
-                        break
-                
-                # 2. Fuzzy match
-                if not match_found:
-                    fname_words = re.findall(r'\w+', fname)
-                    for variant in surname_variants:
-                        v_lower = variant.lower()
-                        for word in fname_words:
-                            ratio = difflib.SequenceMatcher(None, v_lower, word).ratio()
-                            if ratio > 0.80: # Threshold 80%
-                                match_found = True
-                                print(f" [MATCH] Fuzzy match ({ratio:.2f}) found Type 3: {t3_path} (variant: {variant}, word: {word})")
-                                break
-                        if match_found: break
-
-                if match_found:
-                    print(f" Match confirmed for Type 3: {t3_path}")
-                    t3_preview_dir = os.path.join(preview_obj_dir, "type3")
-                    os.makedirs(t3_preview_dir, exist_ok=True)
-                    
-                    t3_data = extract_text_from_pdf(t3_path, FIELDS_MAP_TYPE_3, t3_preview_dir)
-                    row_data[15] = DataCleaner.clean_15(t3_data.get("№ сопров.накл. KZ (15)"), context)
-                    
-                    date_sopr = DataCleaner.clean_1(t3_data.get("Дата сопр.накл (13)"), context)
-                    row_data[13] = date_sopr
-                        
-                    if os.path.exists(t3_preview_dir):
-                        print(f"[process_zip_file] Scanning t3_preview_dir: {t3_preview_dir}")
-                        t3_files_list = []
-                        for img_file in os.listdir(t3_preview_dir):
-                            img_path = os.path.join(t3_preview_dir, img_file)
-                            if os.path.isfile(img_path) and img_file.lower().endswith('.png'):
-                                rel_path = os.path.relpath(img_path, settings.MEDIA_ROOT)
-                                rel_path = rel_path.replace("\\", "/")
-                                preview_image_paths.append(rel_path)
-                                t3_files_list.append((img_file, rel_path))
-                        
-                        for img_file, rel_path in t3_files_list:
-                            img_file_lower = img_file.lower()
-                            print(f"[process_zip_file] Checking t3 file: {img_file}")
-                            
-                            has_kz_15 = ("kz" in img_file_lower or "_15" in img_file_lower or "(15)" in img_file or 
-                                            "15.png" in img_file_lower or "_15_" in img_file_lower or
-                                            "soprovozhdenie" in img_file_lower or "soprovozhd" in img_file_lower)
-                            
-                            has_13 = ("_13" in img_file_lower or "(13)" in img_file or 
-                                        "13.png" in img_file_lower or "_13_" in img_file_lower)
-                            has_date_keyword = ("date" in img_file_lower or "data" in img_file_lower or "дата" in img_file_lower or
-                                                "datar" in img_file_lower) 
-                            has_sopr_nakl = ("sopr" in img_file_lower or "сопров" in img_file_lower or "сопр" in img_file_lower or
-                                                "nakl" in img_file_lower or "накл" in img_file_lower)
-                            
-                            if has_kz_15 and not has_13:
-                                if 15 not in field_images:
-                                    field_images[15] = []
-                                field_images[15].append(rel_path)
-                                print(f"[process_zip_file] Added to field_images[15]: {img_file}")
-                            elif (has_13 or (has_date_keyword and has_sopr_nakl)) and not has_kz_15:
-                                if 13 not in field_images:
-                                    field_images[13] = []
-                                field_images[13].append(rel_path)
-                                print(f"[process_zip_file] Added to field_images[13]: {img_file}")
-                            elif 13 not in field_images and 15 not in field_images:
-                                file_index = [i for i, (f, _) in enumerate(t3_files_list) if f == img_file][0]
-                                if file_index == 0:
-                                    if 15 not in field_images:
-                                        field_images[15] = []
-                                    field_images[15].append(rel_path)
-                                    print(f"[process_zip_file] Added to field_images[15] by order (first): {img_file}")
-                                else:
-                                    if 13 not in field_images:
-                                        field_images[13] = []
-                                    field_images[13].append(rel_path)
-                                    print(f"[process_zip_file] Added to field_images[13] by order (second): {img_file}")
-                            elif 15 in field_images and 13 not in field_images:
-                                if 13 not in field_images:
-                                    field_images[13] = []
-                                field_images[13].append(rel_path)
-                                print(f"[process_zip_file] Added to field_images[13] (15 already filled): {img_file}")
-                            elif 13 in field_images and 15 not in field_images:
-                                if 15 not in field_images:
-                                    field_images[15] = []
-                                field_images[15].append(rel_path)
-                                print(f"[process_zip_file] Added to field_images[15] (13 already filled): {img_file}")
-                    
-                    if save_photos:
-                        os.makedirs(person_img_dir, exist_ok=True)
-                        if os.path.exists(t3_preview_dir):
-                            for img_file in os.listdir(t3_preview_dir):
-                                src_path = os.path.join(t3_preview_dir, img_file)
-                                dst_path = os.path.join(person_img_dir, f"type3_{img_file}")
-                                shutil.copy2(src_path, dst_path)
-                    
-                    found_t3 = True
-                    used_type_3.add(t3_path)
-                    break 
-                if found_t3: break
-            
-            if not found_t3:
-                row_data['errors'].append("Не найден файл СНТ (Накладная) для этого водителя.")
-                print(f"[process_zip_file] Warning: no Type3 (СНТ) match for surname {surname_clean} in object {len(final_results)}")
-        else:
-            print(f"[process_zip_file] Surname not found or empty ('{surname_clean}'), skipping ESF/SNT matching.")
+    # Открытые PDF и отрендеренные страницы задачи: этапы последовательного режима и Force Match.
+    # В пул процессов кэш не передается (открытые документы не переносятся между процессами):
+    # функции этапов получают doc_cache=None и заводят кэш на свой документ
+    doc_cache = DocumentCache()
+
+    # Этап 1 - основные документы водителей (OCR), этап 2 - общее сопоставление ЭСФ/СНТ по фамилиям,
+    # этап 3 - поля назначенных ЭСФ/СНТ и расчет сумм. Этапы 1 и 3 выполняются в пуле процессов, если он включен;
+    # без пула страницы следующих документов рендерятся в потоках, пока идет OCR текущего (pipeline.PagePrefetcher).
+    # stage_documents - [(pdf_path, ключ шаблона)] каждой задачи для рендера заранее
+    def run_stage(executor, func, tasks, step_offset, message, stage_documents):
+        results = [None] * len(tasks)
+        if executor is None:
+            prefetcher = PagePrefetcher(doc_cache, stage_documents, metrics) if prefetch_enabled() else nullcontext()
+            with prefetcher as pipeline:
+                for i, args in enumerate(tasks):
+                    report_progress(step_offset + i, f"{message}: {i + 1} из {len(tasks)}")
+                    if pipeline is not None:
+                        pipeline.take(i)
+                    results[i] = func(*args, doc_cache=doc_cache)
+            return results
+        futures = {executor.submit(func, *args, doc_cache=None): i for i, args in enumerate(tasks)}
+        for done_count, future in enumerate(as_completed(futures), start=1):
+            results[futures[future]] = future.result()
+            report_progress(step_offset + done_count, f"{message}: {done_count} из {len(tasks)}")
+        return results
+
+    parallel_workers = min(get_parallel_workers(), len(type_1_files))
+    if parallel_workers > 1:
+        print(f"[process_zip_file] Parallel mode: {parallel_workers} worker process(es) for {len(type_1_files)} document(s)")
+        pool = create_ocr_process_pool(parallel_workers)
+    else:
+        pool = nullcontext()
+
+    with pool as executor:
+        drivers = run_stage(
+            executor, extract_driver_document,
+            [(obj_idx, t1_path, job_ctx) for obj_idx, t1_path in enumerate(type_1_files)],
+            0, "Обработка основных документов",
+            [[(t1_path, "t1")] for t1_path in type_1_files]
+        )
 
-        try:
-            kol_ton = safe_decimal(row_data[7], "Кол.тон (7)")
-            kol_ton = kol_ton / Decimal("1000")
-            row_data[7] = kol_ton
-            
-            cena = safe_decimal(row_data[8], "Цена (8)")
-            row_data[8] = cena
-            
-            sum_dollar = (kol_ton * cena).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-            row_data[9] = sum_dollar
-            
-            sum_som = (sum_dollar * dollar_rate).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-            row_data[11] = sum_som
-            
-            nds_percent_value = nds_percent if isinstance(nds_percent, Decimal) else Decimal(str(nds_percent))
-            nds_sum = (sum_som * nds_percent_value / Decimal("100")).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-            row_data[12] = nds_sum
-            
-            if found_t3 and not row_data.get(15):
-                row_data['errors'].append("Не удалось найти '№ сопров.накл. KZ'. Проверьте файл СНТ.")
-            if found_t2 and not row_data.get(16):
-                row_data['errors'].append("Не удалось найти '№ счет факт'. Проверьте файл ЭСФ.")
-            if found_t3 and not row_data.get(13):
-                row_data['errors'].append("Не удалось найти 'Дата сопр.накл'. Проверьте файл СНТ.")
-            
-        except Exception as e:
-            print(f"[process_zip_file] Calculation error for object {len(final_results)}: {e}")
+        report_progress(len(type_1_files), "Сопоставление документов")
+        surnames = {
+            driver['obj_idx']: driver['surname'] for driver in drivers
+            if driver['surname'] and driver['surname'] != "Unknown"
+        }
+        t2_matches = SurnameMatcher(type_2_files).assign(surnames)
+        t3_matches = SurnameMatcher(type_3_files).assign(surnames)
+        for driver in drivers:
+            for label, matches in (("ЭСФ", t2_matches), ("СНТ", t3_matches)):
+                match = matches.get(driver['obj_idx'])
+                if match is None:
+                    continue
+                print(f" [MATCH] {label} for '{driver['surname']}': {os.path.basename(match.path)} (score {match.score:.2f})")
+                if match.alternatives:
+                    others = ", ".join(os.path.basename(path) for path, _ in match.alternatives)
+                    driver['row_data']['warnings'].append(
+                        f"Неоднозначное сопоставление {label}: выбран {os.path.basename(match.path)}, подходят также {others}. Проверьте файл."
+                    )
+        used_type_2 = {match.path for match in t2_matches.values()}
+        used_type_3 = {match.path for match in t3_matches.values()}
+
+        linked_tasks = [
+            (driver, getattr(t2_matches.get(driver['obj_idx']), 'path', None),
+             getattr(t3_matches.get(driver['obj_idx']), 'path', None), job_ctx)
+            for driver in drivers
+        ]
+        driver_results = run_stage(
+            executor, attach_linked_documents, linked_tasks,
+            len(type_1_files), "Обработка ЭСФ/СНТ",
+            # ЭСФ/СНТ водителя без фамилии не читаются (см. _attach_linked_documents)
+            [
+                [(t2_path, "t2"), (t3_path, "t3")]
+                if driver['surname'] and driver['surname'] != "Unknown" else []
+                for driver, t2_path, t3_path, _ in linked_tasks
+            ]
+        )
 
+    # Слияние в исходном порядке документов
+    for row_data, doc_metrics in driver_results:
+        metrics.merge(doc_metrics)
         final_results.append(row_data)
 
+    report_progress(2 * len(type_1_files), "Проверка сопоставления")
+
     unused_t2 = len(type_2_files) - len(used_type_2)
     unused_t3 = len(type_3_files) - len(used_type_3)
 
@@ -1250,32 +1581,18 @@ def process_zip_file(zip_file, dollar_rate, selected_date, tn_ved_code, bnd_code
         os.makedirs(t3_preview_dir, exist_ok=True)
 
         # 1. Extract ESF (Type 2)
-        t2_data = extract_text_from_pdf(leftover_t2, FIELDS_MAP_TYPE_2, t2_preview_dir)
-        
-        price_raw = t2_data.get("Цена (8)")
-        price_val_str = DataCleaner.clean_8(price_raw, context)
-        check_price = safe_decimal(price_val_str, "Check Price")
-        
-        if check_price == Decimal("7") or check_price <= Decimal("1"):
-            print(f" [Force Match] checking 2nd page of ESF... (Price={check_price})")
-            t2_data_p2 = extract_text_from_pdf(leftover_t2, FIELDS_MAP_TYPE_2_PAGE_2, t2_preview_dir, page_num=1)
-            price_alt_raw = t2_data_p2.get("Цена (8) Alt")
-            if price_alt_raw:
-                t2_data["Цена (8)"] = price_alt_raw
-
-        row_data[8] = DataCleaner.clean_8(t2_data.get("Цена (8)"), context)
-        row_data[16] = DataCleaner.clean_16(t2_data.get("№ счет факт (Инвойс) (16)"), context)
+        _, t2_columns = extract_document(leftover_t2, get_template("t2"), t2_preview_dir, context, metrics=metrics, doc_cache=doc_cache)
+        row_data.update(t2_columns)
         used_type_2.add(leftover_t2)
 
         # 2. Extract SNT (Type 3)
-        t3_data = extract_text_from_pdf(leftover_t3, FIELDS_MAP_TYPE_3, t3_preview_dir)
-        row_data[15] = DataCleaner.clean_15(t3_data.get("№ сопров.накл. KZ (15)"), context)
-        date_sopr = DataCleaner.clean_1(t3_data.get("Дата сопр.накл (13)"), context)
-        row_data[13] = date_sopr
+        _, t3_columns = extract_document(leftover_t3, get_template("t3"), t3_preview_dir, context, metrics=metrics, doc_cache=doc_cache)
+        row_data.update(t3_columns)
         used_type_3.add(leftover_t3)
         
         # 3. Update Images in row_data
         def scan_and_add_images(scan_dir, r_data):
+            get_image_writer().flush(scan_dir)
             if os.path.exists(scan_dir):
                 for img_file in os.listdir(scan_dir):
                     img_path = os.path.join(scan_dir, img_file)
@@ -1360,6 +1677,9 @@ def process_zip_file(zip_file, dollar_rate, selected_date, tn_ved_code, bnd_code
         unused_t2 = 0
         unused_t3 = 0
 
+    doc_cache.close()
+    add_doc_cache_metrics(metrics, doc_cache)
+
     if unused_t2 > 0 or unused_t3 > 0:
         print(f"[process_zip_file] Unused files: unused_t2={unused_t2}, unused_t3={unused_t3}")
         
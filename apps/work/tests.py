@@ -1,3 +1,1272 @@
-from django.test import TestCase
+import contextlib
+import io
+import os
+import runpy
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import Future
+from datetime import date, timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+import cv2
+import fitz
+import numpy as np
+import openpyxl
+import requests
+from PIL import Image
+from django.contrib.auth import get_user_model
+from django.core.files import File
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.conf import settings
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from . import anchors, jobs, manifest, ocr, ocr_cache, pipeline, rates, services, views
+from .documents import FieldSpec, get_registry, get_template
+from .excel_export import AppendNotSupported, append_to_workbook, excel_response, write_new_workbook
+from .image_writer import ImageWriter
+from .ingest import ArchiveError, ZipIngestor, safe_relpath
+from .management.commands.benchmark import legacy_deskew_image
+from .matching import RANK_FUZZY, RANK_SUBSTRING, RANK_WORD, SurnameMatcher
+from .metrics import PipelineMetrics
+from .models import ExchangeRate, PreviewRow, ProcessingJob
+from .ocr_cache import OCRResultCache, file_sha256
+from .pdf_cache import DocumentCache
+from .results import PreviewStore, serialize_row
+from .workspace import JobWorkspace
+
+
+def dead_pid():
+    """pid только что завершившегося процесса."""
+    proc = subprocess.Popen([sys.executable, "-c", "pass"])
+    proc.wait()
+    return proc.pid
+
+
+class JobQueueTests(TestCase):
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=self.media.name, OCR_JOBS_EAGER=True)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.user = get_user_model().objects.create_user("operator", password="x")
+
+    def enqueue(self):
+        upload = SimpleUploadedFile("batch.zip", b"PK\x05\x06" + b"\x00" * 18)
+        return jobs.enqueue_job(self.user, upload, {'dollar_rate': '87.5', 'nds_percent': '12'})
+
+    def running_job(self, worker, heartbeat_at, attempts=1):
+        return ProcessingJob.objects.create(
+            user=self.user, zip_filename="batch.zip", status=ProcessingJob.STATUS_RUNNING,
+            worker=worker, heartbeat_at=heartbeat_at, attempts=attempts,
+        )
+
+    def test_eager_queue_runs_job_and_reports_progress(self):
+        seen = []
+
+        def fake_process(zip_file, progress_callback=None, **kwargs):
+            progress_callback(1, 2, "Водитель 1")
+            job = ProcessingJob.objects.get()
+            seen.append((job.status, job.progress_current, job.progress_total, job.progress_message, job.worker))
+            return [{1: '01.02.2025', 'errors': [], 'preview_images': []}]
+
+        with mock.patch.object(jobs, 'process_zip_file', side_effect=fake_process):
+            job = self.enqueue()
+
+        job.refresh_from_db()
+        self.assertEqual(seen, [(ProcessingJob.STATUS_RUNNING, 1, 2, "Водитель 1", jobs.current_worker())])
+        self.assertEqual(job.status, ProcessingJob.STATUS_DONE)
+        self.assertEqual(job.result, [{'1': '01.02.2025', 'errors': [], 'preview_images': []}])
+        self.assertEqual((job.progress_current, job.progress_total), (1, 1))
+        self.assertEqual(job.attempts, 1)
+        self.assertTrue(os.path.exists(job.zip_path))
+
+    def test_failed_job_records_error(self):
+        with mock.patch.object(jobs, 'process_zip_file', side_effect=ValueError("архив поврежден")):
+            job = self.enqueue()
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, ProcessingJob.STATUS_FAILED)
+        self.assertEqual(job.error, "архив поврежден")
+        self.assertIsNotNone(job.finished_at)
+
+    def test_claimed_job_is_not_run_twice(self):
+        with mock.patch.object(jobs, 'process_zip_file', return_value=[]) as process:
+            job = self.enqueue()
+            jobs.run_job(job.id)
+        self.assertEqual(process.call_count, 1)
+
+    def test_recover_requeues_job_of_dead_worker(self):
+        job = self.running_job(f"{socket.gethostname()}:{dead_pid()}:test", timezone.now())
+        with mock.patch.object(jobs, 'run_job') as run_job:
+            jobs.JobQueue(eager=True).recover()
+        job.refresh_from_db()
+        self.assertEqual(job.status, ProcessingJob.STATUS_PENDING)
+        run_job.assert_called_once_with(job.id)
+
+    def test_recover_keeps_slow_job_of_live_worker(self):
+        # Другой живой воркер (здесь - родительский процесс) с недавним пульсом
+        job = self.running_job(f"{socket.gethostname()}:{os.getppid()}:test", timezone.now() - timedelta(seconds=5))
+        remote = self.running_job("other-host:123:test", timezone.now())
+        with mock.patch.object(jobs, 'run_job') as run_job:
+            jobs.JobQueue(eager=True).recover()
+        job.refresh_from_db()
+        remote.refresh_from_db()
+        self.assertEqual(job.status, ProcessingJob.STATUS_RUNNING)
+        self.assertEqual(remote.status, ProcessingJob.STATUS_RUNNING)
+        run_job.assert_not_called()
+
+    @override_settings(OCR_JOB_STALE_SECONDS=60)
+    def test_recover_requeues_job_without_heartbeat(self):
+        job = self.running_job("other-host:123:test", timezone.now() - timedelta(seconds=61))
+        with mock.patch.object(jobs, 'run_job'):
+            jobs.JobQueue(eager=True).recover()
+        job.refresh_from_db()
+        self.assertEqual(job.status, ProcessingJob.STATUS_PENDING)
+
+    @override_settings(OCR_JOB_MAX_ATTEMPTS=2)
+    def test_recover_fails_job_after_max_attempts(self):
+        job = self.running_job(f"{socket.gethostname()}:{dead_pid()}:test", timezone.now(), attempts=2)
+        with mock.patch.object(jobs, 'run_job') as run_job:
+            jobs.JobQueue(eager=True).recover()
+        job.refresh_from_db()
+        self.assertEqual(job.status, ProcessingJob.STATUS_FAILED)
+        run_job.assert_not_called()
+
+    def test_worker_start_recovers_jobs_without_request(self):
+        # Как при перезапуске gunicorn: задача умершего воркера и ожидающая задача, запросов к приложению нет
+        orphan = self.running_job(f"{socket.gethostname()}:{dead_pid()}:test", timezone.now())
+        pending = ProcessingJob.objects.create(user=self.user, zip_filename="batch.zip")
+        gunicorn_conf = runpy.run_path(os.path.join(settings.BASE_DIR, "config", "gunicorn.conf.py"))
+        with mock.patch.object(jobs, '_job_queue', None), mock.patch.object(jobs, 'run_job') as run_job:
+            gunicorn_conf['post_worker_init'](mock.Mock(pid=os.getpid()))
+        orphan.refresh_from_db()
+        self.assertEqual(orphan.status, ProcessingJob.STATUS_PENDING)
+        self.assertEqual([c.args[0] for c in run_job.call_args_list], [orphan.id, pending.id])
+
+    def test_heartbeat_touches_only_own_jobs(self):
+        old = timezone.now() - timedelta(minutes=10)
+        own = self.running_job(jobs.current_worker(), old)
+        other = self.running_job("other-host:123:test", old)
+        jobs.JobQueue(eager=True).heartbeat()
+        own.refresh_from_db()
+        other.refresh_from_db()
+        self.assertGreater(own.heartbeat_at, old)
+        self.assertEqual(other.heartbeat_at, old)
+
+
+class JobResultViewTests(TestCase):
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=self.media.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.user = get_user_model().objects.create_user("operator", password="x")
+        self.client.force_login(self.user)
+
+    def open_result(self, row):
+        job = ProcessingJob.objects.create(
+            user=self.user, zip_filename="batch.zip", status=ProcessingJob.STATUS_DONE,
+            result=[dict({'4': 'Иванов', 'preview_images': [], 'errors': [], 'warnings': []}, **row)],
+        )
+        return self.client.get(reverse('job_result', kwargs={'job_id': job.id}))
+
+    def test_warnings_do_not_block_preview(self):
+        response = self.open_result({'warnings': ["Неоднозначное сопоставление ЭСФ"]})
+        self.assertRedirects(response, reverse('preview'), fetch_redirect_response=False)
+
+    def test_errors_return_to_upload(self):
+        response = self.open_result({'errors': ["Не найден файл ЭСФ (Счет-фактура) для этого водителя."]})
+        self.assertRedirects(response, reverse('upload'), fetch_redirect_response=False)
+
+
+def sheet_cells(fileobj):
+    """Строки активного листа: [(значение, формат числа, цвет заливки)] по ячейкам."""
+    fileobj.seek(0)
+    ws = openpyxl.load_workbook(fileobj).active
+    return [
+        [(c.value, c.number_format, c.fill.fgColor.rgb if c.fill.fill_type else None) for c in row]
+        for row in ws.iter_rows()
+    ]
+
+
+class ExcelExportTests(TestCase):
+    ROWS = [
+        {1: '12.05.2025', 2: 'DAF', 3: '01KG123ABC', 4: 'Иванов И.', 5: '27132000', 6: '60/90', 7: Decimal('20.5'),
+         8: Decimal('186'), 10: Decimal('87.45'), 13: '13.05.2025', 14: '3', 15: 'KZ1', 16: 'F1', 'errors': []},
+        {1: 'нет даты', 2: None, 3: '', 4: 'Петров', 5: 'x', 6: '', 7: Decimal('1'), 8: None,
+         10: Decimal('87.45'), 13: None, 14: '12', 15: None, 16: 'F2'},
+    ]
+
+    def existing(self, numbered, auto_filter=False):
+        wb = openpyxl.Workbook()
+        ws = wb.active
+        ws.append((["№"] if numbered else []) + ["Дата", "Марка АТС"])
+        for number in (1, 2, 7):
+            ws.append(([number] if numbered else []) + ["01.01.2025", "MAN"])
+        if auto_filter:
+            ws.auto_filter.ref = ws.dimensions
+        fileobj = io.BytesIO()
+        wb.save(fileobj)
+        fileobj.seek(0)
+        return fileobj
+
+    def test_append_matches_generate_excel(self):
+        for numbered in (True, False):
+            streamed = io.BytesIO()
+            append_to_workbook(self.ROWS, self.existing(numbered), streamed, nds_percent=12)
+            reference = io.BytesIO()
+            services.generate_excel(self.ROWS, self.existing(numbered), nds_percent=12).save(reference)
+
+            got, expected = sheet_cells(streamed), sheet_cells(reference)
+            self.assertEqual(len(got), len(expected))
+            # Новые строки совпадают целиком, у старых - только значения (append их не переформатирует)
+            self.assertEqual(got[-2:], expected[-2:])
+            self.assertEqual([[c[0] for c in row] for row in got], [[c[0] for c in row] for row in expected])
+            if numbered:
+                self.assertEqual([row[0][0] for row in got[-2:]], [8, 9])
+
+    def test_auto_filter_falls_back_to_openpyxl(self):
+        with self.assertRaises(AppendNotSupported):
+            append_to_workbook(self.ROWS, self.existing(True, auto_filter=True), io.BytesIO())
+        response = excel_response(self.ROWS, self.existing(True, auto_filter=True), nds_percent=12)
+        content = io.BytesIO(b"".join(response.streaming_content))
+        response.close()
+        self.assertIsNone(openpyxl.load_workbook(content).active.auto_filter.ref)
+        reference = io.BytesIO()
+        services.generate_excel(self.ROWS, self.existing(True, auto_filter=True), nds_percent=12).save(reference)
+        self.assertEqual(sheet_cells(content), sheet_cells(reference))
+
+    def test_new_workbook_matches_generate_excel(self):
+        streamed = io.BytesIO()
+        write_new_workbook(self.ROWS, streamed, nds_percent=12)
+        reference = io.BytesIO()
+        services.generate_excel(self.ROWS, nds_percent=12).save(reference)
+        self.assertEqual(sheet_cells(streamed), sheet_cells(reference))
+
+
+class ZipIngestorTests(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.out = os.path.join(self.tmp.name, "out")
+
+    def make_zip(self, members, compression=zipfile.ZIP_DEFLATED):
+        path = os.path.join(self.tmp.name, "batch.zip")
+        with zipfile.ZipFile(path, "w", compression) as zf:
+            for name, data in members:
+                zf.writestr(name, data)
+        return path
+
+    def extracted(self):
+        found = []
+        for root, _, files in os.walk(self.out):
+            found.extend(os.path.relpath(os.path.join(root, f), self.out) for f in files)
+        return sorted(found)
+
+    def test_safe_relpath(self):
+        self.assertEqual(safe_relpath("./batch//Водители/1.pdf"), os.path.join("batch", "Водители", "1.pdf"))
+        self.assertEqual(safe_relpath("batch\\1.pdf"), os.path.join("batch", "1.pdf"))
+        for name in ("../1.pdf", "batch/../../1.pdf", "C:/1.pdf", "batch\\..\\1.pdf", "", "./"):
+            self.assertIsNone(safe_relpath(name), name)
+
+    def test_extracts_only_documents(self):
+        path = self.make_zip([
+            ("batch/1.pdf", b"%PDF t1"), ("batch/ЭСФ Иванов.pdf", b"%PDF t2"), ("batch/снт Иванов.pdf", b"%PDF t3"),
+            ("batch/readme.txt", b"x"), ("__MACOSX/batch/._1.pdf", b"x"), ("../2.pdf", b"%PDF escape"),
+        ])
+        files = ZipIngestor().ingest(path, self.out)
+        self.assertEqual({key: [os.path.relpath(p, self.out) for p in paths] for key, paths in files.items()}, {
+            "t1": [os.path.join("batch", "1.pdf")],
+            "t2": [os.path.join("batch", "ЭСФ Иванов.pdf")],
+            "t3": [os.path.join("batch", "снт Иванов.pdf")],
+        })
+        self.assertEqual(len(self.extracted()), 3)
+
+    def test_member_count_limit(self):
+        path = self.make_zip([(f"{i}.pdf", b"%PDF") for i in range(3)])
+        with self.assertRaisesRegex(ArchiveError, "слишком много файлов"):
+            ZipIngestor(max_members=2).ingest(path, self.out)
+
+    def test_member_and_total_size_limits_remove_partial_file(self):
+        path = self.make_zip([("1.pdf", b"1" * 3000), ("2.pdf", b"2" * 3000)], compression=zipfile.ZIP_STORED)
+        with self.assertRaisesRegex(ArchiveError, "слишком большой"):
+            ZipIngestor(max_member_bytes=2000).ingest(path, self.out)
+        self.assertEqual(self.extracted(), [])
+        with self.assertRaisesRegex(ArchiveError, "Архив после распаковки больше"):
+            ZipIngestor(max_total_bytes=5000).ingest(path, self.out)
+        self.assertEqual(self.extracted(), ["1.pdf"])
+
+    def test_compression_ratio_limit(self):
+        path = self.make_zip([("1.pdf", b"\0" * (3 * 1024 * 1024))])
+        with self.assertRaisesRegex(ArchiveError, "zip-бомба"):
+            ZipIngestor(max_ratio=10).ingest(path, self.out)
+        self.assertEqual(self.extracted(), [])
+
+    def test_not_a_zip(self):
+        with self.assertRaisesRegex(ArchiveError, "не является ZIP-архивом"):
+            ZipIngestor().ingest(SimpleUploadedFile("batch.zip", b"not a zip"), self.out)
+
+
+class PreviewStoreTests(TestCase):
+    def setUp(self):
+        user = get_user_model().objects.create_user("operator", password="x")
+        self.job, self.other_job = (
+            ProcessingJob.objects.create(user=user, zip_filename="batch.zip", status=ProcessingJob.STATUS_DONE)
+            for _ in range(2)
+        )
+        self.store = PreviewStore(self.job.id, chunk_size=2)
+        self.store.reset([{'4': f"Водитель {i}"} for i in range(5)])
+        PreviewStore(self.other_job.id).reset([{'4': "Другая задача"}])
+
+    def test_serialize_row(self):
+        row = {1: '12.05.2025', 7: Decimal('20.5'), 'field_images': {2: ['a.png']}, 'sources': {1: 'xlsx'},
+               'errors': ['e'], 'warnings': ['w'], 'preview_images': ['p.png']}
+        self.assertEqual(serialize_row(row), {
+            '1': '12.05.2025', '7': '20.5', 'field_images': {'2': ['a.png']}, 'sources': {'1': 'xlsx'},
+            'errors': ['e'], 'warnings': ['w'], 'preview_images': ['p.png'],
+        })
+
+    def test_reads_only_own_rows_in_order(self):
+        self.assertTrue(self.store.exists())
+        self.assertEqual(self.store.count(), 5)
+        self.assertEqual([idx for idx, _ in self.store.rows(1, 3)], [1, 2])
+        self.assertEqual(self.store.get([4, 0, 9]), {0: {'4': "Водитель 0"}, 4: {'4': "Водитель 4"}})
+        # iter_rows читает порциями по chunk_size и не теряет строки на границах порций
+        self.assertEqual([row['4'] for _, row in self.store.iter_rows()], [f"Водитель {i}" for i in range(5)])
+
+    def test_page_clamps_number(self):
+        page = self.store.page(99, per_page=2)
+        self.assertEqual(page.number, 3)
+        self.assertEqual([idx for idx, _ in page], [4])
+
+    def test_update_saves_only_changed_rows(self):
+        before = dict(PreviewRow.objects.filter(job=self.job).values_list('index', 'updated_at'))
+        self.assertEqual(self.store.update({1: {'4': "Исправлено"}, 7: {'4': "Нет такой строки"}}), 1)
+        after = dict(PreviewRow.objects.filter(job=self.job).values_list('index', 'updated_at'))
+        self.assertEqual(self.store.get([1]), {1: {'4': "Исправлено"}})
+        self.assertEqual([idx for idx in after if after[idx] != before[idx]], [1])
+
+    def test_reset_and_clear(self):
+        self.store.reset([{'4': "Новая"}])
+        self.assertEqual(self.store.rows(), [(0, {'4': "Новая"})])
+        self.store.clear()
+        self.assertFalse(self.store.exists())
+        self.assertEqual(PreviewStore(self.other_job.id).count(), 1)
+
+
+class PreviewViewTests(TestCase):
+    # Строка в виде после перерасчета: 20.5 т * 186 $, курс 87.45, НДС 12%
+    ROW = {
+        '1': '12.05.2025', '2': 'DAF', '3': '01KG123ABC', '4': 'Иванов И.', '5': '27132000', '6': '60/90',
+        '7': '20.5', '8': '186', '9': '3813.00', '10': '87.45', '11': '333446.85', '12': '40013.62',
+        '13': '13.05.2025', '14': '3', '15': 'KZ1', '16': 'F1', 'preview_images': [], 'errors': [], 'warnings': [],
+    }
+
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=self.media.name, PREVIEW_PAGE_SIZE=2)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        rate_service = mock.Mock()
+        rate_service.lookup.return_value = rates.RateLookup(Decimal('87.45'))
+        patcher = mock.patch.object(views, 'get_rate_service', return_value=rate_service)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.user = get_user_model().objects.create_user("operator", password="x")
+        self.client.force_login(self.user)
+        self.job = ProcessingJob.objects.create(
+            user=self.user, zip_filename="batch.zip", status=ProcessingJob.STATUS_DONE,
+            params={'dollar_rate': '87.45', 'nds_percent': '12'},
+        )
+        self.store = PreviewStore(self.job.id)
+        self.store.reset([dict(self.ROW, **{'4': f"Водитель {i}"}) for i in range(5)])
+        session = self.client.session
+        session['preview_data'] = {'job_id': str(self.job.id)}
+        session.save()
+
+    def row_fields(self, index, **changes):
+        """POST-поля строки index со значениями из ROW (как их отправляет страница)."""
+        fields = {
+            'date': '2025-05-12', 'marka': 'DAF', 'gos_number': '01KG123ABC', 'fio': f"Водитель {index}",
+            'kol_ton': '20.5', 'price': '186', 'date_sopr': '13.05.2025', 'num_sopr': 'KZ1', 'invoice': 'F1',
+        }
+        fields.update(changes)
+        return {f'obj_{index}_{name}': value for name, value in fields.items()}
+
+    def saved_rows(self):
+        return {row.index: (row.data, row.updated_at) for row in PreviewRow.objects.filter(job=self.job)}
+
+    def post_row(self, index, data):
+        return self.client.post(reverse('preview_row', kwargs={'index': index}), data)
+
+    def test_get_row(self):
+        response = self.client.get(reverse('preview_row', kwargs={'index': 1}))
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual((data['index'], data['saved']), (1, False))
+        self.assertIn("Водитель 1", data['html'])
+
+    def test_post_saves_only_changed_row(self):
+        before = self.saved_rows()
+        response = self.post_row(1, self.row_fields(1, fio="Петров П.", kol_ton='10'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()['saved'])
+        after = self.saved_rows()
+        self.assertEqual(after[1][0], dict(self.ROW, **{
+            '4': "Петров П.", '7': '10', '9': '1860.00', '11': '162657.00', '12': '19518.84',
+        }))
+        self.assertEqual([idx for idx in after if after[idx] != before[idx]], [1])
+
+    def test_post_without_changes_does_not_write(self):
+        before = self.saved_rows()
+        response = self.post_row(1, self.row_fields(1))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.json()['saved'])
+        self.assertEqual(self.saved_rows(), before)
+
+    def test_invalid_form_returns_field_errors(self):
+        before = self.saved_rows()
+        response = self.post_row(1, self.row_fields(1, price='не число'))
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('obj_1_price', response.json()['fields'])
+        self.assertEqual(self.saved_rows(), before)
+
+    def test_unknown_row_returns_404(self):
+        self.assertEqual(self.client.get(reverse('preview_row', kwargs={'index': 5})).status_code, 404)
+        self.assertEqual(self.post_row(99, self.row_fields(99)).status_code, 404)
+
+    def test_preview_page_past_last(self):
+        response = self.client.get(reverse('preview'), {'page': 99})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['page_obj'].number, 3)
+        self.assertEqual([obj['index'] for obj in response.context['objects']], [4])
+
+    def test_recalculate_keeps_untouched_rows(self):
+        before = self.saved_rows()
+        data = dict(self.row_fields(2, fio="Сидоров С."), **self.row_fields(3), action='recalculate', page='2')
+        self.assertEqual(views.posted_row_indexes(data), {2, 3})
+        response = self.client.post(reverse('preview_submit'), data)
+        self.assertRedirects(response, f"{reverse('preview')}?page=2", fetch_redirect_response=False)
+        after = self.saved_rows()
+        self.assertEqual(after[2][0]['4'], "Сидоров С.")
+        # Строка 3 пришла в форме без изменений, остальные не отправлялись - ни одна не перезаписана
+        self.assertEqual([idx for idx in after if after[idx] != before[idx]], [2])
+
+
+class ManifestTests(TestCase):
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+        self.workspace = JobWorkspace("job", base_dir=os.path.join(self.media.name, "temp_ocr")).create()
+        for name, data in (("page.png", b"png"), ("fio.png", b"fio"), ("empty.png", b"")):
+            with open(os.path.join(self.workspace.preview_imgs_dir, name), "wb") as fh:
+                fh.write(data)
+        rel = os.path.relpath(self.workspace.preview_imgs_dir, self.media.name)
+        self.page, self.fio, self.empty, self.missing = (
+            os.path.join(rel, name) for name in ("page.png", "fio.png", "empty.png", "gone.png")
+        )
+        self.rows = [
+            {'preview_images': [self.page, self.missing], 'field_images': {'4': [self.fio, self.empty]}},
+            {'preview_images': [self.fio], 'field_images': {}},
+        ]
+
+    def test_build_keeps_existing_nonempty_images(self):
+        built = manifest.build_manifest(self.rows, self.media.name)
+        self.assertEqual(built.entries, {
+            self.page: {'size': 3, 'row': 0, 'field': None},
+            self.fio: {'size': 3, 'row': 0, 'field': 4},
+        })
+        self.assertEqual(built.filter([self.missing, self.fio, self.empty]), [self.fio])
+
+    def test_write_then_load_uses_process_cache_until_file_changes(self):
+        written = manifest.write_manifest(self.workspace, self.rows, self.media.name)
+        loaded = manifest.load_manifest(self.workspace)
+        self.assertEqual(loaded.entries, written.entries)
+        self.assertIs(manifest.load_manifest(self.workspace), loaded)
+
+        path = self.workspace.path(manifest.MANIFEST_NAME)
+        manifest.write_manifest(self.workspace, self.rows[1:], self.media.name)
+        os.utime(path, ns=(time.time_ns(), os.stat(path).st_mtime_ns + 1_000_000))
+        self.assertEqual(list(manifest.load_manifest(self.workspace).entries), [self.fio])
+
+        with open(path, "w", encoding="utf-8") as fh:
+            fh.write("{broken")
+        self.assertIsNone(manifest.load_manifest(self.workspace))
+        os.remove(path)
+        self.assertIsNone(manifest.load_manifest(self.workspace))
+
+    def test_ensure_builds_missing_manifest_only_for_existing_workspace(self):
+        self.assertEqual(len(manifest.ensure_manifest(self.workspace, self.rows, self.media.name)), 2)
+        self.assertTrue(os.path.exists(self.workspace.path(manifest.MANIFEST_NAME)))
+        removed = JobWorkspace("removed", base_dir=self.workspace.base_dir)
+        self.assertIsNone(manifest.ensure_manifest(removed, self.rows, self.media.name))
+        self.assertFalse(removed.exists())
+
+
+class SurnameMatcherTests(TestCase):
+    def matcher(self, *names):
+        return SurnameMatcher([f"/batch/{name}" for name in names])
+
+    def test_candidates_ranked_word_substring_fuzzy(self):
+        matcher = self.matcher("Иваноф.pdf", "Ивановский.pdf", "ЭСФ Иванов.pdf", "Петров.pdf")
+        self.assertEqual(
+            [(idx, rank) for idx, rank, _ in matcher.candidates("Иванов")],
+            [(2, RANK_WORD), (1, RANK_SUBSTRING), (0, RANK_FUZZY)],
+        )
+
+    def test_each_file_goes_to_one_driver_best_pairs_first(self):
+        matcher = self.matcher("Иванов.pdf", "Ивановский.pdf")
+        matches = matcher.assign({1: "Ивановский", 2: "Иванов"})
+        self.assertEqual(matches[1].path, "/batch/Ивановский.pdf")
+        self.assertEqual(matches[2].path, "/batch/Иванов.pdf")
+        self.assertEqual(matches[2].rank, RANK_WORD)
+
+    def test_equal_files_of_one_driver_are_alternatives(self):
+        matches = self.matcher("ЭСФ Иванов 1.pdf", "ЭСФ Иванов 2.pdf").assign({1: "Иванов"})
+        self.assertEqual(matches[1].path, "/batch/ЭСФ Иванов 1.pdf")
+        self.assertEqual(matches[1].alternatives, [("/batch/ЭСФ Иванов 2.pdf", 1.0)])
+
+    def test_files_assigned_to_namesakes_are_not_alternatives(self):
+        matches = self.matcher("ЭСФ Иванов 1.pdf", "ЭСФ Иванов 2.pdf").assign({1: "Иванов", 2: "Иванов"})
+        self.assertEqual({m.path for m in matches.values()}, {"/batch/ЭСФ Иванов 1.pdf", "/batch/ЭСФ Иванов 2.pdf"})
+        self.assertEqual([m.alternatives for m in matches.values()], [[], []])
+
+
+def rates_page(*rows):
+    """Страница НБКР с выбранным долларом и строками (дата 'ДД.ММ.ГГГГ', курс '87,4567')."""
+    trs = "".join(f'<tr><td>{day}</td><td class="stat-right">{rate}</td></tr>' for day, rate in rows)
+    return f'<select><option selected="" value="15">1 Доллар США</option></select><table>{trs}</table>'
+
+
+class StubRateClient:
+    """Клиент НБКР без сети: отдает html и считает обращения."""
+
+    def __init__(self, html):
+        self.html = html
+        self.calls = 0
+
+    def fetch(self, timeout=None):
+        self.calls += 1
+        return self.html
+
+
+class RateParsingTests(TestCase):
+    def setUp(self):
+        with open(settings.BASE_DIR / "tests" / "fixtures" / "nbkr_rates.html", encoding="utf-8") as fh:
+            self.html = fh.read()
+
+    def test_saved_page_rows(self):
+        rows = rates.parse_rate_rows(self.html)
+        self.assertEqual(len(rows), 365)
+        self.assertEqual(rows[0], rates.RateRow(date(2025, 10, 17), Decimal("87.45")))
+        self.assertEqual(rows[1], rates.RateRow(date(2025, 10, 16), Decimal("87.48")))
+        self.assertEqual(rows[-1], rates.RateRow(date(2024, 10, 18), Decimal("86.85")))
+        self.assertEqual(len({row.date for row in rows}), 365)
+
+    def test_daily_rates_block_is_not_a_usd_row(self):
+        # Блок "Официальные курсы" (USD, EUR, RUB, KZT) без даты в строке в таблицу курсов доллара не попадает
+        self.assertIn('<td class="exrate-code">RUB</td>', self.html)
+        parsed = rates.parse_rates(self.html)
+        self.assertFalse({Decimal("1.07"), Decimal("0.16"), Decimal("101.61")} & set(parsed.values()))
+        self.assertEqual(parsed[date(2025, 10, 17)], Decimal("87.45"))
+
+    def test_page_without_selected_dollar(self):
+        html = self.html.replace('<option selected="" value="15">', '<option value="15">')
+        with self.assertRaises(Exception):
+            rates.parse_rate_rows(html)
+
+
+class RateServiceTests(TestCase):
+    def setUp(self):
+        self.client_stub = StubRateClient(rates_page(("12.05.2025", "87,4567"), ("13.05.2025", "87,5012")))
+        self.service = rates.RateService(client=self.client_stub)
+
+    def test_fetch_on_miss_then_memory_hit(self):
+        self.assertEqual(self.service.lookup("12.05.2025"), rates.RateLookup(Decimal("87.45")))
+        self.assertEqual(self.service.get_rate("13.05.2025"), Decimal("87.50"))
+        self.assertEqual(self.client_stub.calls, 1)
+        self.assertEqual(self.service.stats, {'memory_hits': 1, 'db_hits': 0, 'fetches': 1})
+        self.assertEqual(ExchangeRate.objects.count(), 2)
+
+    def test_db_hit_without_fetch(self):
+        ExchangeRate.objects.create(date=date(2025, 5, 12), rate=Decimal("87.45"), fetched_at=timezone.now())
+        self.assertEqual(self.service.get_rate("12.05.2025"), Decimal("87.45"))
+        self.assertEqual(self.service.get_rate("12.05.2025"), Decimal("87.45"))
+        self.assertEqual(self.client_stub.calls, 0)
+        self.assertEqual(self.service.stats, {'memory_hits': 1, 'db_hits': 1, 'fetches': 0})
+
+    def test_concurrent_refresh_fetches_once(self):
+        fetching, release, follower_waiting = threading.Event(), threading.Event(), threading.Event()
+        stub = self.client_stub
+
+        class BlockingClient:
+            def fetch(self, timeout=None):
+                fetching.set()
+                release.wait(5)
+                return stub.fetch(timeout)
+
+        class WatchedFuture(rates.Future):
+            def result(self, timeout=None):
+                follower_waiting.set()
+                return super().result(timeout)
+
+        service = rates.RateService(client=BlockingClient())
+        results = []
+        # Ведомый поток только ждет Future ведущего, к БД обращается лишь ведущий (основной поток)
+        follower = threading.Thread(target=lambda: results.append(service.refresh()))
+        with mock.patch.object(rates, 'Future', WatchedFuture):
+            threading.Thread(target=lambda: (fetching.wait(5), follower.start(), follower_waiting.wait(5), release.set())).start()
+            leader_rates = service.refresh()
+            follower.join(5)
+
+        self.assertEqual(stub.calls, 1)
+        self.assertEqual(results, [leader_rates])
+        self.assertEqual(service.stats['fetches'], 1)
+
+    def http_client(self, status):
+        response = requests.Response()
+        response.status_code, response._content, response.url = status, b"<html>maintenance</html>", rates.NBKR_URL
+        session = mock.Mock(get=mock.Mock(return_value=response))
+        return rates.NBKRClient(session=session)
+
+    def test_http_error_is_network_error(self):
+        with self.assertRaises(rates.NetworkError) as ctx:
+            self.http_client(503).fetch()
+        self.assertIn("503", ctx.exception.technical_details)
+
+    def test_stale_fallback_on_http_error_and_unparsable_page(self):
+        ExchangeRate.objects.create(date=date(2025, 5, 12), rate=Decimal("87.45"), fetched_at=timezone.now())
+        for client in (self.http_client(502), self.http_client(200), StubRateClient(rates_page())):
+            service = rates.RateService(client=client)
+            with self.assertRaises(rates.NetworkError):
+                service.lookup("13.05.2025")
+            self.assertEqual(
+                service.lookup("13.05.2025", allow_stale=True)[:3], (Decimal("87.45"), True, date(2025, 5, 12)),
+            )
+
+
+class ImmediateExecutor:
+    """Исполнитель, который выполняет задачу сразу в вызывающем потоке: запись завершается до add_done_callback."""
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+@override_settings(OCR_PIPELINE_QUEUE_SIZE=0)
+class ProcessZipStageTests(TestCase):
+    """Этапы process_zip_file с пулом (исполнитель в том же процессе) и без него; OCR документов заменен заглушкой."""
+
+    DRIVERS = {"1.pdf": "Иванов И.И.", "2.pdf": "Петров П.П.", "3.pdf": "Сидоров С.С.", "4.pdf": "Козлов К.К."}
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        settings_override = override_settings(MEDIA_ROOT=os.path.join(self.tmp, "media"))
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.zip_path = os.path.join(self.tmp, "batch 12-05-2025.zip")
+        with zipfile.ZipFile(self.zip_path, "w") as zf:
+            for name in list(self.DRIVERS) + [
+                "эсф Иванов.pdf", "эсф Петров.pdf", "эсф Козлов.pdf", "эсф 0001.pdf",
+                "снт Иванов.pdf", "снт Петров.pdf", "снт Козлов.pdf", "снт 0002.pdf",
+            ]:
+                zf.writestr(f"batch/{name}", b"%PDF stub")
+
+    def fake_extract_document(self, pdf_path, template, save_dir, context=None, metrics=None, doc_cache=None):
+        name = os.path.basename(pdf_path)
+        if template.key == "t1":
+            return {"Дата (1)": "12.05.2025"}, {4: self.DRIVERS[name], 7: "20000"}
+        if template.key == "t2":
+            return {}, {8: "100.00", 16: f"F {name}"}
+        return {}, {13: "13.05.2025", 15: f"KZ {name}"}
+
+    @staticmethod
+    def completed_out_of_order(futures):
+        """as_completed пула, в котором первая задача этапа завершается последней."""
+        futures = list(futures)
+        return futures[1:] + futures[:1]
+
+    def process(self, workers):
+        with mock.patch.object(services, 'extract_document', side_effect=self.fake_extract_document), \
+                mock.patch.object(services, 'get_parallel_workers', return_value=workers), \
+                mock.patch.object(services, 'create_ocr_process_pool', return_value=ImmediateExecutor()), \
+                mock.patch.object(services, 'as_completed', side_effect=self.completed_out_of_order), \
+                open(self.zip_path, "rb") as fh:
+            return services.process_zip_file(
+                File(fh, name=os.path.basename(self.zip_path)), Decimal("87.5"), None, "27132000", "60/90", Decimal("12"),
+                workspace=JobWorkspace(f"job{workers}", base_dir=self.tmp),
+            )
+
+    def test_parallel_rows_keep_input_order_and_force_match(self):
+        # Пул завершает задачи не по порядку (completed_out_of_order), строки все равно идут в порядке документов
+        parallel = self.process(workers=4)
+        sequential = self.process(workers=0)
+        for results in (parallel, sequential):
+            self.assertEqual([row[4] for row in results], list(self.DRIVERS.values()))
+            self.assertEqual([(row[16], row[15]) for row in results], [
+                ("F эсф Иванов.pdf", "KZ снт Иванов.pdf"),
+                ("F эсф Петров.pdf", "KZ снт Петров.pdf"),
+                # Сидоров не найден по фамилии: правило 1-1-1 отдает ему оставшиеся ЭСФ и СНТ
+                ("F эсф 0001.pdf", "KZ снт 0002.pdf"),
+                ("F эсф Козлов.pdf", "KZ снт Козлов.pdf"),
+            ])
+            self.assertEqual(results[2]['errors'], [])
+            self.assertEqual([row[12] for row in results], [Decimal("21000.00")] * 4)
+        strip = lambda rows: [{k: v for k, v in row.items() if k not in ('preview_images', 'field_images')} for row in rows]
+        self.assertEqual(strip(parallel), strip(sequential))
+
+
+class ImageWriterTests(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def run_with_timeout(self, fn, seconds=10):
+        thread = threading.Thread(target=fn, daemon=True)
+        thread.start()
+        thread.join(seconds)
+        self.assertFalse(thread.is_alive(), "ImageWriter завис")
+
+    def test_already_finished_write_does_not_deadlock(self):
+        writer = ImageWriter()
+        writer._executor = ImmediateExecutor()
+        image = np.zeros((4, 4), np.uint8)
+        paths = [os.path.join(self.tmp.name, f"{i}.png") for i in range(50)]
+        self.run_with_timeout(lambda: [writer.submit(image, p) for p in paths] and writer.flush(self.tmp.name))
+        self.assertEqual(sorted(os.listdir(self.tmp.name)), sorted(os.path.basename(p) for p in paths))
+        self.assertEqual(writer._pending, {})
+
+    def test_failing_writes_are_reported_and_flush_returns(self):
+        writer = ImageWriter()
+        out = io.StringIO()
+        missing_dir = os.path.join(self.tmp.name, "gone")
+        with contextlib.redirect_stdout(out):
+            def fill_and_flush():
+                for i in range(200):
+                    writer.submit(np.zeros((4, 4), np.uint8), os.path.join(missing_dir, f"{i}.png"))
+                writer.flush(missing_dir)
+                writer.flush()
+            self.run_with_timeout(fill_and_flush)
+        self.assertEqual(out.getvalue().count("[ImageWriter] Error saving"), 200)
+        self.assertEqual(writer._pending, {})
+
+
+class StubOCRModel:
+    """
+    Детектор и распознаватель в духе easyocr.Reader без модели: рамка - темные пиксели
+    с полем MARGIN (может выходить за кроп), текст - средняя яркость фрагмента.
+    Считает вызовы detect и recognize.
+    """
+    MARGIN = 3
+
+    def __init__(self):
+        self.detect_batches = []
+        self.recognize_calls = 0
+
+    def detect(self, images, reformat=False):
+        self.detect_batches.append(images.shape)
+        horizontal = []
+        for image in images:
+            ys, xs = np.where(image.mean(axis=2) < 128)
+            m = self.MARGIN
+            horizontal.append([[xs.min() - m, xs.max() + m, ys.min() - m, ys.max() + m]] if len(xs) else [])
+        return horizontal, [[] for _ in images]
+
+    def recognize(self, grey, horizontal_list, free_list, detail=1, reformat=False, batch_size=1):
+        self.recognize_calls += 1
+        out = []
+        for box in horizontal_list:
+            x0, x1 = max(0, box[0]), min(box[1], grey.shape[1])
+            y0, y1 = max(0, box[2]), min(box[3], grey.shape[0])
+            text = "T%d" % int(grey[y0:y1, x0:x1].mean())
+            out.append(([[x0, y0], [x1, y0], [x1, y1], [x0, y1]], text, 0.9))
+        # Как easyocr при batch_size > 1: строки упорядочены по верхней границе
+        return sorted(out, key=lambda item: item[0][0][1])
+
+    def readtext(self, image, detail=1):
+        rgb, grey = ocr._prepare_crop(image)
+        horizontal, free = self.detect(rgb[None], reformat=False)
+        return self.recognize(grey, horizontal[0], free[0])
+
+
+class ReadtextBatchedTests(TestCase):
+    def crop(self, height, width, rects, fill=255):
+        img = np.full((height, width, 3), fill, np.uint8)
+        for x, y, w, h, shade in rects:
+            img[y:y + h, x:x + w] = shade
+        return img
+
+    def test_mixed_size_crops_are_batched_and_match_readtext(self):
+        crops = [
+            self.crop(40, 120, [(2, 3, 50, 20, 0)]),  # рамка с полем выходит за верх и левый край
+            self.crop(90, 60, [(10, 70, 48, 18, 40)]),
+            self.crop(30, 300, []),  # пустое поле - без рамок
+            self.crop(55, 200, [(150, 40, 50, 15, 90)]),  # рамка выходит за правый и нижний край
+            np.full((25, 80), 255, np.uint8),
+        ]
+        crops[4][5:20, 10:70] = 20  # кроп в оттенках серого
+        model = StubOCRModel()
+        expected = [model.readtext(c) for c in crops]
+        model.detect_batches.clear()
+        model.recognize_calls = 0
+
+        with override_settings(OCR_DETECT_BATCH_SIZE=16):
+            got = ocr.readtext_batched(crops, model)
+
+        self.assertEqual(model.detect_batches, [(5, 90, 300, 3)])
+        self.assertEqual(model.recognize_calls, 1)
+        self.assertEqual(got, expected)
+
+    def test_batch_size_splits_detection(self):
+        crops = [self.crop(20 + i, 40, [(5, 5, 20, 8, 0)]) for i in range(5)]
+        model = StubOCRModel()
+        expected = [model.readtext(c) for c in crops]
+        model.detect_batches.clear()
+        got = ocr.readtext_batched(crops, model, batch_size=2)
+        self.assertEqual(len(model.detect_batches), 3)
+        self.assertEqual(got, expected)
+
+
+@override_settings(OCR_TEXT_LAYER_ENABLED=True, OCR_CACHE_ENABLED=False, OCR_SAVE_PREVIEW_IMAGES=False)
+class TextLayerTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        self.coords_map = get_template('t2').plan.steps[0].coords_map
+
+    def esf_pdf(self, price):
+        """ЭСФ с текстовым слоем: цена и номер инвойса в областях полей шаблона t2 (координаты в пунктах)."""
+        path = os.path.join(self.tmp, "эсф.pdf")
+        doc = fitz.open()
+        page = doc.new_page(width=595, height=842)
+        page.insert_text((125, 58), "F-000123", fontname="helv", fontsize=8)
+        page.insert_text((352, 540), price, fontname="helv", fontsize=12)
+        doc.save(path)
+        doc.close()
+        return path
+
+    def extract(self, path, metrics):
+        return services.extract_text_from_pdf(
+            path, self.coords_map, os.path.join(self.tmp, "crops"), metrics=metrics, use_text_layer=True,
+        )
+
+    def test_reads_fields_without_ocr(self):
+        path = self.esf_pdf("186.50")
+        self.assertEqual(services.read_text_layer_fields(path, 0, self.coords_map), {
+            "Цена (8)": "186.50", "№ счет факт (Инвойс) (16)": "F-000123",
+        })
+        metrics = PipelineMetrics()
+        with mock.patch.object(services, 'readtext_batched') as readtext, \
+                mock.patch.object(services, 'render_pdf_page') as render:
+            data = self.extract(path, metrics)
+        self.assertEqual(data, {"Цена (8)": "186.50", "№ счет факт (Инвойс) (16)": "F-000123"})
+        readtext.assert_not_called()
+        render.assert_not_called()
+        self.assertEqual(metrics.counters.get('fields_text_layer'), 2)
+
+    def test_rejected_text_falls_back_to_ocr(self):
+        path = self.esf_pdf("n/a")
+        self.assertEqual(services.read_text_layer_fields(path, 0, self.coords_map),
+                         {"№ счет факт (Инвойс) (16)": "F-000123"})
+        metrics = PipelineMetrics()
+        box = [[0, 0], [60, 0], [60, 30], [0, 30]]
+        with mock.patch.object(services, 'get_reader', return_value=StubOCRModel()), \
+                mock.patch.object(services, 'readtext_batched', return_value=[[(box, "186.50", 0.9)]]) as readtext:
+            data = self.extract(path, metrics)
+        self.assertEqual(data, {"Цена (8)": "186.50", "№ счет факт (Инвойс) (16)": "F-000123"})
+        # OCR получил только поле, не прошедшее проверку текстового слоя
+        self.assertEqual(len(readtext.call_args.args[0]), 1)
+        self.assertEqual(metrics.counters.get('text_layer_rejected'), 1)
+        self.assertEqual(metrics.counters.get('fields_ocr'), 1)
+
+
+def lined_page(angle):
+    """Страница 300 dpi (BGR) с рамками таблицы и штрихами "букв", повернутая на angle градусов по часовой."""
+    img = np.full((3508, 2480, 3), 255, np.uint8)
+    for x in (200, 900, 1600, 2280):
+        cv2.line(img, (x, 400), (x, 3100), (0, 0, 0), 3)
+    for y in range(400, 3101, 150):
+        cv2.line(img, (200, y), (2280, y), (0, 0, 0), 3)
+        for x in range(240, 2200, 60):
+            cv2.rectangle(img, (x, y + 50), (x + 4, y + 90), (0, 0, 0), -1)
+    rotation = cv2.getRotationMatrix2D((1240, 1754), -angle, 1.0)
+    return cv2.warpAffine(img, rotation, (2480, 3508), borderValue=(255, 255, 255))
+
+
+class SkewEstimateTests(TestCase):
+    TOLERANCE = 0.25
+
+    def test_matches_rotation_and_legacy_deskew(self):
+        for angle in (1.5, -1.5, 0.0):
+            with self.subTest(angle=angle):
+                img = lined_page(angle)
+                legacy = legacy_deskew_image(img)[1]
+                gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+                small = cv2.resize(gray, None, fx=0.5, fy=0.5, interpolation=cv2.INTER_AREA)
+                doc = fitz.open()
+                page = doc.new_page(width=595, height=842)
+                page.insert_image(page.rect, stream=cv2.imencode('.png', img)[1].tobytes())
+                with override_settings(OCR_DESKEW_SCALE=0.5):
+                    estimates = [
+                        services.estimate_skew_angle(gray),
+                        services.estimate_skew_angle(small, 0.5),
+                        services.estimate_page_skew(page),
+                    ]
+                doc.close()
+                self.assertAlmostEqual(legacy, angle, delta=self.TOLERANCE)
+                for estimate in estimates:
+                    self.assertAlmostEqual(estimate, angle, delta=self.TOLERANCE)
+                    self.assertAlmostEqual(estimate, legacy, delta=self.TOLERANCE)
+
+
+def legacy_point_preprocess(crop, field_name):
+    """Прежняя предобработка кропа в extract_text_from_pdf (PIL: синий канал и point() с порогом по имени поля)."""
+    crop_img = Image.fromarray(crop)
+    if any(x in field_name for x in ["ФИО Водит.", "Марка", "Гос_номер"]):
+        r, g, b = crop_img.split()
+        crop_img = b
+        if "ФИО Водит." in field_name:
+            threshold = 170
+            crop_img = crop_img.point(lambda p: 255 if p > threshold else 0)
+        elif "Гос_номер" in field_name:
+            threshold = 165
+            crop_img = crop_img.point(lambda p: 255 if p > threshold else 0)
+    return np.asarray(crop_img)
+
+
+class PreprocessCropTests(TestCase):
+    def test_matches_legacy_point_threshold(self):
+        rng = np.random.default_rng(7)
+        crop = rng.integers(0, 256, size=(64, 256, 3), dtype=np.uint8)
+        # Все значения синего канала, включая сами пороги 165 и 170
+        crop[0, :, 2] = np.arange(256, dtype=np.uint8)
+        fields = [field for template in get_registry().templates for field in template.fields()]
+        self.assertEqual({template.key for template in get_registry().templates}, {"t1", "t2", "t3"})
+        for field in fields:
+            with self.subTest(field=field.name):
+                processed = services.preprocess_crop(crop, field.preprocessing) if field.preprocessing else crop
+                # Поля без предобработки (типы 2 и 3, якорь) по-прежнему уходят в OCR как RGB-кроп
+                np.testing.assert_array_equal(processed, legacy_point_preprocess(crop, field.name))
+
+
+class OCRResultCacheTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        self.cache = OCRResultCache(path=os.path.join(self.tmp, "ocr.sqlite3"), max_entries=2, ttl_seconds=60)
+        self.addCleanup(lambda: self.cache._connect().close())
+        self.pdf = os.path.join(self.tmp, "1.pdf")
+        with open(self.pdf, 'wb') as fh:
+            fh.write(b"%PDF-1.4 test")
+
+    def test_key_depends_on_content_page_map_and_deskew(self):
+        coords = {"fio": (10, 20, 30, 40)}
+        key = self.cache.make_key(self.pdf, 0, coords, True)
+        self.assertEqual(key, self.cache.make_key(self.pdf, 0, {"fio": [10, 20, 30, 40]}, True))
+        self.assertEqual(key, self.cache.make_key("other.pdf", 0, coords, True, digest=file_sha256(self.pdf)))
+        self.assertNotEqual(key, self.cache.make_key(self.pdf, 1, coords, True))
+        self.assertNotEqual(key, self.cache.make_key(self.pdf, 0, {"fio": (10, 20, 30, 41)}, True))
+        self.assertNotEqual(key, self.cache.make_key(self.pdf, 0, coords, False))
+
+        with open(self.pdf, 'ab') as fh:
+            fh.write(b" changed")
+        self.assertNotEqual(key, self.cache.make_key(self.pdf, 0, coords, True))
+
+    def test_changed_field_spec_is_cache_miss(self):
+        spec = get_registry().field("ФИО Водит. (4)")
+        coords = {spec.name: spec.rect}
+        key = self.cache.make_key(self.pdf, 0, coords, True)
+        self.cache.set(key, {'data': {spec.name: [["Иванов", 30]]}, 'offset_x': 0, 'offset_y': 0, 'anchor_key': None})
+        self.assertIsNotNone(self.cache.get(self.cache.make_key(self.pdf, 0, coords, True)))
+
+        changes = [
+            {'preprocessing': {"channel": "b", "threshold": 160}},
+            {'min_height': 25},
+            {'raw': False},
+        ]
+        for change in changes:
+            with self.subTest(change=change):
+                changed = FieldSpec(**dict(vars(spec), **change))
+                with mock.patch.object(ocr_cache, 'field_spec', return_value=changed):
+                    changed_key = self.cache.make_key(self.pdf, 0, coords, True)
+                self.assertNotEqual(changed_key, key)
+                self.assertIsNone(self.cache.get(changed_key))
+
+    def test_key_depends_on_pipeline_version(self):
+        key = self.cache.make_key(self.pdf, 0, {}, False)
+        with mock.patch.object(ocr_cache, 'OCR_PIPELINE_VERSION', ocr_cache.OCR_PIPELINE_VERSION + 1):
+            bumped = OCRResultCache(path=self.cache.path)
+        self.assertNotEqual(key, bumped.make_key(self.pdf, 0, {}, False))
+
+    def test_get_and_set_count_hits_and_misses(self):
+        self.assertIsNone(self.cache.get("a"))
+        self.cache.set("a", {"fio": "Иванов"})
+        self.assertEqual(self.cache.get("a"), {"fio": "Иванов"})
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_evict_drops_least_recently_used_over_limit(self):
+        now = time.time()
+        with mock.patch.object(ocr_cache.time, 'time', side_effect=[now - 4, now - 3, now - 2, now - 1, now]):
+            self.cache.set("a", 1)
+            self.cache.set("b", 2)
+            self.cache.set("c", 3)
+            self.cache.get("a")
+            self.assertEqual(self.cache.evict(), 1)
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(self.cache.get("a"), 1)
+        self.assertEqual(self.cache.get("c"), 3)
+
+    def test_expired_entries_are_ignored_and_evicted(self):
+        with mock.patch.object(ocr_cache.time, 'time', return_value=1000):
+            self.cache.set("old", 1)
+        with mock.patch.object(ocr_cache.time, 'time', return_value=1061):
+            self.assertIsNone(self.cache.get("old"))
+            self.assertEqual(self.cache.evict(), 1)
+
+
+class DocumentCacheTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.pdf = os.path.join(tmp.name, "2.pdf")
+        doc = fitz.open()
+        page = doc.new_page(width=200, height=300)
+        page.insert_text((20, 40), "ИНН 01234567890123", fontname="helv")
+        page.draw_rect(fitz.Rect(100, 200, 180, 280), fill=(0, 0, 0))
+        doc.save(self.pdf)
+        doc.close()
+        self.cache = DocumentCache()
+        self.addCleanup(self.cache.close)
+
+    def test_crop_outside_clip_renders_full_page_through_cache(self):
+        clip = self.cache.get_page(self.pdf, 0, False, region=(0, 0, 300, 300))
+        clip_image = clip.image
+        self.assertFalse(clip.is_full)
+        self.assertEqual(self.cache._pages_bytes, clip.nbytes)
+
+        box = (400, 800, 700, 1100)
+        crop = clip.crop(box)
+
+        expected = services.render_pdf_page(self.pdf, 0).crop(box)
+        self.assertTrue(np.array_equal(crop, expected))
+        # Область осталась как была, а полная страница лежит в кэше и учтена в его памяти
+        self.assertIs(clip.image, clip_image)
+        full = self.cache.get_page(self.pdf, 0, False)
+        self.assertTrue(full.is_full)
+        self.assertEqual(self.cache._pages_bytes, full.nbytes)
+        self.assertEqual(self.cache.stats['page_renders'], 2)
+
+
+def make_pdf(path, text="ИНН 01234567890123", pages=1):
+    """PDF формата A4 с текстом и рамкой на каждой странице."""
+    doc = fitz.open()
+    for i in range(pages):
+        page = doc.new_page(width=595, height=842)
+        page.insert_text((60, 200 + 20 * i), text, fontname="helv", fontsize=14)
+        page.draw_rect(fitz.Rect(50, 300, 540, 700), color=(0, 0, 0), width=1)
+    doc.save(path)
+    doc.close()
+    return path
+
+
+@override_settings(OCR_SAVE_PREVIEW_IMAGES=True)
+class PagePrefetcherTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.pdfs = [make_pdf(os.path.join(tmp.name, f"{i}.pdf"), text=f"ИНН {i:014d}") for i in range(8)]
+
+    def test_take_leaves_the_page_extraction_renders(self):
+        doc_cache = DocumentCache()
+        self.addCleanup(doc_cache.close)
+        template = get_template("t1")
+        with pipeline.PagePrefetcher(doc_cache, [[(self.pdfs[0], "t1")]], depth=2) as prefetcher:
+            prefetcher.take(0)
+        renders = doc_cache.stats['page_renders']
+        self.assertGreater(renders, 0)
+        for page_num, apply_deskew, region in pipeline.document_pages(self.pdfs[0], template):
+            page = doc_cache.get_page(self.pdfs[0], page_num, apply_deskew, region)
+            expected = services.render_pdf_page(self.pdfs[0], page_num, apply_deskew, region=region)
+            self.assertTrue(np.array_equal(page.image, expected.image))
+            self.assertEqual((page.origin, page.rotation), (expected.origin, expected.rotation))
+        self.assertEqual(doc_cache.stats['page_renders'], renders)
+
+    def test_depth_keeps_queued_documents_in_cache(self):
+        doc_cache = DocumentCache(max_documents=4)
+        self.addCleanup(doc_cache.close)
+        tasks = [[(self.pdfs[2 * i], "t2"), (self.pdfs[2 * i + 1], "t3")] for i in range(4)]
+        with pipeline.PagePrefetcher(doc_cache, tasks, depth=10) as prefetcher:
+            self.assertEqual(prefetcher.depth, 4 // 2 - 1)
+            for i, docs in enumerate(tasks):
+                prefetcher.take(i)
+                self.assertLessEqual(max(prefetcher._futures, default=i), i + prefetcher.depth)
+                # Документы задачи отрендерены заранее и не вытеснены очередью: обработка берет их из кэша
+                for pdf_path, key in docs:
+                    for page_num, apply_deskew, region in pipeline.document_pages(pdf_path, get_template(key)):
+                        self.assertIsNotNone(doc_cache.get_page(pdf_path, page_num, apply_deskew, region))
+        self.assertEqual(doc_cache.stats['doc_opens'], 8)
+        self.assertEqual(doc_cache.stats['page_renders'], 8)
+        self.assertEqual(pipeline.PagePrefetcher(DocumentCache(max_documents=3), tasks, depth=10).depth, 0)
+
+    def test_render_thread_error_reaches_take(self):
+        doc_cache = DocumentCache()
+        self.addCleanup(doc_cache.close)
+        with mock.patch.object(pipeline, 'document_pages', side_effect=RuntimeError("план шаблона")):
+            with pipeline.PagePrefetcher(doc_cache, [[(self.pdfs[0], "t1")]], depth=1) as prefetcher:
+                with self.assertRaisesRegex(RuntimeError, "план шаблона"):
+                    prefetcher.take(0)
+
+    def test_page_render_error_is_left_to_document_processing(self):
+        doc_cache = DocumentCache()
+        self.addCleanup(doc_cache.close)
+        out = io.StringIO()
+        with mock.patch.object(doc_cache, 'get_page', side_effect=ValueError("битый PDF")), contextlib.redirect_stdout(out):
+            with pipeline.PagePrefetcher(doc_cache, [[(self.pdfs[0], "t1")]], depth=1) as prefetcher:
+                prefetcher.take(0)
+        self.assertIn("[PagePrefetcher] Render error", out.getvalue())
+
+
+class StubReader:
+    """OCR, который на любом изображении читает заданный текст."""
+
+    def __init__(self, text):
+        self.text = text
+
+    def readtext(self, image, detail=1):
+        return [self.text]
+
+
+def inn_page(spots, blur=()):
+    """Кроп зоны якоря с надписями "INN" в точках spots; области blur размываются."""
+    img = np.full((200, 400, 3), 255, np.uint8)
+    for x, y in spots:
+        cv2.putText(img, "INN", (x, y), cv2.FONT_HERSHEY_SIMPLEX, 1.0, (0, 0, 0), 2)
+    for x, y, w, h in blur:
+        img[y:y + h, x:x + w] = cv2.GaussianBlur(img[y:y + h, x:x + w], (7, 7), 0)
+    return img
+
+
+def text_bbox(img, region):
+    """Рамка OCR (4 точки) вокруг темных пикселей в области region = (x, y, w, h)."""
+    x, y, w, h = region
+    gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)[y:y + h, x:x + w]
+    ys, xs = np.where(gray < 128)
+    x0, x1, y0, y1 = x + xs.min(), x + xs.max() + 1, y + ys.min(), y + ys.max() + 1
+    return [[x0, y0], [x1, y0], [x1, y1], [x0, y1]]
+
+
+class AnchorLocatorTests(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.locator = anchors.AnchorLocator(self.tmp.name, threshold=0.8)
+        self.page = inn_page([(30, 50), (250, 50), (30, 150)])
+        self.bbox = text_bbox(self.page, (0, 0, 150, 80))
+
+    def learn(self, locator=None, reader=None, bbox=None):
+        locator = locator or self.locator
+        return locator.learn(self.page, "Якорь", "ИНН", bbox or self.bbox, "ИНН", reader or StubReader("ИНН"))
+
+    def test_match_picks_first_occurrence_in_reading_order(self):
+        self.assertTrue(self.learn())
+        x0, y0 = self.bbox[0]
+        self.assertEqual(self.locator.match(self.page, "Якорь", "ИНН"), (x0, y0, 1.0))
+        # Без левого верхнего вхождения - правое в той же строке, без строки целиком - нижнее
+        dx, dy, _ = self.locator.match(inn_page([(250, 50), (30, 150)]), "Якорь", "ИНН")
+        self.assertEqual((dx - x0, dy - y0), (220, 0))
+        dx, dy, _ = self.locator.match(inn_page([(250, 150), (30, 150)]), "Якорь", "ИНН")
+        self.assertEqual((dx - x0, dy - y0), (0, 100))
+
+    def test_weak_earlier_occurrence_falls_back_to_ocr(self):
+        self.assertTrue(self.learn())
+        strict = anchors.AnchorLocator(self.tmp.name, threshold=0.95)
+        page = inn_page([(30, 50), (250, 50)], blur=[(20, 10, 100, 60)])
+        dx, dy, score = strict.match(page, "Якорь", "ИНН")
+        # Четкое правое вхождение не выбирается вместо размытого левого: решает OCR
+        self.assertEqual((dx, dy), tuple(self.bbox[0]))
+        self.assertLess(score, strict.threshold)
+
+    def test_learn_rejects_unreadable_small_or_misplaced_glyph(self):
+        self.assertFalse(self.learn(reader=StubReader("ИНН1")))
+        x0, y0 = self.bbox[0]
+        self.assertFalse(self.learn(bbox=[[x0, y0], [x0 + 12, y0], [x0 + 12, y0 + 8], [x0, y0 + 8]]))
+        # Рамка второго вхождения: сопоставление нашло бы первое, смещения не совпали бы
+        self.assertFalse(self.learn(bbox=text_bbox(self.page, (220, 0, 180, 80))))
+        self.assertEqual(os.listdir(self.tmp.name), [])
+
+    def test_template_file_is_versioned(self):
+        self.assertTrue(self.learn())
+        names = sorted(os.listdir(self.tmp.name))
+        self.assertTrue(all(n.startswith(f"anchor_v{anchors.TEMPLATE_VERSION}_") for n in names), names)
+        with mock.patch.object(anchors, 'TEMPLATE_VERSION', anchors.TEMPLATE_VERSION + 1):
+            self.assertIsNone(anchors.AnchorLocator(self.tmp.name).match(self.page, "Якорь", "ИНН"))
+
+
+class Type1TemplateTests(TestCase):
+    def test_type1_fields_declare_row_columns(self):
+        columns = {spec.column: spec.cleaner for spec in get_template("t1").pages[0] if spec.column is not None}
+        self.assertEqual(columns, {2: "clean_marka", 3: "clean_gos_number", 4: "clean_fio", 7: "clean_7"})
+        for cleaner in columns.values():
+            self.assertTrue(hasattr(services.DataCleaner, cleaner))
+
+    def test_type1_cleaners(self):
+        clean = services.clean_field
+        self.assertEqual(clean("Марка", [("VOLVO ", 30), ("  ", 20), ("FH", 31)], {}), "VOLVO FH")
+        self.assertEqual(clean("Гос_номер ()", [("27", 40), ("а123вс", 40), ("x", 10), ("01", 41)], {}), "A123BC / 01")
+        self.assertEqual(clean("Гос_номер ()", [("A777AA", 40)], {}), "A777AA")
+        self.assertEqual(clean("Гос_номер ()", [], {}), "")
+        self.assertEqual(clean("ФИО Водит. (4)", [("12.05.2025", 40), ("22", 40), ("Иванов И.И:", 40)], {}), "Иванов И.И.")
+        self.assertEqual(clean("ФИО Водит. (4)", None, {}), "")
+        self.assertEqual(clean("Кол.тон (7)", "Вес 20 000 нетто", {}), "20000")
+
+    def test_xlsx_document_gives_the_same_columns(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, "1.xlsx")
+        wb = openpyxl.Workbook()
+        sheet = wb.active
+        sheet["K75"] = "12.05.2025"
+        sheet["G89"] = "VOLVO"
+        sheet["B89"] = "а123вс"
+        sheet["B90"] = "01"
+        sheet["M80"] = " Иванов И.И. "
+        sheet["U43"] = "20 000 нетто"
+        wb.save(path)
+
+        data, columns, source_map = services.extract_data_from_xlsx(path)
+        self.assertEqual(columns, {2: "VOLVO", 3: "A123BC / 01", 4: "Иванов И.И.", 7: "20000"})
+        self.assertEqual(data["Дата (1)"], "12.05.2025")
+        self.assertEqual(source_map[4], "M80")
+
+    def test_esf_price_fallback_validator(self):
+        from .documents import _valid_price
+        self.assertTrue(_valid_price("186,50"))
+        self.assertFalse(_valid_price("7"))
+        self.assertFalse(_valid_price("1.00"))
+        self.assertFalse(_valid_price(None))
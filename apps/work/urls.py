@@ -5,8 +5,12 @@ from . import views
 
 urlpatterns = [
     path('', views.upload_view, name='upload'),
+    path('jobs/<uuid:job_id>/', views.job_status_view, name='job_status'),
+    path('jobs/<uuid:job_id>/status/', views.job_status_api, name='job_status_api'),
+    path('jobs/<uuid:job_id>/result/', views.job_result_view, name='job_result'),
     path('preview/', views.preview_view, name='preview'),
     path('preview/submit/', views.preview_submit_view, name='preview_submit'),
+    path('preview/rows/<int:index>/', views.preview_row_view, name='preview_row'),
     path('login/', auth_views.LoginView.as_view(template_name='work/login.html'), name='login'),
     path('logout/', auth_views.LogoutView.as_view(next_page='login'), name='logout'),
 ]
@@ -1,13 +1,24 @@
 import os
-import shutil
+import re
 from decimal import Decimal, ROUND_HALF_UP
-from django.shortcuts import render, redirect
-from django.http import HttpResponse
+from django.shortcuts import render, redirect, get_object_or_404
+from django.http import JsonResponse
+from django.template.loader import render_to_string
+from django.urls import reverse
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.conf import settings
+from .excel_export import excel_response
 from .forms import UploadFileForm, PreviewEditForm
-from .services import get_current_dollar_rate, process_zip_file, generate_excel, NetworkError
+from .jobs import enqueue_job, get_job_queue, get_job_workspace
+from .manifest import ensure_manifest, load_manifest
+from .models import ProcessingJob
+from .rates import RateBudget, get_rate_service
+from .results import PreviewStore, serialize_row
+from .services import get_current_dollar_rate, NetworkError
+
+# Поле строки предпросмотра в форме: obj_<номер строки>_<поле>
+ROW_FIELD_RE = re.compile(r'obj_(\d+)_')
 
 @login_required
 def upload_view(request):
@@ -53,74 +64,18 @@ def upload_view(request):
                     'save_photos': save_photos
                 }
                 
-                try:
-                    print(f"[upload_view] Calling process_zip_file with file={getattr(request.FILES['file'], 'name', None)}")
-                    results = process_zip_file(
-                        request.FILES['file'],
-                        dollar_rate=dollar_rate,
-                        selected_date=date,
-                        tn_ved_code=tn_ved_code,
-                        bnd_code=bnd_code,
-                        nds_percent=nds_percent,
-                        save_photos=save_photos
-                    )
-                    print(f"[upload_view] process_zip_file returned {len(results)} result(s)")
-                except Exception as e:
-                    error_message = str(e)
-                    print(f"[upload_view] Error processing zip file: {error_message}")
-                    messages.error(request, f'Ошибка при обработке файла: {error_message}')
-                    return render(request, 'work/index.html', {'form': form})
-                
-                has_critical_errors = False
-                for row in results:
-                    if row.get('errors'):
-                        has_critical_errors = True
-                        driver_name = row.get(4, 'Неизвестный водитель')
-                        for error in row['errors']:
-                            messages.error(request, f"{driver_name}: {error}")
-                
-                if has_critical_errors:
-                    return render(request, 'work/index.html', {'form': form})
-                
-                existing_excel_path = None
-                if existing_excel:
-                    base_temp_dir = os.path.join(settings.MEDIA_ROOT, "temp_ocr")
-                    existing_excel_dir = os.path.join(base_temp_dir, "existing_excel")
-                    os.makedirs(existing_excel_dir, exist_ok=True)
-                    existing_excel_path = os.path.join(existing_excel_dir, existing_excel.name)
-                    with open(existing_excel_path, 'wb+') as destination:
-                        for chunk in existing_excel.chunks():
-                            destination.write(chunk)
-                
-                serializable_results = []
-                for row in results:
-                    serializable_row = {}
-                    for key, value in row.items():
-                        if key == 'preview_images':
-                            serializable_row[key] = value
-                        elif key == 'field_images':
-                            field_images_serialized = {}
-                            if isinstance(value, dict):
-                                for field_key, img_list in value.items():
-                                    field_images_serialized[str(field_key)] = img_list
-                            serializable_row[key] = field_images_serialized
-                        elif isinstance(value, Decimal):
-                            serializable_row[str(key)] = str(value)
-                        else:
-                            serializable_row[str(key)] = value
-                    serializable_results.append(serializable_row)
-                
-                request.session['preview_data'] = {
-                    'results': serializable_results,
+                params = {
+                    'date': date.isoformat() if date else None,
                     'dollar_rate': str(dollar_rate),
                     'tn_ved_code': tn_ved_code,
                     'bnd_code': bnd_code,
                     'nds_percent': str(nds_percent),
-                    'existing_excel_path': existing_excel_path,
-                    'save_photos': save_photos
+                    'save_photos': save_photos,
                 }
-                
-                return redirect('preview')
+                print(f"[upload_view] Enqueue job for file={getattr(request.FILES['file'], 'name', None)}")
+                job = enqueue_job(request.user, request.FILES['file'], params, existing_excel=existing_excel)
+
+                return redirect('job_status', job_id=job.id)
                 
             except Exception as e:
                 error_message = str(e)
@@ -140,95 +95,402 @@ def upload_view(request):
 
 
 @login_required
-def preview_view(request):
-    preview_data = request.session.get('preview_data')
-    
-    if not preview_data:
-        messages.error(request, 'Данные для предпросмотра не найдены. Пожалуйста, загрузите файл заново.')
+def job_status_view(request, job_id):
+    job = get_object_or_404(ProcessingJob, pk=job_id, user=request.user)
+    if job.status == ProcessingJob.STATUS_DONE:
+        return redirect('job_result', job_id=job.id)
+    return render(request, 'work/job_status.html', {'job': job})
+
+
+@login_required
+def job_status_api(request, job_id):
+    # Обращение к очереди подхватывает задачи, оставшиеся после перезапуска воркера
+    get_job_queue()
+    # Результат задачи (ProcessingJob.result) опрашивающей странице не нужен
+    job = get_object_or_404(ProcessingJob.objects.defer('result', 'stats'), pk=job_id, user=request.user)
+    data = {
+        'id': str(job.id),
+        'status': job.status,
+        'status_display': job.get_status_display(),
+        'progress_current': job.progress_current,
+        'progress_total': job.progress_total,
+        'progress_percent': job.progress_percent,
+        'message': job.progress_message,
+        'error': job.error,
+        'finished': job.is_finished,
+    }
+    if job.is_finished:
+        data['redirect_url'] = reverse('job_result', kwargs={'job_id': job.id})
+    return JsonResponse(data)
+
+
+@login_required
+def job_result_view(request, job_id):
+    job = get_object_or_404(ProcessingJob, pk=job_id, user=request.user)
+
+    if job.status == ProcessingJob.STATUS_FAILED:
+        print(f"[job_result_view] Job {job_id} failed: {job.error}")
+        messages.error(request, f'Ошибка при обработке файла: {job.error}')
         return redirect('upload')
+
+    if job.status != ProcessingJob.STATUS_DONE:
+        return redirect('job_status', job_id=job.id)
+
+    results = job.result or []
+    print(f"[job_result_view] Job {job_id} returned {len(results)} result(s)")
+
+    has_critical_errors = False
+    for row in results:
+        if row.get('errors'):
+            has_critical_errors = True
+            driver_name = row.get('4', 'Неизвестный водитель')
+            for error in row['errors']:
+                messages.error(request, f"{driver_name}: {error}")
+
+    if has_critical_errors:
+        return redirect('upload')
+
+    # Строки предпросмотра хранятся в БД (PreviewRow), в сессии - только задача
+    PreviewStore(job.id).reset(results)
+    ensure_manifest(get_job_workspace(job.id), results)
+    request.session['preview_data'] = {'job_id': str(job.id)}
+
+    return redirect('preview')
+
+
+def get_preview_job(request):
+    """Задача предпросмотра из сессии (без ProcessingJob.result) или None, если строк предпросмотра нет."""
+    job_id = (request.session.get('preview_data') or {}).get('job_id')
+    if not job_id:
+        return None
+    job = ProcessingJob.objects.defer('result').filter(pk=job_id, user=request.user).first()
+    if job is None or not PreviewStore(job.id).exists():
+        return None
+    return job
+
+
+def build_preview_object(idx, row, manifest=None):
+    """
+    Строка хранилища -> объект для шаблона work/preview_row.html.
+    Показываются только картинки из манифеста задачи (manifest.CropManifest); файлы не проверяются.
+    """
+    image_paths = row.get('preview_images', [])
+    valid_images = manifest.filter(image_paths) if manifest is not None else []
     
-    results = preview_data['results']
+    data_dict = {}
+    field_images_dict = {}
+    sources_dict = {}
     
-    form = PreviewEditForm(objects_data=results)
+    for key_str, value in row.items():
+        if key_str == 'preview_images':
+            continue
+        elif key_str == 'field_images':
+            if isinstance(value, dict):
+                for field_key_str, img_list in value.items():
+                    try:
+                        field_key = int(field_key_str)
+                        valid_field_images = manifest.filter(img_list) if manifest is not None else []
+                        if valid_field_images:
+                            field_images_dict[field_key] = valid_field_images
+                    except (ValueError, TypeError):
+                        pass
+            continue
+        elif key_str == 'sources':
+            if isinstance(value, dict):
+                for source_key_str, source_val in value.items():
+                    if str(source_key_str) == '1':
+                        continue
+                    try:
+                        sources_dict[int(source_key_str)] = source_val
+                    except (ValueError, TypeError):
+                        sources_dict[source_key_str] = source_val
+            continue
+        try:
+            key = int(key_str)
+            data_dict[key] = value
+        except (ValueError, TypeError):
+            data_dict[key_str] = value
     
-    objects_for_template = []
-    for idx, row in enumerate(results):
-        image_paths = row.get('preview_images', [])
-        valid_images = []
-        for img_path in image_paths:
-            full_path = os.path.join(settings.MEDIA_ROOT, img_path)
-            if os.path.exists(full_path):
-                valid_images.append(img_path)
+    obj = {
+        'index': idx,
+        'images': valid_images,
+        'data': data_dict,
+        'field_images': field_images_dict,
+        'sources': sources_dict,
+        'errors': row.get('errors', []),
+        'warnings': row.get('warnings', [])
+    }
+    date_iso = ""
+    date_raw = data_dict.get(1)
+    if date_raw:
+        try:
+            if hasattr(date_raw, 'strftime'):
+                date_iso = date_raw.strftime('%Y-%m-%d')
+            else:
+                from datetime import datetime as dt
+                parsed = dt.strptime(str(date_raw), '%d.%m.%Y').date()
+                date_iso = parsed.strftime('%Y-%m-%d')
+        except Exception:
+            date_iso = ""
+    obj['date_iso'] = date_iso
+    return obj
+
+
+def restore_row(row):
+    """Строка хранилища (serialize_row) -> ключи-колонки int, суммы Decimal."""
+    updated_row = {}
+    
+    for key_str, value in row.items():
+        if key_str == 'preview_images':
+            updated_row['preview_images'] = value
+            continue
+        if key_str == 'field_images':
+            updated_row['field_images'] = value
+            continue
+        if key_str == 'sources':
+            updated_row['sources'] = value
+            continue
+        if key_str in ('errors', 'warnings'):
+            updated_row[key_str] = value
+            continue
         
-        data_dict = {}
-        field_images_dict = {}
-        sources_dict = {}
+        try:
+            key = int(key_str)
+        except (ValueError, TypeError):
+            continue
         
-        for key_str, value in row.items():
-            if key_str == 'preview_images':
-                continue
-            elif key_str == 'field_images':
-                if isinstance(value, dict):
-                    for field_key_str, img_list in value.items():
-                        try:
-                            field_key = int(field_key_str)
-                            valid_field_images = []
-                            for img_path in img_list:
-                                full_path = os.path.join(settings.MEDIA_ROOT, img_path)
-                                if os.path.exists(full_path):
-                                    valid_field_images.append(img_path)
-                            if valid_field_images:
-                                field_images_dict[field_key] = valid_field_images
-                        except (ValueError, TypeError):
-                            pass
-                continue
-            elif key_str == 'sources':
-                if isinstance(value, dict):
-                    for source_key_str, source_val in value.items():
-                        if str(source_key_str) == '1':
-                            continue
-                        try:
-                            sources_dict[int(source_key_str)] = source_val
-                        except (ValueError, TypeError):
-                            sources_dict[source_key_str] = source_val
-                continue
+        if key in [7, 8, 9, 10, 11, 12] and isinstance(value, str):
             try:
-                key = int(key_str)
-                data_dict[key] = value
-            except (ValueError, TypeError):
-                data_dict[key_str] = value
+                updated_row[key] = Decimal(value)
+            except:
+                updated_row[key] = value
+        else:
+            updated_row[key] = value
+    return updated_row
+
+
+def apply_row_edits(idx, row, form, post, params, refresh_rate=False, rate_budget=None):
+    """
+    Применяет к строке idx правки из формы (поля obj_<idx>_*) и пересчитывает суммы.
+    Для строк без полей в форме остаются сохраненные значения. Курс запрашивается заново при
+    refresh_rate (перерасчет) или смене даты. Возвращает (строка, rate_status):
+    rate_status - None, 'error' (курс не получен) или 'stale' (использован последний известный курс).
+    """
+    prefix = f'obj_{idx}'
+    rate_status = None
+    updated_row = restore_row(row)
+
+    date_value = form.cleaned_data.get(f'{prefix}_date')
+    if not date_value:
+        raw_date = post.get(f'{prefix}_date')
+        if raw_date:
+            try:
+                from datetime import datetime as dt
+                parsed_date = dt.strptime(raw_date, '%Y-%m-%d').date()
+                date_value = parsed_date
+            except Exception:
+                try:
+                    parsed_date = dt.strptime(raw_date, '%d.%m.%Y').date()
+                    date_value = parsed_date
+                except Exception:
+                    date_value = None
+    if date_value:
+        updated_row[1] = date_value.strftime('%d.%m.%Y')
+    else:
+        updated_row[1] = updated_row.get(1, '')
+
+    marka_value = form.cleaned_data.get(f'{prefix}_marka', '')
+    updated_row[2] = str(marka_value).strip() if marka_value else (updated_row.get(2, '') or '')
+    
+    gos_number_value = form.cleaned_data.get(f'{prefix}_gos_number', '')
+    updated_row[3] = str(gos_number_value).strip() if gos_number_value else (updated_row.get(3, '') or '')
+    
+    fio_value = form.cleaned_data.get(f'{prefix}_fio', '')
+    updated_row[4] = str(fio_value).strip() if fio_value else (updated_row.get(4, '') or '')
+    
+    kol_ton_value = form.cleaned_data.get(f'{prefix}_kol_ton', '')
+    if kol_ton_value:
+        try:
+            updated_row[7] = Decimal(str(kol_ton_value).replace(',', '.'))
+        except:
+            updated_row[7] = updated_row.get(7, Decimal("0"))
+    
+    price_value = form.cleaned_data.get(f'{prefix}_price')
+    if price_value is not None:
+        updated_row[8] = Decimal(str(price_value))
+    
+    date_sopr_value = form.cleaned_data.get(f'{prefix}_date_sopr', '')
+    updated_row[13] = str(date_sopr_value).strip() if date_sopr_value else (updated_row.get(13, '') or '')
+    
+    num_sopr_value = form.cleaned_data.get(f'{prefix}_num_sopr', '')
+    updated_row[15] = str(num_sopr_value).strip() if num_sopr_value else (updated_row.get(15, '') or '')
+    
+    invoice_value = form.cleaned_data.get(f'{prefix}_invoice', '')
+    updated_row[16] = str(invoice_value).strip() if invoice_value else (updated_row.get(16, '') or '')
+    
+    for key in [1, 2, 3, 4, 5, 6, 13, 14, 15, 16]:
+        if key not in updated_row:
+            updated_row[key] = ''
+    
+    try:
+        kol_ton = updated_row.get(7, Decimal("0"))
+        if isinstance(kol_ton, str):
+            kol_ton = Decimal(kol_ton)
+        cena = updated_row.get(8, Decimal("0"))
+        if isinstance(cena, str):
+            cena = Decimal(cena)
+
+        base_rate = updated_row.get(10, None)
+        if base_rate is None:
+            base_rate = params.get('dollar_rate', '0')
+        try:
+            base_rate = Decimal(base_rate)
+        except Exception:
+            base_rate = Decimal("0")
+
+        rate_to_use = base_rate
+        
+        original_date_str = row.get('1')
+        current_date_str = updated_row.get(1)
         
-        obj = {
-            'index': idx,
-            'images': valid_images,
-            'data': data_dict,
-            'field_images': field_images_dict,
-            'sources': sources_dict,
-            'errors': row.get('errors', [])
-        }
-        date_iso = ""
-        date_raw = data_dict.get(1)
-        if date_raw:
+        date_changed = False
+        if original_date_str != current_date_str:
+            date_changed = True
+            print(f"[preview_submit_view] Date changed for obj {idx}: {original_date_str} -> {current_date_str}")
+
+        if 'errors' in updated_row and updated_row['errors']:
+            updated_row['errors'] = [e for e in updated_row['errors'] if not str(e).startswith("Ошибка при получении курса")]
+
+        if refresh_rate or date_changed:
             try:
-                if hasattr(date_raw, 'strftime'):
-                    date_iso = date_raw.strftime('%Y-%m-%d')
+                date_for_rate = updated_row.get(1)
+                if not date_for_rate or str(date_for_rate).lower() == 'none':
+                    pass 
                 else:
-                    from datetime import datetime as dt
-                    parsed = dt.strptime(str(date_raw), '%d.%m.%Y').date()
-                    date_iso = parsed.strftime('%Y-%m-%d')
-            except Exception:
-                date_iso = ""
-        obj['date_iso'] = date_iso
-        objects_for_template.append(obj)
+                    print(f"[preview_submit_view] Recalculate/DateChanged: fetching rate for date {date_for_rate}")
+                    lookup = get_rate_service().lookup(date_for_rate, budget=rate_budget, allow_stale=True)
+                    rate_to_use = lookup.rate
+                    print(f"[preview_submit_view] Got rate {rate_to_use} for date {date_for_rate} (stale={lookup.stale})")
+                    if lookup.stale:
+                        updated_row.setdefault('errors', [])
+                        updated_row['errors'].append(
+                            f"Ошибка при получении курса на дату {date_for_rate}: сайт НБКР недоступен, "
+                            f"использован последний известный курс {lookup.rate} на {lookup.source_date:%d.%m.%Y}. "
+                            f"Проверьте курс.|||{lookup.reason}"
+                        )
+                        rate_status = 'stale'
+            except NetworkError as e:
+                rate_error = f"{e.user_message}|||{e.technical_details}"
+                print(f"[preview_submit_view] NetworkError for date {date_for_rate}: {e.technical_details}")
+                updated_row.setdefault('errors', [])
+                updated_row['errors'].append(rate_error)
+                rate_status = 'error'
+                rate_to_use = base_rate
+            except Exception as e:
+                rate_error = f"Ошибка при получении курса на дату {updated_row.get(1, '')}: {e}"
+                print(f"[preview_submit_view] get_current_dollar_rate exception for date {date_for_rate}: {e}")
+                updated_row.setdefault('errors', [])
+                updated_row['errors'].append(rate_error)
+                rate_status = 'error'
+                rate_to_use = base_rate
+
+        updated_row[10] = rate_to_use
+
+        nds_percent = Decimal(params.get('nds_percent', '0'))
+        
+        sum_dollar = (kol_ton * cena).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+        updated_row[9] = sum_dollar
+        
+        sum_som = (sum_dollar * rate_to_use).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+        updated_row[11] = sum_som
+        
+        nds_sum = (sum_som * nds_percent / Decimal("100")).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+        updated_row[12] = nds_sum
+    except Exception as e:
+        print(f"[preview_submit_view] Calculation error in preview for obj {idx}: {e}")
+
+    return updated_row, rate_status
+
+
+def posted_row_indexes(post):
+    """Номера строк, поля которых пришли в форме (страница отправляет только измененные строки)."""
+    indexes = set()
+    for key in post:
+        m = ROW_FIELD_RE.match(key)
+        if m:
+            indexes.add(int(m.group(1)))
+    return indexes
+
+
+def preview_page_url(page):
+    url = reverse('preview')
+    return f"{url}?page={page}" if page else url
+
+
+@login_required
+def preview_view(request):
+    job = get_preview_job(request)
+    
+    if job is None:
+        messages.error(request, 'Данные для предпросмотра не найдены. Пожалуйста, загрузите файл заново.')
+        return redirect('upload')
+
+    workspace = get_job_workspace(job.id)
+    workspace.touch()
+    manifest = load_manifest(workspace)
+
+    # С сервера читаются и рендерятся только строки текущей страницы
+    page_obj = PreviewStore(job.id).page(request.GET.get('page'), getattr(settings, 'PREVIEW_PAGE_SIZE', 25))
+    objects_for_template = [build_preview_object(idx, row, manifest) for idx, row in page_obj]
     
     context = {
-        'form': form,
         'objects': objects_for_template,
+        'page_obj': page_obj,
         'media_url': settings.MEDIA_URL
     }
     
     return render(request, 'work/preview.html', context)
 
+
+@login_required
+def preview_row_view(request, index):
+    """
+    Одна строка предпросмотра: GET - HTML строки, POST - сохранение правок строки (с перерасчетом,
+    как кнопка "Обновить"). Ответ - JSON с HTML строки для замены на странице.
+    """
+    job = get_preview_job(request)
+    if job is None:
+        return JsonResponse({'error': 'Данные для предпросмотра не найдены. Пожалуйста, загрузите файл заново.'}, status=404)
+
+    store = PreviewStore(job.id)
+    row = store.get([index]).get(index)
+    if row is None:
+        return JsonResponse({'error': f'Строка {index + 1} не найдена.'}, status=404)
+
+    data = {'index': index, 'saved': False}
+    if request.method == 'POST':
+        form = PreviewEditForm(request.POST, objects_data={index: row})
+        if not form.is_valid():
+            return JsonResponse({'error': 'Пожалуйста, исправьте ошибки в форме.', 'fields': form.errors}, status=400)
+        updated_row, rate_status = apply_row_edits(index, row, form, request.POST, job.params, refresh_rate=True, rate_budget=RateBudget())
+        row_ser = serialize_row(updated_row)
+        if row_ser != row:
+            store.update({index: row_ser})
+            data['saved'] = True
+        row = row_ser
+        if rate_status == 'error':
+            data['message'] = 'Не удалось получить курс доллара. Исправьте дату или введите курс вручную.'
+        elif rate_status == 'stale':
+            data['message'] = 'Сайт НБКР недоступен: использован последний известный курс. Проверьте курс.'
+        print(f"[preview_row_view] Row {index} of job {job.id}: saved={data['saved']}, rate_status={rate_status}")
+
+    data['html'] = render_to_string('work/preview_row.html', {
+        'obj': build_preview_object(index, row, load_manifest(get_job_workspace(job.id))),
+        'media_url': settings.MEDIA_URL,
+    }, request=request)
+    return JsonResponse(data)
+
+
 @login_required
 def preview_submit_view(request):
     if request.method != 'POST':
@@ -237,282 +499,111 @@ def preview_submit_view(request):
     action = request.POST.get('action', 'ready')
     print(f"[preview_submit_view] Called. action={action}")
     
-    preview_data = request.session.get('preview_data')
+    job = get_preview_job(request)
     
-    if not preview_data:
+    if job is None:
         messages.error(request, 'Данные для предпросмотра не найдены. Пожалуйста, загрузите файл заново.')
         return redirect('upload')
     
-    results = preview_data['results']
-    
-    form = PreviewEditForm(request.POST, objects_data=results)
+    store = PreviewStore(job.id)
+    params = job.params
+    try:
+        page = max(1, int(request.POST.get('page') or 1))
+    except ValueError:
+        page = 1
+
+    # Форма содержит только измененные строки; остальные берутся из хранилища как есть
+    edited_rows = store.get(posted_row_indexes(request.POST))
+    form = PreviewEditForm(request.POST, objects_data=edited_rows)
     
-    if form.is_valid():
-        print(f"[preview_submit_view] Form is valid. preview_data keys: {list(preview_data.keys())}, results_count={len(results)}")
-        def serialize_results(rows):
-            serialized = []
-            for row in rows:
-                row_ser = {}
-                for key, value in row.items():
-                    key_str = str(key)
-                    if key_str == 'field_images' and isinstance(value, dict):
-                        field_images_serialized = {str(k): v for k, v in value.items()}
-                        row_ser[key_str] = field_images_serialized
-                        continue
-                    if key_str == 'sources' and isinstance(value, dict):
-                        sources_serialized = {str(k): v for k, v in value.items()}
-                        row_ser[key_str] = sources_serialized
-                        continue
-                    if key_str == 'preview_images':
-                        row_ser[key_str] = value
-                        continue
-                    if key_str == 'errors':
-                        row_ser[key_str] = value
-                        continue
-                    if isinstance(value, Decimal):
-                        row_ser[key_str] = str(value)
-                    else:
-                        row_ser[key_str] = value
-                serialized.append(row_ser)
-            return serialized
+    if not form.is_valid():
+        messages.error(request, 'Пожалуйста, исправьте ошибки в форме.')
+        return redirect(preview_page_url(page))
 
-        updated_results = []
-        has_rate_errors = False
+    print(f"[preview_submit_view] Form is valid. job_id={job.id}, edited_rows={sorted(edited_rows)}")
+    # Общий лимит времени на запросы к НБКР для всех строк перерасчета
+    rate_budget = RateBudget()
 
-        for idx, row in enumerate(results):
-            prefix = f'obj_{idx}'
-            
-            updated_row = {}
-            
-            for key_str, value in row.items():
-                if key_str == 'preview_images':
-                    updated_row['preview_images'] = value
-                    continue
-                if key_str == 'field_images':
-                    updated_row['field_images'] = value
-                    continue
-                if key_str == 'sources':
-                    updated_row['sources'] = value
-                    continue
-                if key_str == 'errors':
-                    updated_row['errors'] = value
-                    continue
-                
-                try:
-                    key = int(key_str)
-                except (ValueError, TypeError):
-                    continue
-                
-                if key in [7, 8, 9, 10, 11, 12] and isinstance(value, str):
-                    try:
-                        updated_row[key] = Decimal(value)
-                    except:
-                        updated_row[key] = value
-                else:
-                    updated_row[key] = value
-            
-            date_value = form.cleaned_data.get(f'{prefix}_date')
-            if not date_value:
-                raw_date = request.POST.get(f'{prefix}_date')
-                if raw_date:
-                    try:
-                        from datetime import datetime as dt
-                        parsed_date = dt.strptime(raw_date, '%Y-%m-%d').date()
-                        date_value = parsed_date
-                    except Exception:
-                        try:
-                            parsed_date = dt.strptime(raw_date, '%d.%m.%Y').date()
-                            date_value = parsed_date
-                        except Exception:
-                            date_value = None
-            if date_value:
-                updated_row[1] = date_value.strftime('%d.%m.%Y')
-            else:
-                updated_row[1] = updated_row.get(1, '')
-
-            marka_value = form.cleaned_data.get(f'{prefix}_marka', '')
-            updated_row[2] = str(marka_value).strip() if marka_value else (updated_row.get(2, '') or '')
-            
-            gos_number_value = form.cleaned_data.get(f'{prefix}_gos_number', '')
-            updated_row[3] = str(gos_number_value).strip() if gos_number_value else (updated_row.get(3, '') or '')
-            
-            fio_value = form.cleaned_data.get(f'{prefix}_fio', '')
-            updated_row[4] = str(fio_value).strip() if fio_value else (updated_row.get(4, '') or '')
-            
-            kol_ton_value = form.cleaned_data.get(f'{prefix}_kol_ton', '')
-            if kol_ton_value:
-                try:
-                    updated_row[7] = Decimal(str(kol_ton_value).replace(',', '.'))
-                except:
-                    updated_row[7] = updated_row.get(7, Decimal("0"))
-            
-            price_value = form.cleaned_data.get(f'{prefix}_price')
-            if price_value is not None:
-                updated_row[8] = Decimal(str(price_value))
-            
-            date_sopr_value = form.cleaned_data.get(f'{prefix}_date_sopr', '')
-            updated_row[13] = str(date_sopr_value).strip() if date_sopr_value else (updated_row.get(13, '') or '')
-            
-            num_sopr_value = form.cleaned_data.get(f'{prefix}_num_sopr', '')
-            updated_row[15] = str(num_sopr_value).strip() if num_sopr_value else (updated_row.get(15, '') or '')
-            
-            invoice_value = form.cleaned_data.get(f'{prefix}_invoice', '')
-            updated_row[16] = str(invoice_value).strip() if invoice_value else (updated_row.get(16, '') or '')
-            
-            for key in [1, 2, 3, 4, 5, 6, 13, 14, 15, 16]:
-                if key not in updated_row:
-                    updated_row[key] = ''
-            
-            try:
-                kol_ton = updated_row.get(7, Decimal("0"))
-                if isinstance(kol_ton, str):
-                    kol_ton = Decimal(kol_ton)
-                cena = updated_row.get(8, Decimal("0"))
-                if isinstance(cena, str):
-                    cena = Decimal(cena)
-
-                base_rate = updated_row.get(10, None)
-                if base_rate is None:
-                    base_rate = preview_data.get('dollar_rate', '0')
-                try:
-                    base_rate = Decimal(base_rate)
-                except Exception:
-                    base_rate = Decimal("0")
-
-                rate_to_use = base_rate
-                
-                original_date_str = row.get('1')
-                current_date_str = updated_row.get(1)
-                
-                date_changed = False
-                if original_date_str != current_date_str:
-                    date_changed = True
-                    print(f"[preview_submit_view] Date changed for obj {idx}: {original_date_str} -> {current_date_str}")
+    if action == 'recalculate':
+        has_rate_errors = False
+        has_stale_rates = False
+        # Сохраняются только строки, которые изменились после правки или перерасчета
+        changed = {}
+        for idx, row in sorted(edited_rows.items()):
+            updated_row, rate_status = apply_row_edits(idx, row, form, request.POST, params, refresh_rate=True, rate_budget=rate_budget)
+            has_rate_errors = has_rate_errors or rate_status == 'error'
+            has_stale_rates = has_stale_rates or rate_status == 'stale'
+            row_ser = serialize_row(updated_row)
+            if row_ser != row:
+                changed[idx] = row_ser
+        store.update(changed)
 
-                if 'errors' in updated_row and updated_row['errors']:
-                    updated_row['errors'] = [e for e in updated_row['errors'] if not str(e).startswith("Ошибка при получении курса")]
+        if has_rate_errors:
+            messages.error(request, 'Не удалось получить курс доллара для некоторых строк при перерасчёте. Исправьте дату или введите курс вручную.')
+        elif has_stale_rates:
+            messages.warning(request, 'Сайт НБКР недоступен: для некоторых строк использован последний известный курс. Проверьте курс в строках с ошибкой.')
+        else:
+            messages.success(request, 'Перерасчёт выполнен.')
 
-                if action == 'recalculate' or date_changed:
-                    try:
-                        date_for_rate = updated_row.get(1)
-                        if not date_for_rate or str(date_for_rate).lower() == 'none':
-                            pass 
-                        else:
-                            print(f"[preview_submit_view] Recalculate/DateChanged: fetching rate for date {date_for_rate}")
-                            rate_to_use = get_current_dollar_rate(date_for_rate)
-                            print(f"[preview_submit_view] Got rate {rate_to_use} for date {date_for_rate}")
-                    except NetworkError as e:
-                        rate_error = f"{e.user_message}|||{e.technical_details}"
-                        print(f"[preview_submit_view] NetworkError for date {date_for_rate}: {e.technical_details}")
-                        updated_row.setdefault('errors', [])
-                        updated_row['errors'].append(rate_error)
-                        has_rate_errors = True
-                        rate_to_use = base_rate
-                    except Exception as e:
-                        rate_error = f"Ошибка при получении курса на дату {updated_row.get(1, '')}: {e}"
-                        print(f"[preview_submit_view] get_current_dollar_rate exception for date {date_for_rate}: {e}")
-                        updated_row.setdefault('errors', [])
-                        updated_row['errors'].append(rate_error)
-                        has_rate_errors = True
-                        rate_to_use = base_rate
+        print(f"[preview_submit_view] Recalculate finished. Saved {len(changed)} of {len(edited_rows)} edited row(s). Redirecting to preview.")
+        return redirect(preview_page_url(page))
 
-                updated_row[10] = rate_to_use
+    updated_results = [
+        apply_row_edits(idx, row, form, request.POST, params, rate_budget=rate_budget)[0]
+        for idx, row in store.iter_rows()
+    ]
 
-                nds_percent = Decimal(preview_data['nds_percent'])
-                
-                sum_dollar = (kol_ton * cena).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-                updated_row[9] = sum_dollar
-                
-                sum_som = (sum_dollar * rate_to_use).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-                updated_row[11] = sum_som
-                
-                nds_sum = (sum_som * nds_percent / Decimal("100")).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-                updated_row[12] = nds_sum
-            except Exception as e:
-                print(f"[preview_submit_view] Calculation error in preview for obj {idx}: {e}")
+    existing_excel = None
+    existing_excel_path = params.get('existing_excel_path')
+    if existing_excel_path and os.path.exists(existing_excel_path):
+        existing_excel = existing_excel_path
+    
+    try:
+        print(f"[preview_submit_view] Generating Excel for {len(updated_results)} rows. existing_excel={bool(existing_excel_path)}")
+        excel_data = []
+        for row_idx, row in enumerate(updated_results):
+            excel_row = {}
+            for key in range(1, 19):
+                if key in row:
+                    value = row[key]
+                    if key in [7, 8, 9, 10, 11, 12] and isinstance(value, str):
+                        try:
+                            value = Decimal(value)
+                        except:
+                            pass
+                    if value is None:
+                        if key in [1, 2, 3, 4, 5, 6, 13, 14, 15, 16, 17, 18]:
+                            value = ''
+                    excel_row[key] = value
+                else:
+                    if key in [1, 2, 3, 4, 5, 6, 13, 14, 15, 16, 17, 18]:
+                        excel_row[key] = ''
+                    else:
+                        excel_row[key] = None
             
-            updated_results.append(updated_row)
-
-        if action == 'recalculate':
-            if has_rate_errors:
-                messages.error(request, 'Не удалось получить курс доллара для некоторых строк при перерасчёте. Исправьте дату или введите курс вручную.')
-            else:
-                messages.success(request, 'Перерасчёт выполнен.')
-
-            preview_data['results'] = serialize_results(updated_results)
-            request.session['preview_data'] = preview_data
-            print(f"[preview_submit_view] Recalculate finished. Saved {len(updated_results)} rows to session. Redirecting to preview.")
-            return redirect('preview')
+            excel_data.append(excel_row)
         
-        existing_excel = None
-        existing_excel_path = preview_data.get('existing_excel_path')
-        if existing_excel_path and os.path.exists(existing_excel_path):
-            existing_excel = existing_excel_path
+        nds_percent = params.get('nds_percent', 2)
         
-        try:
-            print(f"[preview_submit_view] Generating Excel for {len(updated_results)} rows. existing_excel={bool(existing_excel_path)}")
-            excel_data = []
-            for row_idx, row in enumerate(updated_results):
-                excel_row = {}
-                for key in range(1, 19):
-                    if key in row:
-                        value = row[key]
-                        if key in [7, 8, 9, 10, 11, 12] and isinstance(value, str):
-                            try:
-                                value = Decimal(value)
-                            except:
-                                pass
-                        if value is None:
-                            if key in [1, 2, 3, 4, 5, 6, 13, 14, 15, 16, 17, 18]:
-                                value = ''
-                        excel_row[key] = value
-                    else:
-                        if key in [1, 2, 3, 4, 5, 6, 13, 14, 15, 16, 17, 18]:
-                            excel_row[key] = ''
-                        else:
-                            excel_row[key] = None
-                
-                excel_data.append(excel_row)
-            
-            nds_percent = preview_data.get('nds_percent', 2)
-            
-            wb = generate_excel(excel_data, existing_excel, nds_percent=nds_percent)
-            
-            save_photos = preview_data.get('save_photos', False)
-            base_temp_dir = os.path.join(settings.MEDIA_ROOT, "temp_ocr")
-            preview_imgs_dir = os.path.join(base_temp_dir, "preview_imgs")
-            
-            if save_photos:
-                if os.path.exists(preview_imgs_dir):
-                    shutil.rmtree(preview_imgs_dir)
-                if os.path.exists(base_temp_dir):
-                    for item in ['upload', 'extracted', 'existing_excel']:
-                        item_path = os.path.join(base_temp_dir, item)
-                        if os.path.exists(item_path):
-                            shutil.rmtree(item_path)
-            else:
-                if os.path.exists(base_temp_dir):
-                    shutil.rmtree(base_temp_dir)
-            
-            if 'preview_data' in request.session:
-                del request.session['preview_data']
-            
-            response = HttpResponse(content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-            response['Content-Disposition'] = 'attachment; filename=ocr_results.xlsx'
-            wb.save(response)
-            
-            messages.success(request, 'Excel файл успешно создан и загружен!')
-            
-            return response
-            
-        except Exception as e:
-            error_message = str(e)
-            print(f"[preview_submit_view] Exception while generating Excel: {error_message}")
-            messages.error(request, f'Ошибка при создании Excel файла: {error_message}')
-            return redirect('preview')
-    else:
-        messages.error(request, 'Пожалуйста, исправьте ошибки в форме.')
-        return redirect('preview')
+        # Книга собирается во временном файле до удаления рабочего каталога (там лежит загруженный Excel)
+        response = excel_response(excel_data, existing_excel, nds_percent=nds_percent)
+        
+        # Удаляем только рабочий каталог этой задачи; фото при save_photos уже перенесены в MEDIA_ROOT/imgs
+        get_job_workspace(job.id).remove()
+        
+        store.clear()
+        if 'preview_data' in request.session:
+            del request.session['preview_data']
+        
+        messages.success(request, 'Excel файл успешно создан и загружен!')
+        
+        return response
+        
+    except Exception as e:
+        error_message = str(e)
+        print(f"[preview_submit_view] Exception while generating Excel: {error_message}")
+        messages.error(request, f'Ошибка при создании Excel файла: {error_message}')
+        return redirect(preview_page_url(page))
 
 
 def custom_page_not_found_view(request, exception):
@@ -0,0 +1,132 @@
+"""
+Изолированные рабочие каталоги задач.
+
+Каждая задача (ключ - id задачи) получает собственный корень
+MEDIA_ROOT/temp_ocr/<ключ>/ с подкаталогами upload, extracted, preview_imgs и т.д.,
+поэтому параллельные загрузки больше не удаляют файлы друг друга.
+Заброшенные каталоги удаляет cleanup_stale_workspaces по TTL.
+"""
+import os
+import shutil
+import time
+import threading
+import uuid
+
+from django.conf import settings
+
+WORKSPACE_MARKER = ".last_used"
+
+_last_cleanup = 0.0
+_cleanup_lock = threading.Lock()
+
+
+def get_workspaces_root():
+    return os.path.join(settings.MEDIA_ROOT, "temp_ocr")
+
+
+class JobWorkspace:
+    def __init__(self, key=None, base_dir=None):
+        self.key = str(key) if key else uuid.uuid4().hex
+        self.base_dir = str(base_dir or get_workspaces_root())
+        self.root = os.path.join(self.base_dir, self.key)
+
+    def __repr__(self):
+        return f"JobWorkspace({self.root!r})"
+
+    def path(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    @property
+    def upload_dir(self):
+        return self.path("upload")
+
+    @property
+    def extract_dir(self):
+        return self.path("extracted")
+
+    @property
+    def preview_imgs_dir(self):
+        return self.path("preview_imgs")
+
+    @property
+    def existing_excel_dir(self):
+        return self.path("existing_excel")
+
+    def exists(self):
+        return os.path.isdir(self.root)
+
+    def create(self):
+        for d in (self.upload_dir, self.extract_dir, self.preview_imgs_dir):
+            os.makedirs(d, exist_ok=True)
+        self.touch()
+        return self
+
+    def touch(self):
+        """Отмечает каталог как используемый (продлевает TTL)."""
+        if not self.exists():
+            return
+        marker = self.path(WORKSPACE_MARKER)
+        with open(marker, "a"):
+            pass
+        os.utime(marker, None)
+
+    def last_used(self):
+        marker = self.path(WORKSPACE_MARKER)
+        try:
+            return os.path.getmtime(marker)
+        except OSError:
+            try:
+                return os.path.getmtime(self.root)
+            except OSError:
+                return 0.0
+
+    def remove(self):
+        if self.exists():
+            print(f"[JobWorkspace] Removing {self.root}")
+            shutil.rmtree(self.root, ignore_errors=True)
+
+
+def cleanup_stale_workspaces(ttl_seconds=None, active_keys=(), base_dir=None):
+    """
+    Удаляет рабочие каталоги, которые не использовались дольше ttl_seconds.
+    Каталоги из active_keys (например, выполняющиеся задачи) не трогаются.
+    Возвращает список удаленных ключей.
+    """
+    if ttl_seconds is None:
+        ttl_seconds = getattr(settings, 'OCR_WORKSPACE_TTL_SECONDS', 24 * 60 * 60)
+    base_dir = str(base_dir or get_workspaces_root())
+    if not os.path.isdir(base_dir):
+        return []
+
+    active_keys = {str(k) for k in active_keys}
+    now = time.time()
+    removed = []
+    for name in os.listdir(base_dir):
+        if name in active_keys:
+            continue
+        workspace = JobWorkspace(name, base_dir=base_dir)
+        if not workspace.exists():
+            continue
+        if now - workspace.last_used() > ttl_seconds:
+            workspace.remove()
+            removed.append(name)
+
+    if removed:
+        print(f"[cleanup_stale_workspaces] Removed {len(removed)} stale workspace(s)")
+    return removed
+
+
+def maybe_cleanup_stale_workspaces(active_keys=()):
+    """Запускает уборку не чаще раза в OCR_WORKSPACE_CLEANUP_INTERVAL секунд на процесс."""
+    global _last_cleanup
+    interval = getattr(settings, 'OCR_WORKSPACE_CLEANUP_INTERVAL', 60 * 60)
+    with _cleanup_lock:
+        now = time.time()
+        if now - _last_cleanup < interval:
+            return []
+        _last_cleanup = now
+    try:
+        return cleanup_stale_workspaces(active_keys=active_keys)
+    except Exception as e:
+        print(f"[maybe_cleanup_stale_workspaces] Cleanup error: {e}")
+        return []
@@ -0,0 +1,35 @@
+"""
+Конфигурация gunicorn: gunicorn -c config/gunicorn.conf.py config.wsgi
+
+OCR_WARMUP=1       - каждый воркер загружает и прогревает EasyOCR сразу после fork,
+                     а не на первом документе.
+GUNICORN_PRELOAD=1 - загрузить приложение в мастер-процессе до fork (быстрый старт воркеров).
+                     Модель EasyOCR при этом все равно загружается в воркерах: torch небезопасен после fork.
+
+Очередь задач OCR запускается в каждом воркере после загрузки приложения (post_worker_init):
+задачи, прерванные перезапуском сервера, подхватываются без ожидания первого запроса.
+"""
+import os
+
+bind = os.getenv("GUNICORN_BIND", "127.0.0.1:8004")
+workers = int(os.getenv("GUNICORN_WORKERS", "2"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+preload_app = os.getenv("GUNICORN_PRELOAD", "0") == "1"
+
+
+def post_fork(server, worker):
+    if os.getenv("OCR_WARMUP", "0") != "1":
+        return
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings.prod")
+    from apps.work.ocr import warmup_reader, reader_stats
+
+    warmup_reader()
+    server.log.info("OCR reader ready in worker %s: %s", worker.pid, reader_stats())
+
+
+def post_worker_init(worker):
+    # Django уже настроен загрузкой config.wsgi
+    from apps.work.jobs import start_job_queue
+
+    start_job_queue()
+    worker.log.info("OCR job queue started in worker %s", worker.pid)
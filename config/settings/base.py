@@ -131,3 +131,71 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 LOGIN_URL = 'login'
 LOGIN_REDIRECT_URL = 'upload'
 LOGOUT_REDIRECT_URL = 'login'
+
+# Фоновая обработка архивов (apps/work/jobs.py)
+OCR_JOB_WORKERS = int(os.getenv("OCR_JOB_WORKERS", "2"))
+OCR_JOBS_EAGER = os.getenv("OCR_JOBS_EAGER", "0") == "1"  # выполнять задачи синхронно (тесты)
+OCR_JOB_HEARTBEAT_SECONDS = 30  # как часто воркер отмечает свои задачи и проверяет чужие
+OCR_JOB_STALE_SECONDS = 2 * 60  # задача воркера без пульса дольше этого времени считается прерванной
+OCR_JOB_MAX_ATTEMPTS = 3
+
+# Рабочие каталоги задач MEDIA_ROOT/temp_ocr/<job_id> (apps/work/workspace.py)
+OCR_WORKSPACE_TTL_SECONDS = int(os.getenv("OCR_WORKSPACE_TTL_SECONDS", str(24 * 60 * 60)))
+OCR_WORKSPACE_CLEANUP_INTERVAL = 60 * 60
+
+# Параллельный OCR по документам водителей в пуле процессов; 0 или 1 - последовательно
+OCR_PARALLEL_WORKERS = int(os.getenv("OCR_PARALLEL_WORKERS", "0"))
+OCR_DETECT_BATCH_SIZE = 16  # сколько кропов страницы отдавать детектору EasyOCR за один вызов (на общем холсте)
+OCR_RECOGNIZE_BATCH_SIZE = 16  # batch_size распознавателя EasyOCR для строк пакета; 1 - каждая строка отдельно
+
+# Картинки полей для превью и отладочный кроп якоря пишутся в фоне (apps/work/image_writer.py)
+OCR_SAVE_PREVIEW_IMAGES = os.getenv("OCR_SAVE_PREVIEW_IMAGES", "1") == "1"
+OCR_SAVE_DEBUG_IMAGES = os.getenv("OCR_SAVE_DEBUG_IMAGES", "0") == "1"
+
+# Кэш результатов OCR по содержимому PDF (apps/work/ocr_cache.py)
+OCR_CACHE_ENABLED = os.getenv("OCR_CACHE_ENABLED", "1") == "1"
+OCR_CACHE_PATH = os.getenv("OCR_CACHE_PATH", str(BASE_DIR / "cache" / "ocr_results.sqlite3"))
+OCR_CACHE_MAX_ENTRIES = int(os.getenv("OCR_CACHE_MAX_ENTRIES", "20000"))
+OCR_CACHE_TTL_SECONDS = int(os.getenv("OCR_CACHE_TTL_SECONDS", str(30 * 24 * 60 * 60)))
+
+# Для ЭСФ/СНТ рендерится только область полей (с запасом в пикселях), а не вся страница
+OCR_RENDER_CLIP_MARGIN = 16
+
+# Поля ЭСФ/СНТ сначала читаются из текстового слоя PDF, OCR - только если он пуст или не прошел проверку
+OCR_TEXT_LAYER_ENABLED = os.getenv("OCR_TEXT_LAYER_ENABLED", "1") == "1"
+
+# Кэш открытых PDF и отрендеренных страниц в пределах задачи (apps/work/pdf_cache.py)
+OCR_DOC_CACHE_MAX_DOCUMENTS = 16
+OCR_PAGE_CACHE_MAX_MB = int(os.getenv("OCR_PAGE_CACHE_MAX_MB", "256"))
+
+# Выравнивание Type 1: угол оценивается по копии страницы в OCR_DESKEW_SCALE * 300 dpi, меньшие углы не исправляются
+OCR_DESKEW_SCALE = 0.5
+OCR_DESKEW_MIN_ANGLE = 0.1
+
+# Якорь Type 1 ищется сопоставлением с образцом (apps/work/anchors.py); OCR - только если совпадение ниже порога
+OCR_ANCHOR_MATCHING_ENABLED = os.getenv("OCR_ANCHOR_MATCHING_ENABLED", "1") == "1"
+OCR_ANCHOR_TEMPLATE_DIR = os.getenv("OCR_ANCHOR_TEMPLATE_DIR", str(BASE_DIR / "cache" / "anchors"))
+OCR_ANCHOR_MATCH_THRESHOLD = 0.8
+
+# Курс НБКР (apps/work/rates.py): курс на сегодня перепроверяется не чаще раза в TTL; клиент сети можно подменить
+NBKR_RATE_TODAY_TTL_SECONDS = int(os.getenv("NBKR_RATE_TODAY_TTL_SECONDS", str(60 * 60)))
+NBKR_RATE_CLIENT = os.getenv("NBKR_RATE_CLIENT", "apps.work.rates.NBKRClient")
+NBKR_CONNECT_TIMEOUT = 3
+NBKR_READ_TIMEOUT = 10
+NBKR_HTTP_POOL_SIZE = 4
+NBKR_REQUEST_BUDGET_SECONDS = int(os.getenv("NBKR_REQUEST_BUDGET_SECONDS", "15"))  # на все строки одного перерасчета
+
+# Распаковка архива (apps/work/ingest.py): ограничения от zip-бомб проверяются по фактически распакованным байтам
+OCR_ZIP_MAX_MEMBERS = 5000
+OCR_ZIP_MAX_MEMBER_MB = int(os.getenv("OCR_ZIP_MAX_MEMBER_MB", "100"))
+OCR_ZIP_MAX_TOTAL_MB = int(os.getenv("OCR_ZIP_MAX_TOTAL_MB", "2048"))
+OCR_ZIP_MAX_RATIO = 200
+
+# Конвейер последовательного режима (apps/work/pipeline.py): страницы следующих документов рендерятся в потоках,
+# пока идет OCR текущего; очередь - не больше OCR_PIPELINE_QUEUE_SIZE документов вперед (0 - без конвейера).
+# Страницы очереди хранятся в кэше страниц: при большой очереди они вытесняют друг друга из OCR_PAGE_CACHE_MAX_MB
+OCR_PIPELINE_RENDER_THREADS = int(os.getenv("OCR_PIPELINE_RENDER_THREADS", "2"))
+OCR_PIPELINE_QUEUE_SIZE = int(os.getenv("OCR_PIPELINE_QUEUE_SIZE", "2"))
+
+# Предпросмотр результатов (apps/work/views.py): строки показываются и сохраняются постранично
+PREVIEW_PAGE_SIZE = int(os.getenv("PREVIEW_PAGE_SIZE", "25"))